@@ -0,0 +1,19 @@
+CREATE TABLE wxdata.band_progress
+(
+    model text COLLATE pg_catalog."default" NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    fh text COLLATE pg_catalog."default" NOT NULL,
+    band text COLLATE pg_catalog."default" NOT NULL,
+    status text COLLATE pg_catalog."default",
+    retries integer,
+    bytes bigint,
+    started_at timestamp with time zone,
+    finished_at timestamp with time zone,
+    CONSTRAINT band_progress_pkey PRIMARY KEY (model, "timestamp", fh, band)
+)
+WITH (
+    OIDS = FALSE
+)
+TABLESPACE pg_default;
+
+GRANT INSERT, SELECT, UPDATE, DELETE ON TABLE wxdata.band_progress TO eolus;
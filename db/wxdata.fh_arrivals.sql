@@ -0,0 +1,18 @@
+CREATE TABLE wxdata.fh_arrivals
+(
+    model text COLLATE pg_catalog."default" NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    fh text COLLATE pg_catalog."default" NOT NULL,
+    first_seen timestamp with time zone,
+    upstream_at timestamp with time zone,
+    started_at timestamp with time zone,
+    finished_at timestamp with time zone,
+    published_at timestamp with time zone,
+    CONSTRAINT fh_arrivals_pkey PRIMARY KEY (model, "timestamp", fh)
+)
+WITH (
+    OIDS = FALSE
+)
+TABLESPACE pg_default;
+
+GRANT INSERT, SELECT, UPDATE, DELETE ON TABLE wxdata.fh_arrivals TO eolus;
@@ -5,6 +5,7 @@ CREATE TABLE wxdata.models
     status text COLLATE pg_catalog."default",
     lastfh text COLLATE pg_catalog."default",
     paused_at timestamp with time zone,
+    resume_at timestamp with time zone,
     CONSTRAINT models_pkey PRIMARY KEY (model)
 )
 WITH (
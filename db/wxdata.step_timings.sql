@@ -0,0 +1,26 @@
+CREATE TABLE wxdata.step_timings
+(
+    model text COLLATE pg_catalog."default" NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    fh text COLLATE pg_catalog."default" NOT NULL,
+    band text COLLATE pg_catalog."default" NOT NULL,
+    head_seconds real,
+    idx_seconds real,
+    download_seconds real,
+    translate_seconds real,
+    warp_seconds real,
+    create_seconds real,
+    write_seconds real,
+    download_bytes bigint,
+    finished_at timestamp with time zone NOT NULL
+)
+WITH (
+    OIDS = FALSE
+)
+TABLESPACE pg_default;
+
+CREATE INDEX step_timings_model_timestamp_idx
+    ON wxdata.step_timings USING btree
+    (model, "timestamp");
+
+GRANT INSERT, SELECT, DELETE ON TABLE wxdata.step_timings TO eolus;
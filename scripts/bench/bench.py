@@ -0,0 +1,448 @@
+from datetime import datetime
+from urllib.parse import urlsplit
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytz
+
+import standin
+
+'''
+    Offline benchmarks against the local NOMADS stand-in (standin.py).
+
+    `record` pulls the first few forecast hours of a model from upstream
+    into a fixtures directory, once. For index models only the configured
+    bands are kept, with a rewritten .idx, so fixtures stay small.
+
+    `run` then serves those fixtures locally (optionally with added latency
+    and limited bandwidth) and times one of:
+     * bands - processing.download_band for every band of every fh
+     * full  - processing.download_full_file for every fh
+     * init  - a whole `wxdata.py` pass, as cron would run it. This one
+               needs config.json to point at a scratch database.
+
+    It reports bands/s, bytes/s, CPU seconds per fh and peak RSS, and can
+    save them as a baseline or compare against the saved one.
+
+    wxdata_lib is only imported once WXDATA_CONFIG points at the
+    benchmark's own config, since it loads the config on import.
+'''
+
+utc = pytz.UTC
+
+directory = os.path.dirname(os.path.realpath(__file__))
+scripts_dir = os.path.realpath(directory + "/..")
+default_fixtures = directory + "/fixtures"
+baselines_dir = directory + "/baselines"
+
+# Higher is better for these, lower is better for the rest
+THROUGHPUT_KEYS = ["bands_per_second", "bytes_per_second"]
+COST_KEYS = ["cpu_seconds_per_fh", "peak_rss_mb"]
+
+
+def load_base_config(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_config(data, work_dir):
+    path = work_dir + "/config.json"
+    with open(path, "w") as f:
+        json.dump(data, f, indent=4)
+    os.environ["WXDATA_CONFIG"] = path
+    return path
+
+
+def get_templates(model):
+    return model["url"] if isinstance(model["url"], list) else [model["url"]]
+
+
+def get_fixture_path(url):
+    parts = urlsplit(url)
+    return parts.netloc + parts.path
+
+
+def import_wxdata():
+    sys.path.insert(0, scripts_dir)
+    # pg has to come first, logger and pg import each other
+    import wxdata_lib.pg_connection_manager
+    import wxdata_lib.model_tools as model_tools
+    import wxdata_lib.processing as processing
+    import wxdata_lib.schedules as schedules
+    from osgeo import gdal
+    gdal.UseExceptions()
+    return model_tools, processing, schedules
+
+
+def get_rusage(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024
+
+
+def load_manifest(fixtures):
+    return standin.load_manifest(fixtures)
+
+
+def save_manifest(fixtures, manifest):
+    with open(fixtures + "/manifest.json", "w") as f:
+        json.dump(manifest, f, indent=4)
+
+
+'''
+    Recording
+'''
+
+
+def get_idx_messages(idx_text, content_length):
+    # (start, end, line) for each message, end exclusive
+    lines = [line for line in idx_text.splitlines() if line.strip()]
+    offsets = [int(line.split(":")[1]) for line in lines]
+    messages = []
+    for i, line in enumerate(lines):
+        end = offsets[i + 1] if i + 1 < len(lines) else content_length
+        messages.append((offsets[i], end, line))
+    return messages
+
+
+def record_fh(model_tools, processing, model_name, url, steps, fixture_file, http):
+    os.makedirs(os.path.dirname(fixture_file), exist_ok=True)
+
+    head = http.request("HEAD", url)
+    if head.status != 200:
+        print("× " + url + " isn't available (" + str(head.status) + ").")
+        return False
+    content_length = int(head.headers["Content-Length"])
+
+    band_steps = [step for step in steps if step.band is not None]
+    if len(band_steps) == 0:
+        print("↓ " + url + " (" + str(content_length // 1024) + " KB)")
+        response = http.request("GET", url, preload_content=False)
+        with open(fixture_file, "wb") as f:
+            shutil.copyfileobj(response, f)
+        response.release_conn()
+        return True
+
+    idx_text = http.request("GET", url + ".idx").data.decode("utf-8")
+    messages = get_idx_messages(idx_text, content_length)
+
+    # Every message a configured band's byte range touches
+    keep = set()
+    for step in band_steps:
+        byte_range = processing.get_byte_range(
+            step.band, url + ".idx", str(content_length))
+        if byte_range is None:
+            print("· No " + step.band["shorthand"] +
+                  " in " + url + ", skipping it.")
+            continue
+        start, end = [int(value) for value in byte_range.split("-")]
+        for i, (message_start, message_end, line) in enumerate(messages):
+            if start <= message_start < end:
+                keep.add(i)
+
+    print("↓ " + url + " (" + str(len(keep)) +
+          " of " + str(len(messages)) + " messages)")
+    new_idx = []
+    offset = 0
+    with open(fixture_file, "wb") as f:
+        for i in sorted(keep):
+            message_start, message_end, line = messages[i]
+            data = http.request("GET", url, headers={
+                "Range": "bytes=" + str(message_start) + "-" + str(message_end - 1)}).data
+            f.write(data)
+            parts = line.split(":")
+            new_idx.append(":".join([parts[0], str(offset)] + parts[2:]))
+            offset += len(data)
+
+    with open(fixture_file + ".idx", "w") as f:
+        f.write("\n".join(new_idx) + "\n")
+    return True
+
+
+def record(args):
+    base = load_base_config(args.config)
+    if args.model not in base["models"]:
+        print("Unknown model " + args.model)
+        return 1
+
+    work_dir = tempfile.mkdtemp(prefix="wxbench_")
+    data = json.loads(json.dumps(base))
+    data["config"]["tempDir"] = work_dir
+    data["config"]["downloadCacheMB"] = 0
+    data["config"]["logLevels"] = ["WARN", "ERROR"]
+    write_config(data, work_dir)
+
+    model_tools, processing, schedules = import_wxdata()
+    from wxdata_lib.http_manager import http
+
+    model = data["models"][args.model]
+    if args.run:
+        timestamp = utc.localize(datetime.strptime(args.run, "%Y%m%d%H"))
+    else:
+        timestamp = model_tools.get_last_available_timestamp(model, prev=1)
+
+    hour = timestamp.strftime("%H")
+    schedule = schedules.get_schedule(args.model, hour)
+    fhs = list(schedule.full_fhs[:args.fh_count])
+    steps = model_tools.make_band_dict(args.model, hour)
+
+    # Flat time models keep every fh in one file, so steps are grouped by file
+    urls = {}
+    for fh in fhs:
+        url = model_tools.get_model(args.model).make_url(
+            timestamp.strftime("%Y%m%d"), hour, fh)
+        urls.setdefault(url, []).extend(
+            step for step in steps.values() if step.fh == fh)
+
+    os.makedirs(args.fixtures, exist_ok=True)
+    recorded = {}
+    for url, url_steps in urls.items():
+        recorded[url] = record_fh(model_tools, processing, args.model, url, url_steps,
+                                  args.fixtures + "/" + get_fixture_path(url), http)
+
+    # Only keep the fhs up to the first one that couldn't be recorded
+    for i, fh in enumerate(fhs):
+        url = model_tools.get_model(args.model).make_url(
+            timestamp.strftime("%Y%m%d"), hour, fh)
+        if not recorded[url]:
+            fhs = fhs[:i]
+            break
+
+    template = get_templates(model)[0]
+    manifest = load_manifest(args.fixtures)
+    manifest[args.model] = {
+        "run": timestamp.strftime("%Y%m%d%H"),
+        "path": get_fixture_path(template),
+        "fhs": fhs
+    }
+    save_manifest(args.fixtures, manifest)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("✓ Recorded " + str(len(fhs)) + " fhs of " + args.model +
+          " " + timestamp.strftime("%Y%m%d %HZ") + " into " + args.fixtures)
+    return 0
+
+
+'''
+    Running
+'''
+
+
+def make_run_config(base, model_name, recorded, server, work_dir, args):
+    data = json.loads(json.dumps(base))
+    conf = data["config"]
+    conf["tempDir"] = work_dir + "/temp"
+    conf["mapfileDir"] = work_dir + "/map"
+    conf["downloadCacheMB"] = args.cache_mb
+    conf["logLevels"] = args.log_levels.split(",") if args.log_levels else []
+    conf.pop("metricsFile", None)
+    conf.pop("metricsPort", None)
+    os.makedirs(conf["tempDir"])
+    os.makedirs(conf["mapfileDir"])
+
+    for name, model in data["models"].items():
+        model["enabled"] = name == model_name
+
+    model = data["models"][model_name]
+    template = get_templates(model)[0]
+    model["url"] = server.get_url() + "/" + get_fixture_path(template) + \
+        (("?" + urlsplit(template).query) if urlsplit(template).query else "")
+    # Stop where the recording stops, so the run can finish
+    model["endTime"] = int(recorded["fhs"][-1])
+
+    return data
+
+
+def run_in_process(scenario, model_name, recorded, model_tools, processing, schedules):
+    timestamp = utc.localize(datetime.strptime(recorded["run"], "%Y%m%d%H"))
+    hour = timestamp.strftime("%H")
+    schedule = schedules.get_schedule(model_name, hour)
+    done = 0
+    total = 0
+
+    if scenario == "bands":
+        steps = model_tools.make_band_dict(model_name, hour)
+        for step in steps.values():
+            if step.fh not in recorded["fhs"] or step.band is None:
+                continue
+            total += 1
+            if processing.download_band(model_name, timestamp, step.fh, step.band, step.band_num):
+                done += 1
+    else:
+        bands = model_tools.make_model_band_array(model_name, force=True) or []
+        for fh in recorded["fhs"]:
+            total += len(bands)
+            if processing.download_full_file(model_name, timestamp, fh, schedule.band_numbers[fh]):
+                done += len(bands)
+
+    return done, total
+
+
+def run(args):
+    manifest = load_manifest(args.fixtures)
+    if args.model not in manifest:
+        print("No fixtures for " + args.model +
+              ", record them first with `bench.py record`.")
+        return 1
+    recorded = manifest[args.model]
+
+    server = standin.start(args.fixtures, latency=args.latency,
+                           bandwidth=args.bandwidth, any_run=args.scenario == "init")
+    work_dir = tempfile.mkdtemp(prefix="wxbench_")
+    data = make_run_config(load_base_config(args.config), args.model,
+                           recorded, server, work_dir, args)
+    config_path = write_config(data, work_dir)
+
+    print(f"Running {args.scenario} for {args.model} against {server.get_url()} " +
+          f"({str(len(recorded['fhs']))} fhs, {str(args.latency)}s latency, " +
+          (f"{str(int(args.bandwidth))} B/s)" if args.bandwidth else "unlimited bandwidth)"))
+
+    started = time.time()
+    if args.scenario == "init":
+        cpu_before, rss_before = get_rusage(resource.RUSAGE_CHILDREN)
+        process = subprocess.run([sys.executable, scripts_dir + "/wxdata.py"],
+                                 cwd=scripts_dir, env=dict(os.environ, WXDATA_CONFIG=config_path))
+        seconds = time.time() - started
+        cpu_after, peak_rss = get_rusage(resource.RUSAGE_CHILDREN)
+        done = count_done_steps(args.model, started)
+        total = None
+        ok = process.returncode == 0
+    else:
+        model_tools, processing, schedules = import_wxdata()
+        cpu_before, rss_before = get_rusage(resource.RUSAGE_SELF)
+        done, total = run_in_process(args.scenario, args.model, recorded,
+                                     model_tools, processing, schedules)
+        seconds = time.time() - started
+        cpu_after, peak_rss = get_rusage(resource.RUSAGE_SELF)
+        ok = done == total
+
+    served = server.stats.snapshot()
+    server.shutdown()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        "scenario": args.scenario,
+        "model": args.model,
+        "fhs": len(recorded["fhs"]),
+        "steps_done": done,
+        "steps_total": total,
+        "seconds": round(seconds, 3),
+        "bands_per_second": round(done / seconds, 3),
+        "bytes_per_second": round(served["bytes"] / seconds, 1),
+        "cpu_seconds_per_fh": round((cpu_after - cpu_before) / len(recorded["fhs"]), 3),
+        "peak_rss_mb": round(peak_rss, 1),
+        "requests": served["requests"],
+        "latency": args.latency,
+        "bandwidth": args.bandwidth,
+        "recorded_at": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+    print_results(results)
+
+    baseline_path = baselines_dir + "/" + args.scenario + "-" + args.model + ".json"
+    exit_code = 0 if ok else 1
+    if args.compare:
+        if compare(results, baseline_path, args.tolerance):
+            exit_code = 1
+    if args.save:
+        os.makedirs(baselines_dir, exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=4)
+        print("✓ Saved baseline " + baseline_path)
+
+    return exit_code
+
+
+def count_done_steps(model_name, started):
+    import_wxdata()
+    import wxdata_lib.pg_connection_manager as pg
+
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        curr.execute("SELECT COUNT(*) FROM wxdata.band_progress WHERE model = %s AND status = 'DONE' AND finished_at >= %s",
+                     (model_name, datetime.fromtimestamp(started, utc)))
+        return curr.fetchone()[0]
+    except Exception as e:
+        print("× Couldn't count finished steps: " + repr(e))
+        return 0
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+
+def print_results(results):
+    total = "?" if results["steps_total"] is None else str(
+        results["steps_total"])
+    print(f"   steps       {str(results['steps_done'])}/{total} in {results['seconds']:.1f}s")
+    print(f"   bands/s     {results['bands_per_second']:.2f}")
+    print(f"   bytes/s     {results['bytes_per_second'] / 1024 / 1024:.2f} MB/s")
+    print(f"   CPU s/fh    {results['cpu_seconds_per_fh']:.2f}")
+    print(f"   peak RSS    {results['peak_rss_mb']:.0f} MB")
+    print(f"   requests    " + ", ".join(f"{key}: {str(count)}" for key, count in sorted(results["requests"].items())))
+
+
+def compare(results, baseline_path, tolerance):
+    try:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    except OSError:
+        print("· No baseline at " + baseline_path + " yet.")
+        return False
+
+    regressed = False
+    print("Compared to the baseline from " + baseline["recorded_at"] + ":")
+    for key in THROUGHPUT_KEYS + COST_KEYS:
+        if not baseline.get(key):
+            continue
+        change = (results[key] - baseline[key]) / baseline[key] * 100
+        worse = -change if key in THROUGHPUT_KEYS else change
+        flag = "×" if worse > tolerance else "✓"
+        regressed = regressed or worse > tolerance
+        print(f"   {flag} {key:<20} {baseline[key]:>12} -> {results[key]:<12} ({change:+.1f}%)")
+
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks against a local NOMADS stand-in.")
+    parser.add_argument("--config", default=scripts_dir + "/config.json",
+                        help="config to base the benchmark on (default: scripts/config.json)")
+    parser.add_argument("--fixtures", default=default_fixtures,
+                        help="fixtures directory (default: bench/fixtures)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser(
+        "record", help="download fixtures for a model from upstream")
+    record_parser.add_argument("model")
+    record_parser.add_argument("--run", help="run to record, YYYYMMDDHH (default: the previous run)")
+    record_parser.add_argument("--fh-count", type=int, default=3,
+                               help="how many forecast hours to record (default: 3)")
+
+    run_parser = subparsers.add_parser("run", help="run a benchmark")
+    run_parser.add_argument("scenario", choices=["bands", "full", "init"])
+    run_parser.add_argument("model")
+    run_parser.add_argument("--latency", type=float, default=0,
+                            help="seconds added to every request")
+    run_parser.add_argument("--bandwidth", type=float, default=0,
+                            help="bytes/second per connection, 0 for unlimited")
+    run_parser.add_argument("--cache-mb", type=int, default=0,
+                            help="downloadCacheMB to run with (default: 0, off)")
+    run_parser.add_argument("--log-levels", default="ERROR",
+                            help="comma separated logLevels to run with (default: ERROR)")
+    run_parser.add_argument("--save", action="store_true",
+                            help="save the results as the new baseline")
+    run_parser.add_argument("--compare", action="store_true",
+                            help="compare against the saved baseline, exit 1 on a regression")
+    run_parser.add_argument("--tolerance", type=float, default=10,
+                            help="percent a metric can get worse before it's a regression (default: 10)")
+
+    args = parser.parse_args()
+    sys.exit(record(args) if args.command == "record" else run(args))
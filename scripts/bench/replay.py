@@ -0,0 +1,359 @@
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+import argparse
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import bench
+import standin
+
+'''
+    Replays a day (or any stretch) of model cycles to see how the scheduler
+    copes, on a clock running --speed times faster than real time.
+
+    The stand-in serves the recorded fixtures for every run and fh, but
+    holds each file back until the schedule says it's out: the cycle time
+    plus that fh's lag. Lags come from a schedule file (`export` writes one
+    from the arrival history in wxdata.fh_arrivals) or, without one, fhs
+    show up every --fh-interval seconds starting --first-lag minutes after
+    the cycle.
+
+    `wxdata.py --daemon` runs against it with its clock set to the
+    simulated time (see wxdata_lib/clock.py). Afterwards it reports, per
+    model, how long fhs and whole runs took to be published after they
+    came out, how busy the workers were and how many requests were made.
+    --set overrides config values, so scheduling policies can be compared.
+
+    Processing itself still takes real time, which the fast clock
+    stretches: keep fixtures small and --speed modest enough that a step
+    doesn't take a big share of the time between fhs.
+
+    This needs config.json to point at a scratch database; the simulated
+    models' rows are cleared before each replay.
+'''
+
+
+def parse_overrides(pairs):
+    overrides = {}
+    for pair in pairs:
+        key, _, value = pair.partition("=")
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+
+def make_replay_config(base, model_names, server, work_dir, args):
+    data = json.loads(json.dumps(base))
+    conf = data["config"]
+    conf["tempDir"] = work_dir + "/temp"
+    conf["mapfileDir"] = work_dir + "/map"
+    conf["logLevels"] = args.log_levels.split(",") if args.log_levels else []
+    conf.pop("metricsFile", None)
+    conf.pop("metricsPort", None)
+    conf.update(parse_overrides(args.set))
+    os.makedirs(conf["tempDir"])
+    os.makedirs(conf["mapfileDir"])
+
+    for name, model in data["models"].items():
+        model["enabled"] = name in model_names
+        if name in model_names:
+            template = bench.get_templates(model)[0]
+            model["url"] = server.get_url() + "/" + bench.get_fixture_path(template) + \
+                (("?" + urlsplit(template).query) if urlsplit(template).query else "")
+
+    return data
+
+
+'''
+    Schedules map model -> fh -> seconds after the cycle time.
+'''
+
+
+def load_schedule(path):
+    if path is None:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def get_lag(schedule, schedules, model_name, hour, fh, args):
+    if model_name in schedule and fh in schedule[model_name]:
+        return timedelta(seconds=schedule[model_name][fh])
+
+    full_fhs = schedules.get_schedule(model_name, hour).full_fhs
+    index = full_fhs.index(fh) if fh in full_fhs else 0
+    return timedelta(minutes=args.first_lag) + timedelta(seconds=args.fh_interval * index)
+
+
+class ReplayServer(standin.StandinServer):
+    def is_available(self, path):
+        path = path.split("?", 1)[0]
+        for model_name, pattern, recorded_path, first_fh in self.run_patterns:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            groups = match.groupdict()
+            if not groups.get("date"):
+                return True
+
+            run_time = datetime.strptime(groups["date"] + (groups.get("hour") or "00"),
+                                         "%Y%m%d%H").replace(tzinfo=timezone.utc)
+            fh = groups.get("fh") or first_fh
+            lag = get_lag(self.schedule, self.schedules, model_name,
+                          run_time.strftime("%H"), fh, self.args)
+            return self.clock.now() >= run_time + lag
+
+        return True
+
+
+def reset_models(pg, model_names):
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        for table in ["models", "band_progress", "fh_arrivals"]:
+            curr.execute("DELETE FROM wxdata." + table +
+                         " WHERE model = ANY(%s)", (list(model_names),))
+        conn.commit()
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return {
+        "p50": round(statistics.median(values), 1),
+        "p95": round(values[min(int(len(values) * 0.95), len(values) - 1)], 1),
+        "max": round(values[-1], 1)
+    }
+
+
+def make_report(pg, schedules, schedule, model_names, sim_start, sim_end, max_threads, args):
+    conn = curr = None
+    report = {}
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        for model_name in model_names:
+            curr.execute("""
+                SELECT timestamp, fh, published_at FROM wxdata.fh_arrivals
+                WHERE model = %s AND published_at IS NOT NULL AND published_at <= %s""",
+                         (model_name, sim_end))
+            fh_latency = []
+            runs = {}
+            for timestamp, fh, published_at in curr.fetchall():
+                timestamp = timestamp.astimezone(timezone.utc)
+                hour = timestamp.strftime("%H")
+                available_at = timestamp + \
+                    get_lag(schedule, schedules, model_name, hour, fh, args)
+                if available_at < sim_start:
+                    continue
+                fh_latency.append(
+                    (published_at - available_at).total_seconds() / 60)
+                runs.setdefault(timestamp, []).append(published_at)
+
+            # A run is done when all of its fhs are published
+            run_latency = []
+            for timestamp, published in runs.items():
+                full_fhs = schedules.get_schedule(
+                    model_name, timestamp.strftime("%H")).full_fhs
+                if len(published) < len(full_fhs):
+                    continue
+                last_available = timestamp + get_lag(schedule, schedules, model_name,
+                                                     timestamp.strftime("%H"), full_fhs[-1], args)
+                run_latency.append(
+                    (max(published) - last_available).total_seconds() / 60)
+
+            curr.execute("""
+                SELECT COUNT(*), COALESCE(SUM(EXTRACT(EPOCH FROM finished_at - started_at)), 0)
+                FROM wxdata.band_progress
+                WHERE model = %s AND started_at >= %s AND finished_at <= %s""",
+                         (model_name, sim_start, sim_end))
+            steps, busy_seconds = curr.fetchone()
+
+            report[model_name] = {
+                "fhs_published": len(fh_latency),
+                "fh_latency_minutes": percentiles(fh_latency),
+                "runs_completed": len(run_latency),
+                "run_latency_minutes": percentiles(run_latency),
+                "steps": steps,
+                "busy_seconds": float(busy_seconds)
+            }
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+    sim_seconds = (sim_end - sim_start).total_seconds()
+    total_busy = sum(model["busy_seconds"] for model in report.values())
+    return {
+        "models": report,
+        "worker_utilization": round(total_busy / (max_threads * sim_seconds), 4)
+    }
+
+
+def run(args):
+    model_names = args.models.split(",")
+    manifest = bench.load_manifest(args.fixtures)
+    missing = [name for name in model_names if name not in manifest]
+    if missing:
+        print("No fixtures for " + ", ".join(missing) +
+              ", record them first with `bench.py record`.")
+        return 1
+
+    sim_start = datetime.fromisoformat(args.start).replace(tzinfo=timezone.utc) if args.start else \
+        (datetime.now(timezone.utc) - timedelta(days=1)).replace(hour=0,
+                                                                  minute=0, second=0, microsecond=0)
+    sim_end = sim_start + timedelta(hours=args.hours)
+
+    server = standin.start(args.fixtures, 0, args.latency, args.bandwidth,
+                           any_run=True, any_fh=True, server_class=ReplayServer)
+    work_dir = tempfile.mkdtemp(prefix="wxreplay_")
+    base = bench.load_base_config(args.config)
+    data = make_replay_config(base, model_names, server, work_dir, args)
+    config_path = bench.write_config(data, work_dir)
+
+    real_start = time.time()
+    os.environ["WXDATA_CLOCK"] = ",".join(
+        [sim_start.replace(tzinfo=None).isoformat(), str(args.speed), str(real_start)])
+
+    sys.path.insert(0, bench.scripts_dir)
+    import wxdata_lib.pg_connection_manager as pg
+    import wxdata_lib.schedules as schedules
+    import wxdata_lib.clock as clock
+
+    schedule = load_schedule(args.schedule)
+    server.schedule = schedule
+    server.schedules = schedules
+    server.clock = clock
+    server.args = args
+
+    reset_models(pg, model_names)
+
+    real_seconds = args.hours * 3600 / args.speed
+    print(f"Replaying {str(args.hours)}h of {', '.join(model_names)} from {sim_start.strftime('%Y-%m-%d %H:%MZ')} " +
+          f"at {str(args.speed)}x, about {real_seconds / 60:.1f} minutes.")
+
+    process = subprocess.Popen([sys.executable, bench.scripts_dir + "/wxdata.py", "--daemon"],
+                               cwd=bench.scripts_dir, env=dict(os.environ, WXDATA_CONFIG=config_path))
+    try:
+        while clock.now() < sim_end and process.poll() is None:
+            time.sleep(1)
+    finally:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+    results = make_report(pg, schedules, schedule, model_names, sim_start,
+                          min(clock.now(), sim_end), data["config"]["maxThreads"], args)
+    results["requests"] = server.stats.snapshot()["requests"]
+    results["settings"] = {
+        "models": model_names,
+        "start": sim_start.isoformat(),
+        "hours": args.hours,
+        "speed": args.speed,
+        "overrides": parse_overrides(args.set),
+        "schedule": args.schedule
+    }
+
+    server.shutdown()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(results)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=4, default=str)
+        print("✓ Saved results to " + args.out)
+
+    return 0
+
+
+def format_percentiles(values):
+    if values is None:
+        return "-"
+    return f"p50 {values['p50']:.1f}m, p95 {values['p95']:.1f}m, max {values['max']:.1f}m"
+
+
+def print_report(results):
+    for model_name, model in results["models"].items():
+        print(model_name)
+        print(f"   fhs published   {str(model['fhs_published'])}, " +
+              format_percentiles(model["fh_latency_minutes"]) + " after release")
+        print(f"   runs completed  {str(model['runs_completed'])}, " +
+              format_percentiles(model["run_latency_minutes"]) + " after the last fh")
+        print(f"   steps           {str(model['steps'])}")
+    print(f"Worker utilization {results['worker_utilization'] * 100:.1f}%")
+    print("Requests           " + ", ".join(f"{key}: {str(count)}" for key, count in sorted(results["requests"].items())))
+
+
+def export(args):
+    os.environ["WXDATA_CONFIG"] = args.config
+    sys.path.insert(0, bench.scripts_dir)
+    import wxdata_lib.pg_connection_manager as pg
+
+    schedule = {}
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        curr.execute("""
+            SELECT model, fh, percentile_cont(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM COALESCE(upstream_at, first_seen) - timestamp))
+            FROM wxdata.fh_arrivals
+            WHERE first_seen IS NOT NULL AND timestamp > now() - %s * interval '1 day'
+            GROUP BY model, fh ORDER BY model, fh""", (args.days,))
+        for model_name, fh, lag in curr.fetchall():
+            schedule.setdefault(model_name, {})[fh] = round(lag)
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+    print(json.dumps(schedule, indent=4))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay model cycles against the scheduler on a fast clock.")
+    parser.add_argument("--config", default=bench.scripts_dir + "/config.json",
+                        help="config to base the replay on (default: scripts/config.json)")
+    parser.add_argument("--fixtures", default=bench.default_fixtures,
+                        help="fixtures directory (default: bench/fixtures)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run a replay")
+    run_parser.add_argument("models", help="comma separated models to replay")
+    run_parser.add_argument("--start", help="simulated start, ISO UTC time (default: yesterday 00Z)")
+    run_parser.add_argument("--hours", type=float, default=24,
+                            help="simulated hours to replay (default: 24)")
+    run_parser.add_argument("--speed", type=float, default=60,
+                            help="how much faster than real time the clock runs (default: 60)")
+    run_parser.add_argument("--schedule", help="schedule file from `export`")
+    run_parser.add_argument("--first-lag", type=float, default=60,
+                            help="without a schedule, minutes after the cycle the first fh is out (default: 60)")
+    run_parser.add_argument("--fh-interval", type=float, default=60,
+                            help="without a schedule, seconds between fhs (default: 60)")
+    run_parser.add_argument("--latency", type=float, default=0,
+                            help="real seconds added to every request")
+    run_parser.add_argument("--bandwidth", type=float, default=0,
+                            help="bytes/second per connection, 0 for unlimited")
+    run_parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                            help="override a config value, e.g. --set pausedResumeMinutes=1")
+    run_parser.add_argument("--log-levels", default="ERROR",
+                            help="comma separated logLevels to run with (default: ERROR)")
+    run_parser.add_argument("--out", help="save the results as JSON")
+
+    export_parser = subparsers.add_parser(
+        "export", help="print a schedule from the recorded arrival history")
+    export_parser.add_argument("--days", type=int, default=7,
+                               help="how much history to use (default: 7)")
+
+    args = parser.parse_args()
+    sys.exit(run(args) if args.command == "run" else export(args))
@@ -0,0 +1,280 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import formatdate
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+'''
+    A local stand-in for NOMADS/the NCEP FTP site. Files are served out of
+    a fixtures directory laid out as <host>/<upstream path>, so
+    https://nomads.ncep.noaa.gov/pub/data/... is served from
+    fixtures/nomads.ncep.noaa.gov/pub/data/...
+
+    It answers HEAD and GET, single and multi-range requests, with ETag and
+    Last-Modified headers. Each request can be delayed by `latency` seconds
+    and bodies are trickled out at `bandwidth` bytes/second per connection.
+
+    With any_run, a request for a run that wasn't recorded is answered with
+    the recorded run of the same model (fixtures/manifest.json says which),
+    so the scheduler finds "new" data whatever the date is. With any_fh as
+    well, forecast hours that weren't recorded get the first one that was.
+'''
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.bytes = 0
+
+    def add(self, method, status, nbytes=0):
+        with self.lock:
+            key = method + " " + str(status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.bytes += nbytes
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": dict(self.requests), "bytes": self.bytes}
+
+
+def load_manifest(root):
+    try:
+        with open(root + "/manifest.json") as f:
+            return json.load(f)
+    except OSError:
+        return {}
+
+
+def make_run_patterns(manifest):
+    # (model, regex for any run of the model's file, the recorded file's
+    # path, the first recorded fh)
+    patterns = []
+    for model_name, recorded in manifest.items():
+        pattern = "^/" + re.escape(recorded["path"])
+        pattern = pattern.replace(re.escape("%D"), "(?P<date>[0-9]{8})")
+        pattern = pattern.replace(re.escape("%H"), "(?P<hour>[0-9]{2})", 1)
+        pattern = pattern.replace(re.escape("%H"), "(?P=hour)")
+        pattern = pattern.replace(re.escape("%T"), "(?P<fh>[0-9]+)")
+        recorded_path = "/" + recorded["path"].replace(
+            "%D", recorded["run"][0:8]).replace("%H", recorded["run"][8:10])
+        patterns.append((model_name, re.compile(pattern + "(?P<idx>\\.idx)?$"),
+                         recorded_path, recorded["fhs"][0] if recorded["fhs"] else None))
+    return patterns
+
+
+def parse_ranges(header, size):
+    if not header.startswith("bytes="):
+        return None
+
+    ranges = []
+    for part in header[len("bytes="):].split(","):
+        start, _, end = part.strip().partition("-")
+        if start == "":
+            # Suffix range, the last n bytes
+            start = max(size - int(end), 0)
+            end = size - 1
+        else:
+            start = int(start)
+            end = size - 1 if end == "" else min(int(end), size - 1)
+        if start > end or start >= size:
+            continue
+        ranges.append((start, end))
+
+    return ranges
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def resolve(self):
+        path = self.path.split("?", 1)[0]
+        filename = self.server.root + path
+        if os.path.isfile(filename):
+            return path, filename
+
+        if self.server.any_run:
+            for model_name, pattern, recorded_path, first_fh in self.server.run_patterns:
+                match = pattern.match(path)
+                if match is None:
+                    continue
+                groups = match.groupdict()
+                fhs = [groups.get("fh") or ""]
+                if self.server.any_fh and first_fh is not None:
+                    fhs.append(first_fh)
+                for fh in fhs:
+                    recorded = recorded_path.replace("%T", fh) + \
+                        (groups.get("idx") or "")
+                    if os.path.isfile(self.server.root + recorded):
+                        return recorded, self.server.root + recorded
+
+        return path, None
+
+    def send_error_status(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        self.server.stats.add(self.command, status)
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+        path, filename = self.resolve()
+        if filename is None or not self.server.is_available(self.path):
+            self.send_error_status(404)
+            return
+
+        stat = os.stat(filename)
+        size = stat.st_size
+        etag = '"' + hashlib.md5((path + str(stat.st_mtime) + str(size)).encode("utf-8")).hexdigest() + '"'
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self.server.stats.add(self.command, 304)
+            return
+
+        ranges = None
+        if self.headers.get("Range"):
+            ranges = parse_ranges(self.headers["Range"], size)
+            if ranges is not None and len(ranges) == 0:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */" + str(size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                self.server.stats.add(self.command, 416)
+                return
+
+        if ranges is None:
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+            parts = [(0, size - 1, None)]
+            status = 200
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.send_header("Content-Length", str(end - start + 1))
+            parts = [(start, end, None)]
+            status = 206
+        else:
+            boundary = hashlib.md5(path.encode("utf-8")).hexdigest()
+            parts = []
+            length = 0
+            for start, end in ranges:
+                header = (f"\r\n--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+                          f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode("utf-8")
+                parts.append((start, end, header))
+                length += len(header) + end - start + 1
+            closing = f"\r\n--{boundary}--\r\n".encode("utf-8")
+            length += len(closing)
+            self.send_response(206)
+            self.send_header("Content-Type",
+                             "multipart/byteranges; boundary=" + boundary)
+            self.send_header("Content-Length", str(length))
+            status = 206
+
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+
+        sent = 0
+        if send_body:
+            with open(filename, "rb") as f:
+                for start, end, header in parts:
+                    if header is not None:
+                        self.wfile.write(header)
+                    f.seek(start)
+                    sent += self.send_bytes(f, end - start + 1)
+                if len(parts) > 1:
+                    self.wfile.write(closing)
+
+        self.server.stats.add(self.command, status, sent)
+
+    def send_bytes(self, f, remaining):
+        sent = 0
+        started = time.time()
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            remaining -= len(chunk)
+
+            # Sleep off whatever we're ahead of the bandwidth limit
+            if self.server.bandwidth > 0:
+                ahead = sent / self.server.bandwidth - (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        return sent
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, port=0, latency=0, bandwidth=0, any_run=False,
+                 any_fh=False, handler=StandinHandler):
+        super().__init__(("127.0.0.1", port), handler)
+        self.root = os.path.realpath(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.any_run = any_run
+        self.any_fh = any_fh
+        self.run_patterns = make_run_patterns(load_manifest(self.root))
+        self.stats = Stats()
+
+    def is_available(self, path):
+        # Subclasses can hold files back, e.g. until their scheduled time
+        return True
+
+    def get_url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+
+def start(root, port=0, latency=0, bandwidth=0, any_run=False, any_fh=False,
+          server_class=StandinServer):
+    server = server_class(root, port, latency, bandwidth, any_run, any_fh)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve recorded GRIB2 fixtures like NOMADS does.")
+    parser.add_argument("fixtures", help="fixtures directory")
+    parser.add_argument("--port", type=int, default=8086)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds to wait before answering each request")
+    parser.add_argument("--bandwidth", type=float, default=0,
+                        help="bytes/second per connection, 0 for unlimited")
+    parser.add_argument("--any-run", action="store_true",
+                        help="answer requests for any run with the recorded one")
+    parser.add_argument("--any-fh", action="store_true",
+                        help="with --any-run, answer requests for unrecorded fhs with the first recorded one")
+    args = parser.parse_args()
+
+    server = StandinServer(args.fixtures, args.port, args.latency,
+                           args.bandwidth, args.any_run, args.any_fh)
+    print("Serving " + server.root + " on " + server.get_url())
+    server.serve_forever()
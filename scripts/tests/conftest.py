@@ -0,0 +1,8 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# The logger and the connection manager import each other; loading the
+# connection manager first is what wxdata.py does too
+import wxdata_lib.pg_connection_manager  # noqa: E402,F401
@@ -0,0 +1,82 @@
+import pytest
+
+from wxdata_lib import concurrency
+from wxdata_lib.config import config
+
+MB = 1024 * 1024
+
+
+@pytest.fixture(autouse=True)
+def host(monkeypatch):
+    monkeypatch.setitem(config, "concurrencyMax", 8)
+    monkeypatch.setitem(config, "concurrencyMin", 1)
+    monkeypatch.setitem(config, "concurrencyBackoffSeconds", 0.5)
+    monkeypatch.setitem(config, "concurrencyLatencyFactor", 3)
+    monkeypatch.setattr(concurrency, "limits", {})
+    now = [1000.0]
+    monkeypatch.setattr(concurrency.time, "time", lambda: now[0])
+    return now
+
+
+def step(*requests):
+    # (seconds, status, bytes) per request
+    concurrency.start_step({})
+    for seconds, status, nbytes in requests:
+        concurrency.observe("https://upstream.test/file", seconds, status, nbytes=nbytes)
+    concurrency.adjust("upstream.test", concurrency.observations["upstream.test"])
+    return concurrency.get_limit("upstream.test")
+
+
+def test_starts_at_max():
+    assert concurrency.get_limit("upstream.test").limit == 8
+
+
+def test_throttled_halves_then_cools_down(host):
+    assert step((0.1, 429, 0)).limit == 4
+    assert step((0.1, 503, 0)).limit == 4
+    host[0] += concurrency.DECREASE_COOLDOWN_SECONDS
+    limit = step((0.1, 503, 0))
+    assert limit.limit == 2
+    assert limit.backoff == 2.0
+
+
+def test_errors_halve(host):
+    assert step((5.0, None, 0)).limit == 4
+    host[0] += concurrency.DECREASE_COOLDOWN_SECONDS
+    assert step((0.1, 500, 0)).limit == 2
+
+
+def test_never_below_min(host):
+    for i in range(10):
+        host[0] += concurrency.DECREASE_COOLDOWN_SECONDS
+        step((0.1, 429, 0))
+    assert concurrency.get_limit("upstream.test").limit == 1
+
+
+def test_additive_increase(host):
+    step((0.1, 429, 0))
+    limit = step((0.1, 200, 1000))
+    assert limit.limit == pytest.approx(4.25)
+    assert limit.backoff == pytest.approx(0.9)
+    for i in range(40):
+        step((0.1, 200, 1000))
+    assert limit.limit == 8
+    assert limit.backoff == 0.5
+
+
+def test_big_downloads_arent_slow_next_to_small_requests(host):
+    # HEAD and .idx hits set their own baselines
+    step((0.02, 200, 0), (0.03, 200, 20000))
+    limit = step((0.02, 200, 0), (0.03, 200, 20000), (4.0, 206, 20 * MB))
+    assert limit.limit == 8
+    assert limit.baselines["large"] == pytest.approx(0.2)
+
+
+def test_slow_large_downloads_halve(host):
+    step((2.0, 206, 10 * MB))
+    assert step((2.0, 206, 2 * MB)).limit == 4
+
+
+def test_slow_small_requests_halve(host):
+    step((0.05, 200, 0))
+    assert step((0.2, 200, 0)).limit == 4
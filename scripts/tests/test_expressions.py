@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from wxdata_lib.expressions import ExpressionError, FUNCTIONS, PREV_PREFIX, parse
+
+
+def evaluate(expression, **values):
+    scope = {name: getattr(np, name) for name in FUNCTIONS}
+    scope.update(values)
+    return eval(expression.code, {"__builtins__": {}}, scope)
+
+
+def test_inputs_and_functions():
+    expression = parse("hypot(ugrd_10m, vgrd_10m) * 1.94384")
+    assert expression.inputs == ("ugrd_10m", "vgrd_10m")
+    assert expression.prev_inputs == ()
+    assert evaluate(expression, ugrd_10m=np.array([3.0]), vgrd_10m=np.array([4.0])) == \
+        pytest.approx(5.0 * 1.94384)
+
+
+def test_comparisons_and_where():
+    expression = parse("where(tmp_2m < 273.15, 1, 0)")
+    assert list(evaluate(expression, tmp_2m=np.array([270.0, 280.0]))) == [1, 0]
+
+
+def test_prev_is_rewritten():
+    expression = parse("apcp - prev(apcp)")
+    assert expression.inputs == ("apcp",)
+    assert expression.prev_inputs == ("apcp",)
+    assert PREV_PREFIX + "apcp" in expression.code.co_names
+    assert "prev" not in expression.code.co_names
+    assert evaluate(expression, apcp=np.array([5.0]), **{PREV_PREFIX + "apcp": np.array([2.0])}) == 3.0
+
+
+def test_prev_only_input():
+    expression = parse("prev(tmp_2m)")
+    assert expression.inputs == ()
+    assert expression.prev_inputs == ("tmp_2m",)
+
+
+@pytest.mark.parametrize("text", [
+    "tmp_2m.__class__",
+    "np.sqrt(tmp_2m)",
+    "tmp_2m[0]",
+    "(lambda: 1)()",
+    "'a' + tmp_2m",
+    "b'a'",
+    "None",
+    "sqrt(tmp_2m, out=tmp_2m)",
+    "sqrt(**tmp_2m)",
+    "open(tmp_2m)",
+    "__import__('os')",
+    "eval(tmp_2m)",
+    "[tmp_2m]",
+    "tmp_2m if tmp_2m else 0",
+    "tmp_2m and ugrd_10m",
+    "prev(tmp_2m, ugrd_10m)",
+    "prev(tmp_2m * 2)",
+    "prev(x=tmp_2m)",
+    "(tmp_2m := 1)",
+    "tmp_2m +",
+])
+def test_rejected(text):
+    with pytest.raises(ExpressionError):
+        parse(text)
+
+
+def get_derived_problems(*derived):
+    from wxdata_lib.config import validate_derived
+
+    model = {
+        "bands": [{"var": "TMP", "level": "2_m_above_ground"},
+                  {"var": "UGRD", "level": "10_m_above_ground"}],
+        "derived": [{"name": name, "expression": text} for name, text in derived]
+    }
+    problems = []
+    validate_derived(model, "test: ", problems)
+    return problems
+
+
+def test_known_names():
+    assert get_derived_problems(
+        ("tmp_c", "tmp_2_m_above_ground - 273.15"),
+        ("tmp_c_change", "tmp_c - prev(tmp_c)")) == []
+
+
+@pytest.mark.parametrize("text", [
+    "dpt_2_m_above_ground",
+    "tmp_2_m_above_ground - prev(dpt_2_m_above_ground)",
+    "later - 1",
+    "sqrt(2)",
+])
+def test_unknown_names(text):
+    assert len(get_derived_problems(("derived", text), ("later", "tmp_2_m_above_ground"))) == 1
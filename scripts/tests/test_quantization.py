@@ -0,0 +1,42 @@
+import numpy as np
+
+from wxdata_lib.quantization import quantize
+
+
+def run(values, dtype, scale, offset, nodata, src_nodata=None):
+    values = np.array(values, dtype=np.float32)
+    out = np.empty(values.shape, dtype=dtype)
+    return quantize(values, out, scale, offset, nodata, src_nodata)
+
+
+def test_round_trip():
+    values = [-40.0, -0.04, 0.0, 0.06, 12.34, 55.55]
+    stored = run(values, np.int16, 0.1, 0.0, -32768)
+    assert stored.dtype == np.int16
+    assert list(stored) == [-400, 0, 0, 1, 123, 556]
+    assert np.allclose(stored * 0.1, values, atol=0.05)
+
+
+def test_offset():
+    stored = run([250.0, 273.15, 320.0], np.uint8, 0.5, 250.0, 255)
+    assert list(stored) == [0, 46, 140]
+
+
+def test_invalid_values_become_nodata():
+    stored = run([np.nan, np.inf, -np.inf, 9999.0, 1.0], np.int16, 1.0, 0.0, -32768, src_nodata=9999.0)
+    assert list(stored) == [-32768, -32768, -32768, -32768, 1]
+
+
+def test_clipped_clear_of_nodata():
+    # Out of range values saturate, without landing on nodata
+    stored = run([-1e9, 1e9], np.int16, 1.0, 0.0, -32768)
+    assert list(stored) == [-32767, 32767]
+    stored = run([-1e9, 1e9], np.uint8, 1.0, 0.0, 255)
+    assert list(stored) == [0, 254]
+
+
+def test_2d_windows():
+    values = np.arange(6, dtype=np.float32).reshape(2, 3)
+    out = np.empty((2, 3), dtype=np.int16)
+    assert quantize(values.copy(), out, 0.5, 0.0, -32768) is out
+    assert out.tolist() == [[0, 2, 4], [6, 8, 10]]
@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+import pytest
+
+from wxdata_lib import schedules
+
+
+def test_fh_steps_latest_start_first():
+    model = {"fhStep": {"0": 1, "120": 3, "240.0": 12}}
+    assert schedules.get_fh_steps(model, "00") == [(240, 12), (120, 3), (0, 1)]
+
+
+def test_fh_steps_manual_by_cycle_hour():
+    model = {"fhStepManual": [
+        {"appliesTo": ["00", "12"], "fhStep": {"0": 1, "36": 3}},
+        {"appliesTo": ["06", "18"], "fhStep": {"0": 1}}
+    ]}
+    assert schedules.get_fh_steps(model, "12") == [(36, 3), (0, 1)]
+    assert schedules.get_fh_steps(model, "06") == [(0, 1)]
+    assert schedules.get_fh_steps(model, "03") == []
+
+
+def test_next_fh():
+    fh_steps = [(120, 3), (6, 1)]
+    assert schedules.get_next_fh(fh_steps, 6) == 7
+    assert schedules.get_next_fh(fh_steps, 119) == 120
+    assert schedules.get_next_fh(fh_steps, 120) == 123
+    assert schedules.get_next_fh(fh_steps, 0) is None
+
+
+def test_compile_schedule(monkeypatch):
+    raw = {"startTime": 0, "endTime": 126, "fhStep": {"0": 6, "120": 3}}
+    monkeypatch.setattr(schedules, "get_model", lambda model_name: SimpleNamespace(raw=raw))
+
+    schedule = schedules.compile_schedule("test", "00")
+    assert schedule.fhs == tuple(range(0, 120, 6)) + (120, 123, 126)
+    assert schedule.full_fhs[:2] == ("000", "006")
+    assert schedule.full_fhs[-1] == "126"
+    assert schedule.band_numbers["000"] == 1
+    assert schedule.band_numbers["126"] == schedule.band_count == len(schedule.fhs)
+
+    with pytest.raises(AttributeError):
+        schedule.fhs = ()
+    with pytest.raises(TypeError):
+        schedule.band_numbers["000"] = 2
+
+
+def test_compile_schedule_without_a_step(monkeypatch):
+    raw = {"startTime": 0, "endTime": 48,
+           "fhStepManual": [{"appliesTo": ["00"], "fhStep": {"0": 24}}]}
+    monkeypatch.setattr(schedules, "get_model", lambda model_name: SimpleNamespace(raw=raw))
+
+    assert schedules.compile_schedule("test", "00").full_fhs == ("00", "24", "48")
+    # No step for this cycle hour, just the start
+    assert schedules.compile_schedule("test", "06").full_fhs == ("00",)
+
+
+def test_cycle_hours():
+    assert schedules.get_cycle_hours({"updateOffset": 0, "updateFrequency": 6}) == \
+        ["00", "06", "12", "18"]
+    assert schedules.get_cycle_hours({"updateOffset": 3, "updateFrequency": 12}) == ["03", "15"]
@@ -1,30 +1,52 @@
 import wxdata_lib.pg_connection_manager as pg
-from wxdata_lib.config import config, levelMaps, models
+from wxdata_lib.config import config, levelMaps, models, get_model
+import wxdata_lib.config as config_file
 import wxdata_lib.http_manager as http_manager
-from wxdata_lib.logger import log, say_hello, print_line
+from wxdata_lib.logger import log, say_hello, print_line, flush_remote_logs
 import wxdata_lib.model_tools as model_tools
 import wxdata_lib.processing as processing
 import wxdata_lib.file_tools as file_tools
+import wxdata_lib.progress as progress
+import wxdata_lib.arrivals as arrivals
+import wxdata_lib.concurrency as concurrency
+import wxdata_lib.metrics as metrics
+import wxdata_lib.slo as slo
+import wxdata_lib.points as points
+import wxdata_lib.publish as publish
+import wxdata_lib.clock as clock
 
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import os
+import sys
 import multiprocessing
+import queue
 import time
 import random
 import pytz
-import copy
 from osgeo import gdal
 import pprint
+import signal
+import argparse
+import json
 
 agent_logged = False
-first_run = True
 processing_pool = {}
 pp = pprint.PrettyPrinter(indent=4)
 utc = pytz.UTC
 
 gdal.UseExceptions()
-tasks_last_updated = datetime.now()
-processing_pool_updating = False
+tasks_last_updated = clock.now()
+daemon_mode = False
+shutdown_requested = False
+
+# Models being discovered in the background -> their futures
+pending_discovery = {}
+discovery_executor = None
+
+# Results from the worker pool, and how many tasks are still out
+results = queue.Queue()
+dispatched = 0
 
 
 def kill_me(exit_code):
@@ -39,11 +61,16 @@ def kill_me(exit_code):
                 pg.remove_agent()
             except:
                 os._exit(exit_code)
+
+    progress.flush()
+    metrics.flush()
+    flush_remote_logs()
+    pg.ConnectionPool.close_all()
     os._exit(exit_code)
 
 
-def init():
-    global agent_logged, processing_pool
+def start_agent():
+    global agent_logged
 
     say_hello()
     if not pg.connect():
@@ -59,306 +86,686 @@ def init():
     if not agent_logged:
         kill_me(1)
 
-    max_threads = config["maxThreads"]
 
-    update_processing_pool()
+def init():
+    start_agent()
+
+    with multiprocessing.Pool(processes=config["maxThreads"], initializer=init_worker) as pool:
+        # Started once the workers have forked, they don't need it
+        metrics.serve()
+        start_discovery()
+
+        while True:
+            if (clock.now() - tasks_last_updated).total_seconds() > (config["pausedResumeMinutes"] * 60) and len(pending_discovery) == 0:
+                log("Need to update the processing pool", "DEBUG")
+                start_discovery()
+
+            apply_discoveries()
+            dispatch_open_tasks(pool)
 
-    while len(get_open_tasks()) > 0:
-        with multiprocessing.Pool(processes=max_threads) as pool:
-            tasks = get_open_tasks()
-            if len(tasks) == 0:
+            if dispatched == 0 and len(pending_discovery) == 0:
                 break
-            log("Open tasks: " + str(len(tasks)), "DEBUG", remote=True)
-
-            for result in pool.imap_unordered(process, tasks, chunksize=1):
-                code = result["code"]
-                model_name = result["model_name"]
-                step_name = result["step_name"]
-                fh = result["fh"]
-                timestamp = result["timestamp"]
-
-                if code == "OK":
-                    model_tools.update_last_fh(model_name, fh)
-                    if model_name in processing_pool:
-                        del processing_pool[model_name]["steps"][step_name]
-                        if not bool(processing_pool[model_name]["steps"]) or ("flatTimeFullFile" in models[model_name] and models[model_name]["flatTimeFullFile"] == True):
-                            del processing_pool[model_name]
-                            model_tools.finish_model(model_name, timestamp)
-
-                elif code == "PAUSE":
-                    model_tools.set_as_paused(model_name, fh)
-                    if model_name in processing_pool:
-                        del processing_pool[model_name]
-
-                elif code == "FAIL":
-                    if model_name in processing_pool:
-                        time.sleep(5)
-                        step = processing_pool[model_name]["steps"][step_name]
-                        step["retries"] += 1
-                        if step["retries"] > config["maxRetriesPerStep"]:
-                            log("Step " + model_name + ": " + step_name +
-                                " failed permanently.", "ERROR", remote=True)
-                            del processing_pool[model_name]["steps"][step_name]
-                            if not bool(processing_pool[model_name]["steps"]):
-                                del processing_pool[model_name]
-                                model_tools.finish_model(model_name, timestamp)
 
-                else:
-                    if model_name in processing_pool:
-                        del processing_pool[model_name]
+            wait_for_result()
 
+    concurrency.log_limits()
     log("No more processing to do. Goodbye.", "NOTICE")
     time.sleep(1)
     kill_me(0)
 
 
-def process(step):
+'''
+    Daemon mode stays resident instead of being started by cron. The worker
+    pool, caches and database connections stay warm between runs, and each
+    model is only checked for new data when it's due:
+     * a WAITING model one updateFrequency after its last run, then every
+       pausedResumeMinutes until the next run shows up
+     * a PAUSED model pausedResumeMinutes after it was paused
+    SIGTERM/SIGINT stop dispatching, flush state and exit cleanly.
+    Unfinished steps are picked back up from band_progress on restart.
+'''
+
+
+def daemon():
+    global daemon_mode
+
+    daemon_mode = True
+    start_agent()
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    next_discovery = {}
+
+    with multiprocessing.Pool(processes=config["maxThreads"], initializer=init_worker) as pool:
+        metrics.serve()
+        while not shutdown_requested:
+            # Runs already in the pool carry their own steps, so a reload
+            # only affects what gets discovered from here on
+            if model_tools.reload_config():
+                next_discovery = {model_name: next_discovery[model_name]
+                                  for model_name in next_discovery
+                                  if model_name in models and models[model_name]["enabled"]}
+            config_file.release_retired(
+                set(processing_pool) | set(pending_discovery))
+
+            now = clock.now()
+            due = [model_name for model_name, model in models.items()
+                   if model["enabled"] and model_name not in processing_pool and
+                   model_name not in pending_discovery and
+                   next_discovery.get(model_name, now) <= now]
+
+            if len(due) > 0:
+                start_discovery(due)
+
+            for model_name in apply_discoveries():
+                if model_name not in processing_pool:
+                    next_discovery[model_name] = get_next_discovery_time(
+                        model_name)
+
+            dispatch_open_tasks(pool)
+
+            result = wait_for_result()
+            if result is not None and result["model_name"] not in processing_pool:
+                next_discovery[result["model_name"]] = get_next_discovery_time(
+                    result["model_name"])
+
+        if dispatched > 0:
+            log("Stopping dispatch, in-flight steps will resume on restart.", "NOTICE")
+        concurrency.log_limits()
+
+    log("Daemon stopped. Goodbye.", "NOTICE", remote=True)
+    kill_me(0)
+
+
+def request_shutdown(signum, frame):
+    global shutdown_requested
+    log("Received signal " + str(signum) + ", shutting down.", "NOTICE")
+    shutdown_requested = True
+
+
+def init_worker():
+    # Let the parent decide when workers go away.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def get_next_discovery_time(model_name):
+    now = clock.now()
+    poll = timedelta(minutes=config["pausedResumeMinutes"])
+    state = model_tools.get_model_state(model_name)
+
+    if state is None:
+        return now + poll
+
+    if state["status"] == "PAUSED" and state["resume_at"] is not None:
+        return max(state["resume_at"], now)
+
+    if state["status"] == "PAUSED" and state["paused_at"] is not None:
+        return max(state["paused_at"].replace(tzinfo=utc) + poll, now)
+
+    if state["status"] == "WAITING" and state["timestamp"] is not None:
+        model = models[model_name]
+        next_run = state["timestamp"].replace(tzinfo=utc) + \
+            timedelta(hours=model["updateFrequency"])
+
+        # Don't bother looking before the first fh usually shows up
+        first_fh = model_tools.get_full_fh(model_name, model["startTime"])
+        lag = arrivals.get_expected_lag(model_name, next_run, first_fh)
+        if lag is not None:
+            return max(next_run + lag, now + poll)
+
+        return max(next_run, now + poll)
+
+    return now + poll
+
+
+'''
+    Tasks are handed to the worker pool one at a time as soon as they're
+    open, rather than in batches, so a model that finishes discovery can
+    start while others are still being checked or processed.
+'''
+
+
+def dispatch_open_tasks(pool):
+    global dispatched
+
+    tasks = get_open_tasks()
+    if len(tasks) == 0:
+        return
+
+    log("Dispatching tasks: " + str(len(tasks)), "DEBUG")
+    for task in tasks:
+        dispatched += 1
+        pool.apply_async(process, (task,), callback=results.put,
+                         error_callback=lambda e, task=task: results.put(make_error_result(task, e)))
+
+
+def wait_for_result(timeout=1):
+    global dispatched
+
+    try:
+        result = results.get(timeout=timeout)
+    except queue.Empty:
+        return None
+
+    dispatched -= 1
+    handle_result(result)
+    return result
+
+
+def make_error_result(task, e):
+    log("Worker crashed | " + task["model_name"] + " | " + task["step_name"] + " -- " + repr(e),
+        "ERROR", remote=True, model=task["model_name"])
+    now = clock.now()
+    return {
+        "code": "FAIL",
+        "fh": task["step"].fh,
+        "band": progress.get_step_band(task["step"]),
+        "model_name": task["model_name"],
+        "step_name": task["step_name"],
+        "timestamp": task["timestamp"],
+        "bytes": 0,
+        "seen_at": None,
+        "upstream_at": None,
+        "started_at": now,
+        "finished_at": now,
+        "host": task["host"],
+        "upstream": {},
+        "spans": []
+    }
+
+
+def handle_result(result):
     global processing_pool
+
+    code = result["code"]
+    model_name = result["model_name"]
+    step_name = result["step_name"]
+    fh = result["fh"]
+    timestamp = result["timestamp"]
+
+    concurrency.release(result["host"], result["upstream"])
+    metrics.record_spans(result)
+
+    if code == "OK":
+        progress.record_step(model_name, timestamp, fh, result["band"], "DONE",
+                             bytes=result["bytes"], started_at=result["started_at"],
+                             finished_at=result["finished_at"])
+        arrivals.record_arrival(model_name, timestamp, fh,
+                                result["seen_at"] or result["started_at"],
+                                result["upstream_at"])
+        slo.observe(result)
+        model_tools.update_last_fh(model_name, fh)
+        if model_name in processing_pool:
+            remove_step(model_name, step_name)
+            if processing_pool[model_name]["remaining"][fh] == 0:
+                publish_fh(model_name, timestamp, fh)
+            # Runs keep going even if their model was removed by a config reload
+            flat_time_full_file = get_model(
+                model_name).flat_time_full_file
+            if not bool(processing_pool[model_name]["steps"]) or flat_time_full_file:
+                del processing_pool[model_name]
+                model_tools.finish_model(model_name, timestamp)
+
+    elif code == "PAUSE":
+        model_tools.set_as_paused(model_name, fh, timestamp)
+        if model_name in processing_pool:
+            del processing_pool[model_name]
+
+    elif code == "FAIL":
+        if model_name in processing_pool:
+            clock.sleep(5)
+            step = processing_pool[model_name]["steps"][step_name]
+            processing_pool[model_name]["in_flight"].discard(step_name)
+            step.retries += 1
+            if step.retries > config["maxRetriesPerStep"]:
+                log("Step " + model_name + ": " + step_name +
+                    " failed permanently.", "ERROR", remote=True)
+                progress.record_step(model_name, timestamp, fh, result["band"], "FAILED",
+                                     retries=step.retries, bytes=result["bytes"],
+                                     started_at=result["started_at"],
+                                     finished_at=result["finished_at"])
+                remove_step(model_name, step_name)
+                processing_pool[model_name]["failed_fhs"].add(fh)
+                fail_dependants(model_name, timestamp, step_name)
+                if processing_pool[model_name]["remaining"][fh] == 0:
+                    publish_fh(model_name, timestamp, fh)
+                if not bool(processing_pool[model_name]["steps"]):
+                    del processing_pool[model_name]
+                    model_tools.finish_model(model_name, timestamp)
+
+    else:
+        if model_name in processing_pool:
+            del processing_pool[model_name]
+
+
+def fail_dependants(model_name, timestamp, step_name):
+    # Dependants can be in the next fh too, through prev()
+    model = processing_pool[model_name]
+    for dependant, step in list(model["steps"].items()):
+        if step_name not in step.inputs or dependant in model["in_flight"] or \
+                dependant not in model["steps"]:
+            continue
+
+        log("Step " + model_name + ": " + dependant + " can't be derived without " + step_name + ".",
+            "ERROR", remote=True)
+        progress.record_step(model_name, timestamp, step.fh, progress.get_step_band(step), "FAILED",
+                             retries=step.retries)
+        remove_step(model_name, dependant)
+        model["failed_fhs"].add(step.fh)
+        if model["remaining"][step.fh] == 0:
+            publish_fh(model_name, timestamp, step.fh)
+        fail_dependants(model_name, timestamp, dependant)
+
+
+def publish_fh(model_name, timestamp, fh):
+    # The fh has no steps left; it's published even if some of them failed
+    complete = fh not in processing_pool[model_name]["failed_fhs"]
+    if not publish.publish_fh(model_name, timestamp, fh, complete) or not complete:
+        # An fh with a missing band doesn't count as published
+        slo.discard(model_name, timestamp, fh)
+    slo.record_published(model_name, timestamp, fh)
+
+
+def process(step):
     model_name = step["model_name"]
     timestamp = step["timestamp"]
     step_name = step["step_name"]
-    pool_step = processing_pool[model_name]["steps"][step_name]
-    if model_tools.get_model_status(model_name) == "PAUSED":
+    # Steps travel with the task, workers can outlive the pool they forked from
+    pool_step = step["step"]
+    if daemon_mode:
+        model_tools.reload_config()
+    started_at = clock.now()
+    processing.reset_step_stats()
+    concurrency.start_step(step["backoffs"])
+    metrics.start_step(model_name, timestamp, pool_step.fh,
+                       progress.get_step_band(pool_step))
+    if model_tools.is_model_paused(model_name):
         log("Skipping paused model | " + model_name + " | " + step_name, "NOTICE")
-        return {
-            "code": "REMOVED",
-            "fh": pool_step['fh'],
-            "model_name": model_name,
-            "step_name": step_name,
-            "timestamp": timestamp
-        }
-
-    log("Starting processing | " + model_name + " | " + step_name, "INFO")
-    res = processing.process(pool_step, model_name, timestamp)
+        res = "REMOVED"
+    else:
+        log("Starting processing | " + model_name + " | " + step_name, "INFO")
+        res = processing.process(pool_step, model_name, timestamp)
+
+    # Ship this step's remote log lines before handing the result back,
+    # the worker may be torn down as soon as the pool runs dry.
+    flush_remote_logs()
+
     return {
         "code": res,
-        "fh": pool_step['fh'],
+        "fh": pool_step.fh,
+        "band": progress.get_step_band(pool_step),
         "model_name": model_name,
         "step_name": step_name,
-        "timestamp": timestamp
+        "timestamp": timestamp,
+        "bytes": processing.step_stats["bytes"],
+        "seen_at": processing.step_stats["seen_at"],
+        "upstream_at": processing.step_stats["upstream_at"],
+        "started_at": started_at,
+        "finished_at": clock.now(),
+        "host": step["host"],
+        "upstream": dict(concurrency.observations),
+        "spans": list(metrics.spans)
     }
 
 
 def get_open_tasks():
-    if (datetime.now() - tasks_last_updated).total_seconds() > (config["pausedResumeMinutes"] * 60) and processing_pool_updating == False:
-        log("Need to update the processing pool", "DEBUG")
-        update_processing_pool()
-
     open_tasks = []
-    new_processing_pool = copy.deepcopy(processing_pool)
-
-    # Temporary(?) workaround - surpress nbm execution til
-    # other models are done. Otherwise it makes everything wait
-    # for its slow-ass steps to process.
-    # Ideally, we should use something other than
-    # pool.imap to feed steps into the multiprocessor
-    model_choices = list(new_processing_pool.keys())
-    # if len(model_choices) > 1 and 'nbm' in model_choices:
-    #    del new_processing_pool['nbm']
-
-    while bool(new_processing_pool):
-        model_choices = list(new_processing_pool.keys())
-        model_name = random.choice(model_choices)
-        model = new_processing_pool[model_name]
+
+    model_choices = list(processing_pool.keys())
+    random.shuffle(model_choices)
+
+    for model_name in model_choices:
+        model = processing_pool[model_name]
         if "status" in model and model["status"] == "POPULATING":
-            del new_processing_pool[model_name]
             continue
 
-        timestamp = model["timestamp"]
-        for step_name in model["steps"]:
-            step = model["steps"][step_name]
+        # Only hand out steps for the model's earliest unfinished fh.
+        # This keeps issues from occuring if the same tif file is
+        # written to by two steps at the same time
+        fh = get_current_fh(model)
+        if fh is None:
+            continue
 
-        step_fh = -1
-        for step_name in list(model["steps"]):
+        for step_name in model["fh_steps"][fh]:
+            if step_name not in model["steps"] or step_name in model["in_flight"]:
+                continue
+
+            # Derived variables, contours and tiles wait for their inputs,
+            # and don't touch upstream
             step = model["steps"][step_name]
-            fh = step['fh']
-            if step_fh == -1 or step_fh == fh and step["processing"] == False:
-                open_tasks.append({
-                    'model_name': model_name,
-                    'timestamp': timestamp,
-                    'step': step,
-                    'step_name': step_name
-                })
-                step_fh = fh
-                del model["steps"][step_name]
-            # Delete any steps later than the one to process
-            # this keeps issues from occuring if the same
-            # tif file is written to by two steps at the same time
-            elif step_fh != -1 and step_fh != fh:
-                del model["steps"][step_name]
-
-        if len(model["steps"]) == 0:
-            del new_processing_pool[model_name]
+            if model_tools.is_local_step(step):
+                if any(name in model["steps"] for name in step.inputs):
+                    continue
+                host = ""
+            else:
+                # Leave the rest for later if upstream can't take more right now
+                host = concurrency.acquire(model_name)
+                if host is None:
+                    break
+
+            model["in_flight"].add(step_name)
+            open_tasks.append({
+                'model_name': model_name,
+                'timestamp': model["timestamp"],
+                'step': step,
+                'step_name': step_name,
+                'host': host,
+                'backoffs': concurrency.get_backoffs(model_name)
+            })
 
     return open_tasks
 
 
-def update_processing_pool():
-    global processing_pool, first_run, tasks_last_updated, processing_pool_updating
+'''
+    Each model in the processing pool keeps its steps grouped by fh, in
+    order, with a count of what's left in each group. The cursor points at
+    the earliest fh that still has steps, and in_flight holds the steps
+    that have been handed to workers but haven't reported back yet.
+    failed_fhs holds the fhs with a step that failed for good, which are
+    published as incomplete once they have nothing left.
+'''
+
+
+def init_ready_queue(model):
+    model["fhs"] = []
+    model["fh_steps"] = {}
+    model["remaining"] = {}
+    model["cursor"] = 0
+    model["in_flight"] = set()
+    model["failed_fhs"] = set()
+
+    for step_name, step in model["steps"].items():
+        if step.fh not in model["fh_steps"]:
+            model["fhs"].append(step.fh)
+            model["fh_steps"][step.fh] = []
+            model["remaining"][step.fh] = 0
+        model["fh_steps"][step.fh].append(step_name)
+        model["remaining"][step.fh] += 1
+
+
+def get_current_fh(model):
+    while model["cursor"] < len(model["fhs"]) and model["remaining"][model["fhs"][model["cursor"]]] == 0:
+        model["cursor"] += 1
+
+    if model["cursor"] >= len(model["fhs"]):
+        return None
+
+    return model["fhs"][model["cursor"]]
+
+
+def remove_step(model_name, step_name):
+    model = processing_pool[model_name]
+    step = model["steps"].pop(step_name, None)
+    model["in_flight"].discard(step_name)
+    if step is not None:
+        model["remaining"][step.fh] -= 1
+
+
+'''
+    Discovery (checking each model's status, probing upstream for new runs
+    and building the run's steps) runs concurrently across models in a
+    thread pool. Finished discoveries are picked up by apply_discoveries(),
+    which adds their runs to the processing pool and writes the new state
+    to the DB in bulk.
+'''
+
+
+def start_discovery(model_names=None):
+    global tasks_last_updated, discovery_executor
     log("Updating processing pool", "DEBUG")
-    processing_pool_updating = True
-    conn, curr = pg.ConnectionPool.connect()
+
+    if discovery_executor is None:
+        discovery_executor = ThreadPoolExecutor(
+            max_workers=config.get("discoveryThreads", 8))
+
+    # One query for the state of every model, the discoveries
+    # read from the snapshot.
+    model_tools.get_model_states(refresh=True)
+    progress.flush()
+
+    # Flag disabled models in the DB
+    model_tools.set_models_as_disabled(
+        [model_name for model_name, model in models.items() if not model["enabled"]])
+
     # Check only brand new models, or models that are waiting first
     for model_name, model in models.items():
-        # Flag this model as disabled in the DB
         if not model["enabled"]:
-            try:
-                curr.execute(
-                    "UPDATE wxdata.models SET status = %s WHERE model = %s", ("DISABLED", model_name))
-                conn.commit()
-            except Exception as e:
-                log(repr(e), "ERROR", remote=True)
             continue
 
-        if model_name in processing_pool:
+        if model_names is not None and model_name not in model_names:
+            continue
+
+        if model_name in processing_pool or model_name in pending_discovery:
             continue
 
-        status = model_tools.get_model_status(model_name)
-        if (status == "DISABLED"):
-            status = "WAITING"
+        pending_discovery[model_name] = discovery_executor.submit(
+            discover_model, model_name)
 
-        model_fh = model_tools.get_full_fh(model_name, model["startTime"])
-        log("Model: " + model_name, "INFO")
+    tasks_last_updated = clock.now()
 
-        lookback = 0
 
-        if status == None:
-            try:
-                while lookback < config["maxLookback"]:
-                    timestamp = model_tools.get_last_available_timestamp(
-                        model, prev=lookback)
-                    if model_tools.check_if_model_fh_available(model_name, timestamp, model_fh):
-                        model_tools.add_model_to_db(model_name, timestamp)
-                        init_new_run(processing_pool, model_name, timestamp)
-                        model_tools.mark_model_as_processing(
-                            model_name, timestamp)
-                        break
-
-                    lookback += 1
-            except Exception as e:
-                log(repr(e), "ERROR", remote=True)
+def apply_discoveries():
+    finished = [model_name for model_name, future in pending_discovery.items()
+                if future.done()]
 
-        elif status == "WAITING":
+    new_models = []
+    started_runs = []
+    for model_name in finished:
+        future = pending_discovery.pop(model_name)
+        try:
+            discovery = future.result()
+        except Exception as e:
+            log(repr(e), "ERROR", remote=True, model=model_name)
+            continue
 
-            log("Status: " + status, "INFO")
+        if discovery is None or model_name in processing_pool:
+            continue
 
-            prev_timestamp = model_tools.get_model_timestamp(
-                model_name).replace(tzinfo=utc)
+        if discovery["is_new"]:
+            new_models.append((model_name, discovery["timestamp"]))
+        started_runs.append((model_name, discovery["timestamp"]))
+        processing_pool[model_name] = discovery["run"]
 
-            if prev_timestamp == None:
-                log("Couldn't get previous timestamp, continuing.",
-                    "WARN", remote=True)
-                continue
+    if len(new_models) > 0:
+        model_tools.add_models_to_db(new_models)
 
-            log("Prev timestamp: " + str(prev_timestamp), "INFO")
-            while lookback < config["maxLookback"]:
-                try:
-                    timestamp = model_tools.get_last_available_timestamp(
-                        model, prev=lookback)
+    if len(started_runs) > 0:
+        model_tools.mark_models_as_processing(started_runs)
 
-                    if timestamp <= prev_timestamp:
-                        log("· No newer runs exist.", "INFO", indentLevel=1)
-                        break
+    if len(finished) > 0 and len(pending_discovery) == 0:
+        log("Done updating the model pool.", "DEBUG")
 
-                    if model_tools.check_if_model_fh_available(model_name, timestamp, model_fh):
-                        init_new_run(processing_pool, model_name, timestamp)
-                        model_tools.mark_model_as_processing(
-                            model_name, timestamp)
-                        break
+    return finished
 
-                    else:
-                        log("· Nope.", "INFO", indentLevel=1)
 
-                    lookback += 1
+def discover_model(model_name):
+    model = models[model_name]
+    status = model_tools.get_model_status(model_name)
+    if (status == "DISABLED"):
+        status = "WAITING"
 
-                except Exception as e:
-                    log(repr(e), "ERROR", remote=True)
+    model_fh = model_tools.get_full_fh(model_name, model["startTime"])
+    log("Model: " + model_name, "INFO")
 
-        elif status == "PAUSED":
+    lookback = 0
 
+    if status == None:
+        try:
+            while lookback < config["maxLookback"]:
+                timestamp = model_tools.get_last_available_timestamp(
+                    model, prev=lookback)
+                if model_tools.check_if_model_fh_available(model_name, timestamp, model_fh):
+                    arrivals.record_arrival(
+                        model_name, timestamp, model_fh, clock.now())
+                    return {
+                        "is_new": True,
+                        "timestamp": timestamp,
+                        "run": init_new_run(model_name, timestamp)
+                    }
+
+                lookback += 1
+        except Exception as e:
+            log(repr(e), "ERROR", remote=True)
+
+    elif status == "WAITING":
+
+        log("Status: " + status, "INFO")
+
+        prev_timestamp = model_tools.get_model_timestamp(model_name)
+
+        if prev_timestamp == None:
+            log("Couldn't get previous timestamp, continuing.",
+                "WARN", remote=True)
+            return None
+
+        prev_timestamp = prev_timestamp.replace(tzinfo=utc)
+        log("Prev timestamp: " + str(prev_timestamp), "INFO")
+        while lookback < config["maxLookback"]:
             try:
-                curr.execute(
-                    "SELECT paused_at FROM wxdata.models WHERE model LIKE '" + model_name + "'"
-                )
-                paused_at = curr.fetchone()[0]
-
-                log(model_name + " is PAUSED.", "INFO")
-
-                if abs(datetime.now().replace(tzinfo=utc) - paused_at.replace(tzinfo=utc)) >= timedelta(minutes=config["pausedResumeMinutes"]):
-                    log("Restarting paused model " + model_name, "NOTICE")
-                    timestamp = model_tools.get_model_timestamp(
-                        model_name).replace(tzinfo=utc)
-                    get_non_complete_processing_pool(
-                        processing_pool, model_name, curr
-                    )
-                    model_tools.mark_model_as_processing(model_name, timestamp)
+                timestamp = model_tools.get_last_available_timestamp(
+                    model, prev=lookback)
+
+                if timestamp <= prev_timestamp:
+                    log("· No newer runs exist.", "INFO", indentLevel=1)
+                    break
+
+                if model_tools.check_if_model_fh_available(model_name, timestamp, model_fh):
+                    arrivals.record_arrival(
+                        model_name, timestamp, model_fh, clock.now())
+                    return {
+                        "is_new": False,
+                        "timestamp": timestamp,
+                        "run": init_new_run(model_name, timestamp)
+                    }
+
                 else:
-                    log("Not resuming yet until the threshold of " +
-                        str(config["pausedResumeMinutes"]) + " minutes is met.", "INFO")
+                    log("· Nope.", "INFO", indentLevel=1)
 
-            except Exception as e:
-                log("Error in pause resumption -- " +
-                    repr(e), "ERROR", remote=True)
+                lookback += 1
 
-        # This shouldn't be necessary, but it will resume models that were in
-        # process if the script were to die
-        elif status == "PROCESSING" and model_name not in processing_pool:
-            log("Resurrecting dead model " + model_name, "NOTICE", remote=True)
-            try:
-                timestamp = model_tools.get_model_timestamp(
-                    model_name).replace(tzinfo=utc)
-                get_non_complete_processing_pool(
-                    processing_pool, model_name, curr
-                )
-                model_tools.mark_model_as_processing(model_name, timestamp)
             except Exception as e:
                 log(repr(e), "ERROR", remote=True)
 
-        elif status == "ERROR":
-            log("Couldn't retrieve the status for some reason.", "WARN")
+    elif status == "PAUSED":
 
-    pg.ConnectionPool.close(conn, curr)
-    tasks_last_updated = datetime.now()
-    processing_pool_updating = False
-    log("Done updating the model pool.", "DEBUG")
+        try:
+            state = model_tools.get_model_state(model_name)
+            paused_at = state["paused_at"]
+            resume_at = state["resume_at"]
 
+            log(model_name + " is PAUSED.", "INFO")
 
-def init_new_run(processing_pool, model_name, timestamp):
-    processing_pool[model_name] = {
-        'timestamp': timestamp,
-        'status': 'POPULATING',
-        'steps': {}
-    }
+            # resume_at comes from the fh's expected arrival time, older
+            # rows without one just wait pausedResumeMinutes
+            if resume_at is not None:
+                can_resume = clock.now() >= resume_at
+            else:
+                can_resume = abs(clock.now() - paused_at.replace(
+                    tzinfo=utc)) >= timedelta(minutes=config["pausedResumeMinutes"])
+
+            if can_resume:
+                log("Restarting paused model " + model_name, "NOTICE")
+                return get_non_complete_run(model_name)
+            else:
+                log("Not resuming yet, next probe at " +
+                    str(resume_at or paused_at.replace(tzinfo=utc) + timedelta(minutes=config["pausedResumeMinutes"])) + ".", "INFO")
+
+        except Exception as e:
+            log("Error in pause resumption -- " +
+                repr(e), "ERROR", remote=True)
+
+    # This shouldn't be necessary, but it will resume models that were in
+    # process if the script were to die
+    elif status == "PROCESSING":
+        log("Resurrecting dead model " + model_name, "NOTICE", remote=True)
+        try:
+            return get_non_complete_run(model_name)
+        except Exception as e:
+            log(repr(e), "ERROR", remote=True)
+
+    elif status == "ERROR":
+        log("Couldn't retrieve the status for some reason.", "WARN")
+
+    return None
+
+
+def init_new_run(model_name, timestamp):
     log(f"Initializing new run for {model_name} | {timestamp}.",
         "NOTICE", indentLevel=0, remote=True, model=model_name)
-    processing_pool[model_name]["steps"] = model_tools.make_band_dict(
-        model_name, timestamp.strftime("%H"))
-    processing_pool[model_name]["status"] = "READY"
+    run = {
+        'timestamp': timestamp,
+        'status': 'READY',
+        'steps': model_tools.make_band_dict(model_name, timestamp.strftime("%H"))
+    }
+    init_ready_queue(run)
+    return run
+
 
+def get_non_complete_run(model_name):
 
-def get_non_complete_processing_pool(processing_pool, model_name, curr):
+    state = model_tools.get_model_state(model_name)
+    last_fh = int(state["lastfh"] or 0)
+    timestamp = state["timestamp"].replace(tzinfo=utc)
+    completed_steps = progress.get_completed_steps(
+        model_name, timestamp, flush_pending=False)
 
-    last_fh = 0
-    curr.execute(
-        "SELECT lastfh, timestamp FROM wxdata.models WHERE model = %s", (model_name,))
-    result = curr.fetchone()
-    last_fh = int(result[0])
-    timestamp = result[1]
+    steps = model_tools.make_band_dict(model_name, timestamp.strftime("%H"))
 
-    processing_pool[model_name] = {
+    # Skip exactly the bands that were already written. Runs without any
+    # recorded progress fall back to the last completed fh.
+    for step_name in list(steps):
+        step = steps[step_name]
+        if completed_steps:
+            if (step.fh, progress.get_step_band(step)) in completed_steps:
+                del steps[step_name]
+        elif int(step.fh) < last_fh:
+            del steps[step_name]
+
+    run = {
         'timestamp': timestamp,
-        'status': 'POPULATING',
-        'steps': {}
+        'status': 'READY',
+        'steps': steps
+    }
+    init_ready_queue(run)
+    return {
+        "is_new": False,
+        "timestamp": timestamp,
+        "run": run
     }
-    processing_pool[model_name]["steps"] = model_tools.make_band_dict(
-        model_name, timestamp.strftime("%H")
-    )
-    for step in list(processing_pool[model_name]['steps']):
-        step_fh = processing_pool[model_name]['steps'][step]['fh']
-        if int(step_fh) < last_fh:
-            del processing_pool[model_name]['steps'][step]
-    processing_pool[model_name]["status"] = "READY"
 
 
 if __name__ == "__main__":
-    init()
+    parser = argparse.ArgumentParser(
+        description="Download weather model data and convert it to GeoTIFFs.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="stay resident and schedule model checks internally instead of running once from cron")
+    subparsers = parser.add_subparsers(dest="command")
+    slo_parser = subparsers.add_parser(
+        "slo", help="print end-to-end latency percentiles and SLO status per model, then exit")
+    slo_parser.add_argument("--hours", type=int, default=24,
+                            help="how far back to look (default: 24)")
+    point_parser = subparsers.add_parser(
+        "point", help="print a point's forecast from a run's point series as JSON, then exit")
+    point_parser.add_argument("model", help="model name")
+    point_parser.add_argument("run", help="run, as YYYYMMDDHH")
+    point_parser.add_argument("point", help="point id, from `points` in the config")
+    args = parser.parse_args()
+
+    if args.command == "slo":
+        ok = slo.print_report(args.hours)
+        flush_remote_logs()
+        sys.exit(0 if ok else 1)
+    elif args.command == "point":
+        series = points.read_series(args.model, datetime.strptime(
+            args.run, "%Y%m%d%H"), args.point)
+        if series is None:
+            print(f"{args.point} isn't in {args.model} {args.run}'s point series.")
+            sys.exit(1)
+        print(json.dumps(series))
+        sys.exit(0)
+    elif args.daemon:
+        daemon()
+    else:
+        init()
@@ -0,0 +1,135 @@
+from .config import config
+from .logger import log
+from . import pg_connection_manager as pg
+from . import clock
+
+from datetime import timedelta
+import pytz
+
+utc = pytz.UTC
+
+'''
+    Learns when each forecast hour shows up upstream, relative to the
+    model's cycle time, from wxdata.fh_arrivals: the upstream file's
+    Last-Modified, or the first time we saw it when we didn't get one.
+    Our own first sighting includes however long we took to look, so it's
+    only a fallback.
+
+    When a model pauses because an fh isn't out yet, the next probe is
+    scheduled just after that fh's expected arrival. Without enough history
+    it falls back to pausedResumeMinutes. If it's already
+    overdue, the wait grows with how late it is (a quarter of the time
+    overdue, between arrivalMinProbeSeconds and arrivalMaxProbeMinutes),
+    so a late upstream gets probed less and less often.
+'''
+
+# Arrivals recorded with a first sighting, and with an upstream time
+recorded = set()
+recorded_upstream = set()
+
+
+def record_arrival(model_name, timestamp, fh, seen_at, upstream_at=None):
+    key = (model_name, timestamp, fh)
+    if key in recorded_upstream or (key in recorded and upstream_at is None):
+        return
+
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        curr.execute('''
+            INSERT INTO wxdata.fh_arrivals (model, timestamp, fh, first_seen, upstream_at)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (model, timestamp, fh) DO UPDATE SET
+                first_seen = LEAST(wxdata.fh_arrivals.first_seen, EXCLUDED.first_seen),
+                upstream_at = COALESCE(wxdata.fh_arrivals.upstream_at, EXCLUDED.upstream_at)''',
+                     (model_name, timestamp, fh, seen_at, upstream_at))
+        conn.commit()
+        recorded.add(key)
+        if upstream_at is not None:
+            recorded_upstream.add(key)
+    except Exception as e:
+        log("Couldn't record fh arrival for " + model_name,
+            "WARN", remote=True, model=model_name)
+        log(repr(e), "WARN", indentLevel=1)
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+
+def forget_run(model_name, timestamp):
+    # Earlier runs of the model that never finished go with it
+    for keys in [recorded, recorded_upstream]:
+        for key in [key for key in keys if key[0] == model_name and key[1] <= timestamp]:
+            keys.discard(key)
+
+
+def get_expected_lag(model_name, timestamp, fh):
+    # Median lag over the last few runs for the same cycle hour, or any
+    # cycle hour if there isn't enough history for this one yet.
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        for same_hour in [True, False]:
+            curr.execute('''
+                SELECT percentile_cont(0.5) WITHIN GROUP (ORDER BY lag), COUNT(*) FROM (
+                    SELECT EXTRACT(EPOCH FROM COALESCE(upstream_at, first_seen) - timestamp) AS lag
+                    FROM wxdata.fh_arrivals
+                    WHERE model = %s AND fh = %s AND timestamp < %s
+                        AND (NOT %s OR EXTRACT(HOUR FROM timestamp AT TIME ZONE 'UTC') = %s)
+                    ORDER BY timestamp DESC
+                    LIMIT %s
+                ) AS history''',
+                         (model_name, fh, timestamp, same_hour, timestamp.astimezone(utc).hour,
+                          config.get("arrivalHistoryRuns", 10)))
+            result = curr.fetchone()
+            if result[0] is not None and result[1] >= config.get("arrivalMinHistory", 3):
+                return timedelta(seconds=float(result[0]))
+
+        return None
+
+    except Exception as e:
+        log("Couldn't get the expected arrival for " + model_name,
+            "WARN", remote=True, model=model_name)
+        log(repr(e), "WARN", indentLevel=1)
+        return None
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+
+def get_next_probe_time(model_name, timestamp, fh):
+    now = clock.now()
+    min_wait = timedelta(seconds=config.get("arrivalMinProbeSeconds", 30))
+    max_wait = timedelta(minutes=config.get("arrivalMaxProbeMinutes", 15))
+
+    lag = get_expected_lag(model_name, timestamp, fh)
+    if lag is None:
+        return now + timedelta(minutes=config["pausedResumeMinutes"])
+
+    expected = timestamp.astimezone(utc) + lag + \
+        timedelta(seconds=config.get("arrivalMarginSeconds", 30))
+
+    if expected > now:
+        wait = max(expected - now, min_wait)
+    else:
+        wait = min(max((now - expected) / 4, min_wait), max_wait)
+
+    log(f"· Next probe for {model_name} fh {fh} in {str(wait)}.",
+        "DEBUG", indentLevel=1)
+    return now + wait
+
+
+def clean():
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        curr.execute(
+            "DELETE FROM wxdata.fh_arrivals WHERE timestamp < now() - interval '" + str(config.get("arrivalRetentionDays", 14)) + " days'")
+        conn.commit()
+    except Exception as e:
+        log(f"· Couldn't delete old fh arrivals.",
+            "WARN", indentLevel=0, remote=True)
+        log(repr(e), "WARN", indentLevel=0)
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
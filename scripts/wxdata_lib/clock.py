@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta, timezone
+import os
+import time
+
+'''
+    The wall clock scheduling decisions are made on: which run is the
+    latest, when a paused model is due, when an fh was first seen.
+    Durations (timeouts, flush intervals, request latency) stay on the
+    real clock.
+
+    Normally this is just the system clock in UTC. The replay simulator
+    sets WXDATA_CLOCK to "<start>,<speed>,<real start>" (an ISO time,
+    a multiplier and a Unix time) so every process agrees on a clock that
+    started at <start> when the real clock read <real start> and runs
+    <speed> times faster.
+'''
+
+start = None
+speed = 1.0
+real_start = None
+
+if os.environ.get("WXDATA_CLOCK"):
+    start_str, speed_str, real_start_str = os.environ["WXDATA_CLOCK"].split(",")
+    start = datetime.fromisoformat(start_str).replace(tzinfo=timezone.utc)
+    speed = float(speed_str)
+    real_start = float(real_start_str)
+
+
+def now():
+    if start is None:
+        return datetime.now(timezone.utc)
+    return start + timedelta(seconds=(time.time() - real_start) * speed)
+
+
+def sleep(seconds):
+    # Sleeps are in clock time, so they shrink when it runs fast
+    time.sleep(seconds / speed)
@@ -0,0 +1,205 @@
+from .config import config, get_model
+from .logger import log
+
+from urllib.parse import urlsplit
+import time
+
+'''
+    AIMD control of how hard we lean on each upstream host.
+
+    Workers note every request they make to a host during a step (how long
+    it took and whether it was throttled with a 429/503 or failed outright)
+    and send that back with the step's result. The dispatcher keeps a limit
+    of in-flight steps per host: every clean step nudges the limit up by
+    1/limit, so it grows by about one per round of steps, and a throttled
+    or much slower than usual step halves it. The retry backoff handed to
+    workers moves the other way.
+
+    "Slower than usual" is judged per kind of request, each against its
+    own baseline: responses without a body (HEAD, 304) and small GETs
+    (.idx files, small bands) by latency, large GETs by seconds per MB.
+    Requests that failed only count as errors.
+'''
+
+THROTTLE_CODES = (429, 503)
+
+# GETs at least this big are judged by throughput instead of latency
+LARGE_BYTES = 1024 * 1024
+
+# Don't halve again for the same burst of bad responses
+DECREASE_COOLDOWN_SECONDS = 10
+
+
+class HostLimit:
+    __slots__ = ("limit", "backoff", "in_flight", "baselines", "last_decrease")
+
+    def __init__(self):
+        self.limit = float(get_max_limit())
+        self.backoff = get_base_backoff()
+        self.in_flight = 0
+        # Kind of request -> best mean cost seen, see get_kind()
+        self.baselines = {}
+        self.last_decrease = 0
+
+
+limits = {}
+
+# What this worker has seen during the current step
+observations = {}
+
+# Retry backoff per host for the current step, set by the dispatcher
+backoffs = {}
+
+
+def get_max_limit():
+    return config.get("concurrencyMax", config["maxThreads"])
+
+
+def get_base_backoff():
+    return config.get("concurrencyBackoffSeconds", 0.5)
+
+
+def get_limit(host):
+    if host not in limits:
+        limits[host] = HostLimit()
+    return limits[host]
+
+
+def get_model_hosts(model_name):
+    try:
+        model = get_model(model_name)
+    except KeyError:
+        return []
+    return [urlsplit(template).netloc for template in model.url_templates]
+
+
+'''
+    Dispatcher side. A step is charged to whichever of its model's hosts
+    has the most room; the worker may still end up using another mirror,
+    its observations are credited to the host that actually answered.
+'''
+
+
+def acquire(model_name):
+    hosts = get_model_hosts(model_name)
+    if len(hosts) == 0:
+        # Model was dropped from the config, nothing to throttle
+        return ""
+
+    best = None
+    best_room = 0
+    for host in hosts:
+        host_limit = get_limit(host)
+        room = int(host_limit.limit) - host_limit.in_flight
+        if room > best_room:
+            best = host
+            best_room = room
+
+    if best is not None:
+        limits[best].in_flight += 1
+    return best
+
+
+def release(host, step_observations):
+    if host is not None and host in limits:
+        limits[host].in_flight = max(limits[host].in_flight - 1, 0)
+
+    for observed_host, seen in step_observations.items():
+        adjust(observed_host, seen)
+
+
+def get_backoffs(model_name):
+    return {host: get_limit(host).backoff for host in get_model_hosts(model_name)}
+
+
+def adjust(host, seen):
+    if seen["requests"] == 0:
+        return
+
+    host_limit = get_limit(host)
+    old_limit = int(host_limit.limit)
+    factor = config.get("concurrencyLatencyFactor", 3)
+
+    slow = False
+    for kind, (count, cost) in seen["kinds"].items():
+        mean = cost / count
+        baseline = host_limit.baselines.get(kind)
+        if baseline is not None and mean > baseline * factor:
+            slow = True
+
+        # The baseline follows the best we've seen, creeping up so it can
+        # adapt if the host just gets slower for good
+        if baseline is None or mean < baseline:
+            host_limit.baselines[kind] = mean
+        else:
+            host_limit.baselines[kind] = baseline * 1.01
+
+    congested = seen["throttled"] > 0 or seen["errors"] > 0 or slow
+
+    if congested:
+        if time.time() - host_limit.last_decrease < DECREASE_COOLDOWN_SECONDS:
+            return
+        host_limit.last_decrease = time.time()
+        host_limit.limit = max(host_limit.limit / 2,
+                               config.get("concurrencyMin", 1), 1)
+        host_limit.backoff = min(host_limit.backoff * 2, 60)
+    else:
+        host_limit.limit = min(host_limit.limit + 1 / host_limit.limit,
+                               get_max_limit())
+        host_limit.backoff = max(host_limit.backoff * 0.9,
+                                 get_base_backoff())
+
+    if int(host_limit.limit) != old_limit:
+        log(f"· Upstream limit for {host}: {str(int(host_limit.limit))} in flight, {host_limit.backoff:.1f}s retry backoff"
+            + (" (throttled)." if congested else "."), "INFO", remote=True)
+
+
+def log_limits():
+    for host, host_limit in limits.items():
+        log(f"· {host}: {str(host_limit.in_flight)}/{str(int(host_limit.limit))} in flight, {host_limit.backoff:.1f}s retry backoff.",
+            "INFO", indentLevel=1)
+
+
+'''
+    Worker side.
+'''
+
+
+def start_step(step_backoffs):
+    observations.clear()
+    backoffs.clear()
+    backoffs.update(step_backoffs)
+
+
+def get_kind(nbytes):
+    if nbytes == 0:
+        return "empty"
+    if nbytes < LARGE_BYTES:
+        return "small"
+    return "large"
+
+
+def observe(url, seconds, status=None, throttled=0, nbytes=0):
+    host = urlsplit(url).netloc
+    if host not in observations:
+        observations[host] = {"requests": 0, "throttled": 0,
+                              "errors": 0, "seconds": 0.0, "kinds": {}}
+
+    seen = observations[host]
+    seen["requests"] += 1
+    seen["seconds"] += seconds
+    seen["throttled"] += throttled
+    if status in THROTTLE_CODES:
+        seen["throttled"] += 1
+    elif status is None or status >= 500:
+        seen["errors"] += 1
+    else:
+        kind = get_kind(nbytes)
+        # Large GETs are compared by seconds per MB, the rest by latency
+        cost = seconds / (nbytes / LARGE_BYTES) if kind == "large" else seconds
+        count, total = seen["kinds"].get(kind, (0, 0.0))
+        seen["kinds"][kind] = (count + 1, total + cost)
+
+
+def get_backoff(url):
+    return backoffs.get(urlsplit(url).netloc, get_base_backoff())
@@ -1,16 +1,530 @@
+from .expressions import ExpressionError, parse as parse_expression
+
 import json
 import os
 import sys
 
 directory = os.path.dirname(os.path.realpath(__file__))
+# WXDATA_CONFIG points at another config, e.g. for the benchmarks
+config_path = os.environ.get("WXDATA_CONFIG", directory + '/../config.json')
 
-try:
-    with open(directory + '/../config.json') as f:
+'''
+    config.json is validated and compiled once into typed objects (bounds
+    as floats, URL templates, band shorthands and level names resolved) so
+    hot paths don't have to do string-keyed lookups.
+
+    The raw config, levelMaps and models dicts are still exposed. On a hot
+    reload they're updated in place, so modules that imported them see the
+    new values, and an invalid file leaves the current config untouched.
+    They're never cleared along the way, since discovery threads and the
+    log shipper read them while the main thread reloads. A model that's
+    removed keeps its compiled config (see get_model) until the dispatcher
+    releases it, so its steps in flight can finish.
+'''
+
+
+class ConfigError(Exception):
+    def __init__(self, problems):
+        self.problems = problems
+        super().__init__("; ".join(problems))
+
+
+class Bounds:
+    __slots__ = ("left", "bottom", "right", "top")
+
+    def __init__(self, left, bottom, right, top):
+        self.left = left
+        self.bottom = bottom
+        self.right = right
+        self.top = top
+
+    def as_list(self):
+        return [self.left, self.bottom, self.right, self.top]
+
+
+# Storage types a band can be written as. Integer types are quantized
+# with a scale and offset; these are their ranges and default nodata.
+STORAGE_TYPES = {
+    "Float32": None,
+    "Int16": (-32768, 32767, -32768),
+    "UInt16": (0, 65535, 65535)
+}
+
+
+class StorageConfig:
+    __slots__ = ("type", "scale", "offset", "nodata")
+
+    def __init__(self, raw):
+        self.type = raw.get("storageType", "Float32")
+        if self.type == "Float32":
+            self.scale = 1.0
+            self.offset = 0.0
+            self.nodata = None
+        else:
+            self.scale = float(raw.get("scale", 0.01))
+            self.offset = float(raw.get("offset", 0))
+            self.nodata = int(raw.get("nodata", STORAGE_TYPES[self.type][2]))
+
+
+class ContourConfig:
+    __slots__ = ("interval", "base", "simplify")
+
+    def __init__(self, raw):
+        self.interval = float(raw["interval"])
+        self.base = float(raw.get("base", 0))
+        self.simplify = float(raw.get("simplify", 0))
+
+
+def make_contours(raw):
+    return ContourConfig(raw["contours"]) if "contours" in raw else None
+
+
+TILE_FORMATS = ("PNG", "WEBP")
+
+
+class TileConfig:
+    __slots__ = ("min_zoom", "max_zoom", "format", "ramp_values", "ramp_colors",
+                 "scale", "offset")
+
+    def __init__(self, raw):
+        self.min_zoom = raw.get("minZoom", 0)
+        self.max_zoom = raw.get("maxZoom", 6)
+        self.format = raw.get("format", "PNG")
+        # Without a ramp tiles hold the raw values, packed into RGB as
+        # offset + (R * 65536 + G * 256 + B) * scale
+        self.ramp_values = tuple(float(stop[0]) for stop in raw.get("ramp", []))
+        self.ramp_colors = tuple(tuple(stop[1]) + (255,) * (4 - len(stop[1]))
+                                 for stop in raw.get("ramp", []))
+        self.scale = float(raw.get("scale", 0.1))
+        self.offset = float(raw.get("offset", -10000))
+
+
+def make_tiles(raw):
+    return TileConfig(raw["tiles"]) if "tiles" in raw else None
+
+
+class BandConfig:
+    __slots__ = ("shorthand", "var", "level", "idx_var", "idx_level",
+                 "grib_level", "sub_band_num", "hour_range", "comment", "storage",
+                 "contours", "tiles", "raw")
+
+    def __init__(self, raw, level_maps):
+        self.raw = raw
+        self.var = raw["var"]
+        self.level = raw["level"]
+        self.shorthand = raw["var"].lower() + "_" + raw["level"].lower()
+        if "output" in raw:
+            self.shorthand += "_" + raw["output"]
+        self.idx_var = raw.get("idxVar", raw["var"])
+        self.idx_level = level_maps[raw["level"]]["idxName"]
+        self.grib_level = level_maps[raw["level"]]["gribName"]
+        # None when the band is the GRIB message's only one
+        self.sub_band_num = raw.get("subBandNum")
+        self.hour_range = raw.get("hourRange")
+        self.comment = raw.get("comment")
+        self.storage = StorageConfig(raw)
+        self.contours = make_contours(raw)
+        self.tiles = make_tiles(raw)
+
+
+class DerivedConfig:
+    __slots__ = ("name", "expression", "storage", "contours", "tiles", "raw")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.name = raw["name"]
+        self.expression = parse_expression(raw["expression"])
+        self.storage = StorageConfig(raw)
+        self.contours = make_contours(raw)
+        self.tiles = make_tiles(raw)
+
+
+class ModelConfig:
+    __slots__ = ("name", "enabled", "bounds", "url_templates", "filetype",
+                 "index", "anl", "flat_time", "flat_time_full_file",
+                 "ignore_band_var", "custom_translate", "custom_path_prefix",
+                 "update_frequency", "update_offset", "start_time", "end_time",
+                 "bands", "band_array", "bands_by_shorthand", "derived",
+                 "derived_by_name", "raw")
+
+    def __init__(self, name, raw, bounds, level_maps):
+        self.name = name
+        self.raw = raw
+        self.enabled = raw["enabled"]
+        self.bounds = bounds[raw["bounds"]]
+        # url can be a single template or a list of mirrors, in preference order
+        urls = raw["url"] if isinstance(raw["url"], list) else [raw["url"]]
+        self.url_templates = tuple(url.replace("{", "{{").replace("}", "}}").replace(
+            "%D", "{date}").replace("%H", "{hour}").replace("%T", "{fh}") for url in urls)
+        self.filetype = raw["filetype"]
+        self.index = raw["index"]
+        self.anl = "anl" in raw
+        self.flat_time = raw.get("flatTime", False) == True
+        self.flat_time_full_file = raw.get("flatTimeFullFile", False) == True
+        self.ignore_band_var = raw.get("ignoreBandVar", False) == True
+        self.custom_translate = raw.get("customTranslate")
+        self.custom_path_prefix = raw.get("customPathPrefix", "")
+        self.update_frequency = raw["updateFrequency"]
+        self.update_offset = raw["updateOffset"]
+        self.start_time = raw["startTime"]
+        self.end_time = raw["endTime"]
+        self.bands = tuple(BandConfig(band, level_maps)
+                           for band in raw.get("bands", []))
+        # The {shorthand, band, config} dicts that steps carry around
+        self.band_array = tuple({
+            "shorthand": band.shorthand,
+            "band": band.raw,
+            "config": band
+        } for band in self.bands)
+        self.bands_by_shorthand = {band.shorthand: band for band in self.bands}
+        self.derived = tuple(DerivedConfig(derived)
+                             for derived in raw.get("derived", []))
+        self.derived_by_name = {
+            derived.name: derived for derived in self.derived}
+
+    def get_output(self, shorthand):
+        # The band or derived variable written to the shorthand's TIF
+        return self.bands_by_shorthand.get(shorthand, self.derived_by_name.get(shorthand))
+
+    def get_storage(self, shorthand):
+        band = self.get_output(shorthand)
+        return band.storage if band is not None else None
+
+    def get_contours(self, shorthand):
+        band = self.get_output(shorthand)
+        return band.contours if band is not None else None
+
+    def get_tiles(self, shorthand):
+        band = self.get_output(shorthand)
+        return band.tiles if band is not None else None
+
+    def make_urls(self, model_date, model_hour, fh):
+        return [template.format(date=model_date, hour=model_hour, fh=fh)
+                for template in self.url_templates]
+
+    def make_url(self, model_date, model_hour, fh):
+        return self.url_templates[0].format(date=model_date, hour=model_hour, fh=fh)
+
+
+def is_number(value):
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validate_storage(raw, label, problems):
+    storage_type = raw.get("storageType", "Float32")
+    if storage_type not in STORAGE_TYPES:
+        problems.append(
+            label + f" has an unknown storageType, use one of {', '.join(STORAGE_TYPES)}.")
+    elif "scale" in raw and (not is_number(raw["scale"]) or float(raw["scale"]) == 0):
+        problems.append(label + " needs a non-zero scale.")
+    elif "offset" in raw and not is_number(raw["offset"]):
+        problems.append(label + " needs a numeric offset.")
+    elif "nodata" in raw and (not is_int(raw["nodata"]) or STORAGE_TYPES[storage_type] is None or
+                              not STORAGE_TYPES[storage_type][0] <= raw["nodata"] <= STORAGE_TYPES[storage_type][1]):
+        problems.append(
+            label + " needs an integer nodata value in range for its storageType.")
+
+
+def validate_contours(raw, model, label, problems):
+    if "contours" not in raw:
+        return
+
+    contours = raw["contours"]
+    if not isinstance(contours, dict) or not is_number(contours.get("interval")) or float(contours["interval"]) <= 0:
+        problems.append(label + " contours need a positive interval.")
+    elif not is_number(contours.get("base", 0)):
+        problems.append(label + " contours need a numeric base.")
+    elif not is_number(contours.get("simplify", 0)) or float(contours.get("simplify", 0)) < 0:
+        problems.append(label + " contours need a non-negative simplify tolerance.")
+    elif model.get("flatTime") or model.get("flatTimeFullFile"):
+        problems.append(label + " contours need a file per fh, not flatTime.")
+
+
+def validate_tiles(raw, model, label, problems):
+    if "tiles" not in raw:
+        return
+
+    tiles = raw["tiles"]
+    if not isinstance(tiles, dict):
+        problems.append(label + " tiles must be an object.")
+        return
+
+    min_zoom = tiles.get("minZoom", 0)
+    max_zoom = tiles.get("maxZoom", 6)
+    ramp = tiles.get("ramp", [])
+    if not is_int(min_zoom) or not is_int(max_zoom) or not 0 <= min_zoom <= max_zoom <= 22:
+        problems.append(label + " tiles need 0 <= minZoom <= maxZoom <= 22.")
+    elif tiles.get("format", "PNG") not in TILE_FORMATS:
+        problems.append(label + f" tiles format must be one of {', '.join(TILE_FORMATS)}.")
+    elif not isinstance(ramp, list) or len(ramp) == 1 or not all(
+            isinstance(stop, list) and len(stop) == 2 and is_number(stop[0]) and isinstance(stop[1], list) and
+            len(stop[1]) in (3, 4) and all(is_int(c) and 0 <= c <= 255 for c in stop[1]) for stop in ramp):
+        problems.append(
+            label + " tiles ramp needs at least two [value, [r, g, b(, a)]] stops.")
+    elif any(float(ramp[i][0]) >= float(ramp[i + 1][0]) for i in range(len(ramp) - 1)):
+        problems.append(label + " tiles ramp values must be increasing.")
+    elif not is_number(tiles.get("scale", 0.1)) or float(tiles.get("scale", 0.1)) == 0 or not is_number(tiles.get("offset", 0)):
+        problems.append(label + " tiles need a non-zero scale and a numeric offset.")
+    elif model.get("flatTime") or model.get("flatTimeFullFile"):
+        problems.append(label + " tiles need a file per fh, not flatTime.")
+
+
+def validate_derived(model, prefix, problems):
+    derived = model.get("derived", [])
+    if len(derived) == 0:
+        return
+
+    if model.get("flatTime") or model.get("flatTimeFullFile"):
+        problems.append(prefix + "derived variables need a file per fh, not flatTime.")
+        return
+
+    # Inputs can be bands, or derived variables defined before them
+    names = set(band["var"].lower() + "_" + band["level"].lower() + ("_" + band["output"] if "output" in band else "")
+                for band in model.get("bands", []) if "var" in band and "level" in band)
+    for entry in derived:
+        if not isinstance(entry.get("name"), str) or not isinstance(entry.get("expression"), str):
+            problems.append(prefix + "every derived variable needs a name and expression.")
+            continue
+
+        label = prefix + f"derived {entry['name']}"
+        if entry["name"] in names:
+            problems.append(label + " has the same name as another band.")
+            continue
+
+        try:
+            expression = parse_expression(entry["expression"])
+        except ExpressionError as e:
+            problems.append(label + ": " + str(e) + ".")
+            continue
+
+        unknown = [name for name in expression.inputs + expression.prev_inputs
+                   if name not in names]
+        if len(expression.inputs + expression.prev_inputs) == 0:
+            problems.append(label + " doesn't use any bands.")
+        elif unknown:
+            problems.append(label + " uses unknown bands " + ", ".join(unknown) + ".")
+
+        validate_storage(entry, label, problems)
+        validate_contours(entry, model, label, problems)
+        validate_tiles(entry, model, label, problems)
+        names.add(entry["name"])
+
+
+def validate(data):
+    problems = []
+
+    for section in ["config", "levelMaps", "models"]:
+        if section not in data or not isinstance(data[section], dict):
+            problems.append(f"Missing section '{section}'.")
+    if problems:
+        raise ConfigError(problems)
+
+    conf = data["config"]
+    for key in ["host", "db", "user"]:
+        if key not in conf.get("postgres", {}):
+            problems.append(f"config.postgres.{key} is required.")
+
+    for key in ["tempDir", "mapfileDir"]:
+        if not isinstance(conf.get(key), str):
+            problems.append(f"config.{key} must be a path.")
+
+    if not isinstance(conf.get("logLevels"), list):
+        problems.append("config.logLevels must be a list.")
+
+    for key in ["maxThreads", "retentionDays", "pausedResumeMinutes",
+                "maxRetriesPerStep", "maxLookback"]:
+        if not is_number(conf.get(key)) or conf.get(key) < 0:
+            problems.append(f"config.{key} must be a non-negative number.")
+
+    for name, bounds in conf.get("bounds", {}).items():
+        if not all(is_number(bounds.get(side)) for side in ["left", "bottom", "right", "top"]):
+            problems.append(
+                f"Bounds '{name}' need numeric left, bottom, right and top.")
+        elif float(bounds["left"]) >= float(bounds["right"]) or float(bounds["bottom"]) >= float(bounds["top"]):
+            problems.append(f"Bounds '{name}' are inverted.")
+
+    if "zarrDir" in conf and not isinstance(conf["zarrDir"], str):
+        problems.append("config.zarrDir must be a path.")
+    chunks = conf.get("zarrChunks", [1, 1, 1])
+    if not isinstance(chunks, list) or len(chunks) != 3 or \
+            not all(isinstance(size, int) and size > 0 for size in chunks):
+        problems.append("config.zarrChunks must be three positive integers (fhs, rows, columns).")
+
+    point_ids = set()
+    for point in conf.get("points", []):
+        if not isinstance(point, dict) or not isinstance(point.get("id"), str) or \
+                not is_number(point.get("lat")) or not is_number(point.get("lon")):
+            problems.append("config.points need a string id and numeric lat and lon.")
+        elif point["id"] in point_ids:
+            problems.append(f"Point '{point['id']}' is listed more than once.")
+        else:
+            point_ids.add(point["id"])
+
+    for name, level in data["levelMaps"].items():
+        if "idxName" not in level or "gribName" not in level:
+            problems.append(f"Level '{name}' needs idxName and gribName.")
+
+    for name, model in data["models"].items():
+        prefix = f"Model '{name}': "
+        for key in ["enabled", "index"]:
+            if not isinstance(model.get(key), bool):
+                problems.append(prefix + f"{key} must be true or false.")
+
+        for key in ["updateFrequency", "updateOffset", "startTime", "endTime"]:
+            if not is_int(model.get(key)):
+                problems.append(prefix + f"{key} must be an integer.")
+
+        if is_int(model.get("updateFrequency")) and model["updateFrequency"] <= 0:
+            problems.append(prefix + "updateFrequency must be positive.")
+
+        if is_int(model.get("startTime")) and is_int(model.get("endTime")) and model["startTime"] > model["endTime"]:
+            problems.append(prefix + "startTime is after endTime.")
+
+        if model.get("bounds") not in conf.get("bounds", {}):
+            problems.append(
+                prefix + f"unknown bounds '{model.get('bounds')}'.")
+
+        if not isinstance(model.get("filetype"), str):
+            problems.append(prefix + "filetype is required.")
+
+        url = model.get("url")
+        if isinstance(url, list):
+            if len(url) == 0 or not all(isinstance(mirror, str) for mirror in url):
+                problems.append(
+                    prefix + "url must be a template or a non-empty list of templates.")
+        elif not isinstance(url, str):
+            problems.append(prefix + "url is required.")
+
+        if "fhStepManual" in model:
+            for fh_def in model["fhStepManual"]:
+                if "appliesTo" not in fh_def or not isinstance(fh_def.get("fhStep"), dict) or len(fh_def["fhStep"]) == 0:
+                    problems.append(
+                        prefix + "each fhStepManual entry needs appliesTo and fhStep.")
+        elif not isinstance(model.get("fhStep"), dict) or len(model["fhStep"]) == 0:
+            problems.append(prefix + "fhStep or fhStepManual is required.")
+        elif not all(is_number(key) and is_int(step) and step > 0 for key, step in model["fhStep"].items()):
+            problems.append(prefix + "fhStep steps must be positive integers.")
+
+        if "customTranslate" in model and "customPathPrefix" not in model:
+            problems.append(
+                prefix + "customTranslate requires customPathPrefix.")
+
+        for band in model.get("bands", []):
+            if "var" not in band or "level" not in band:
+                problems.append(prefix + "every band needs a var and level.")
+            elif band["level"] not in data["levelMaps"]:
+                problems.append(
+                    prefix + f"band {band['var']} uses unknown level '{band['level']}'.")
+            else:
+                validate_storage(band, prefix + f"band {band['var']}", problems)
+                validate_contours(band, model, prefix + f"band {band['var']}", problems)
+                validate_tiles(band, model, prefix + f"band {band['var']}", problems)
+
+        validate_derived(model, prefix, problems)
+
+    if problems:
+        raise ConfigError(problems)
+
+
+def compile_config(data):
+    validate(data)
+
+    bounds = {}
+    for name, raw in data["config"].get("bounds", {}).items():
+        bounds[name] = Bounds(float(raw["left"]), float(raw["bottom"]),
+                              float(raw["right"]), float(raw["top"]))
+
+    compiled = {}
+    for name, raw in data["models"].items():
+        compiled[name] = ModelConfig(name, raw, bounds, data["levelMaps"])
+
+    return compiled
+
+
+def load(path):
+    with open(path) as f:
         data = json.load(f)
+    return data, compile_config(data)
+
+
+config = {}
+levelMaps = {}
+models = {}
+model_configs = {}
+# Compiled configs of models removed by a reload
+retired_configs = {}
+loaded_mtime = None
+
+
+def replace_items(target, source):
+    target.update(source)
+    for key in [key for key in target if key not in source]:
+        del target[key]
+
+
+def apply(data, compiled):
+    for model_name, model in model_configs.items():
+        if model_name not in compiled:
+            retired_configs[model_name] = model
+    for model_name in compiled:
+        retired_configs.pop(model_name, None)
+
+    replace_items(config, data["config"])
+    replace_items(levelMaps, data["levelMaps"])
+    replace_items(models, data["models"])
+    replace_items(model_configs, compiled)
+
+
+def get_model(model_name):
+    if model_name in model_configs:
+        return model_configs[model_name]
+    return retired_configs[model_name]
+
+
+def release_retired(in_use):
+    # Workers never release theirs, they're small and only their steps in
+    # flight use them
+    for model_name in list(retired_configs):
+        if model_name not in in_use:
+            del retired_configs[model_name]
+
+
+'''
+    Returns True if the file changed and was reloaded. Raises ConfigError
+    (or a json/OS error) if it changed but couldn't be used; the last good
+    config stays in place and the same file isn't retried until it changes
+    again.
+'''
+
+
+def reload_if_changed():
+    global loaded_mtime
+    mtime = os.stat(config_path).st_mtime
+    if mtime == loaded_mtime:
+        return False
+
+    loaded_mtime = mtime
+    data, compiled = load(config_path)
+    apply(data, compiled)
+    return True
+
+
+try:
+    loaded_mtime = os.stat(config_path).st_mtime
+    apply(*load(config_path))
+except ConfigError as e:
+    print("Error: Config file is invalid.")
+    for problem in e.problems:
+        print(" * " + problem)
+    sys.exit(1)
 except:
     print("Error: Config file does not exist or is corrupt.")
     sys.exit(1)
-
-config = data["config"]
-levelMaps = data["levelMaps"]
-models = data["models"]
@@ -0,0 +1,118 @@
+from .config import get_model
+from .logger import log
+
+from . import model_tools as model_tools
+from . import metrics
+from . import publish
+import os
+
+from osgeo import gdal, ogr, osr
+
+'''
+    Contour lines generated at ingest, for bands (or derived variables)
+    with `contours` set, so the map server can draw static lines instead
+    of contouring the whole TIF on every request.
+
+    Each (band, fh) gets a step that runs once the band is written. It
+    contours the fh's band at the configured interval, simplifies the lines
+    and writes them to contours/<band's TIF name>_<band number>.shp in the
+    run's directory, with the value in the `con` field like the on-the-fly
+    contour layer. Quantized bands are contoured in stored units and their
+    values converted back.
+'''
+
+EXTENSIONS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+
+def get_filename(model_name, timestamp, shorthand, band_num):
+    return publish.get_publish_dir(model_name, timestamp) + "/contours/" + \
+        model_tools.get_base_filename(model_name, timestamp, shorthand) + \
+        "_" + str(band_num) + ".shp"
+
+
+def remove_shapefile(filename):
+    base = filename[:-len(".shp")]
+    for extension in EXTENSIONS:
+        try:
+            os.remove(base + extension)
+        except FileNotFoundError:
+            pass
+
+
+def generate(model_name, timestamp, fh, band, band_num):
+    model = get_model(model_name)
+    shorthand = band["contours"]
+    settings = model.get_contours(shorthand)
+    if settings is None:
+        log(f"× {shorthand} doesn't have contours set anymore.",
+            "WARN", indentLevel=2, remote=True, model=model_name)
+        return False
+
+    source_filename = model_tools.get_band_filename(
+        model_name, timestamp, shorthand)
+    target_filename = get_filename(model_name, timestamp, shorthand, band_num)
+    # Written next to the real one and swapped in, the map server may be reading it
+    staged_filename = target_filename[:-len(".shp")] + "_staged.shp"
+
+    try:
+        os.makedirs(os.path.dirname(target_filename), exist_ok=True)
+
+        with metrics.span("write"):
+            tif = gdal.Open(source_filename)
+            raster_band = tif.GetRasterBand(band_num)
+            scale = raster_band.GetScale() or 1.0
+            offset = raster_band.GetOffset() or 0.0
+            nodata = raster_band.GetNoDataValue()
+
+            srs = osr.SpatialReference()
+            srs.ImportFromWkt(tif.GetProjection())
+
+            lines = ogr.GetDriverByName("Memory").CreateDataSource("")
+            layer = lines.CreateLayer("contours", srs, ogr.wkbLineString)
+            layer.CreateField(ogr.FieldDefn("id", ogr.OFTInteger))
+            layer.CreateField(ogr.FieldDefn("con", ogr.OFTReal))
+
+            # Levels in the band's stored units
+            gdal.ContourGenerate(raster_band, settings.interval / scale,
+                                 (settings.base - offset) / scale, [],
+                                 1 if nodata is not None else 0, nodata or 0, layer, 0, 1)
+
+            remove_shapefile(staged_filename)
+            out = ogr.GetDriverByName("ESRI Shapefile").CreateDataSource(staged_filename)
+            out_layer = out.CreateLayer("contours", srs, ogr.wkbLineString)
+            out_layer.CreateField(ogr.FieldDefn("con", ogr.OFTReal))
+            definition = out_layer.GetLayerDefn()
+
+            count = 0
+            for feature in layer:
+                geometry = feature.GetGeometryRef()
+                if settings.simplify > 0:
+                    geometry = geometry.SimplifyPreserveTopology(settings.simplify)
+                if geometry is None or geometry.IsEmpty():
+                    continue
+                line = ogr.Feature(definition)
+                line.SetGeometry(geometry)
+                line.SetField("con", round(feature.GetField("con") * scale + offset, 6))
+                out_layer.CreateFeature(line)
+                count += 1
+
+            out_layer = None
+            out = None
+            lines = None
+            tif = None
+
+            base = staged_filename[:-len(".shp")]
+            for extension in EXTENSIONS:
+                if os.path.exists(base + extension):
+                    os.replace(base + extension,
+                               target_filename[:-len(".shp")] + extension)
+    except Exception as e:
+        log(f"Couldn't generate contours for {shorthand} | fh: {fh}.",
+            "ERROR", indentLevel=2, remote=True, model=model_name)
+        log(repr(e), "ERROR", indentLevel=2, remote=True, model=model_name)
+        remove_shapefile(staged_filename)
+        return False
+
+    log(f"✓ {str(count)} contour lines for {shorthand} | fh: {fh}.",
+        "INFO", indentLevel=2, remote=True, model=model_name)
+    return True
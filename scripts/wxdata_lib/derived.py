@@ -0,0 +1,122 @@
+from .config import config, get_model
+from .logger import log
+
+from . import model_tools as model_tools
+from . import raster_tools
+from . import outputs
+from . import metrics
+from . import publish
+from .expressions import PREV_PREFIX
+import os
+
+from osgeo import gdal, gdalconst
+import numpy as np
+
+'''
+    Derived variables (a model's `derived` list) are computed from bands
+    that are already in our TIFs and written to master TIFs of their own,
+    e.g. wind speed from UGRD/VGRD, once at ingest instead of on every
+    API call.
+
+    Each one is a step of its own for every fh. It's dispatched once the
+    steps writing its inputs for that fh are done, and it reads them back a
+    window at a time. Inputs are unscaled to real values, with nodata as
+    NaN, before the expression is evaluated.
+'''
+
+FUNCTIONS = {
+    "abs": np.abs,
+    "arctan2": np.arctan2,
+    "cos": np.cos,
+    "degrees": np.degrees,
+    "exp": np.exp,
+    "hypot": np.hypot,
+    "log": np.log,
+    "maximum": np.maximum,
+    "minimum": np.minimum,
+    "mod": np.mod,
+    "radians": np.radians,
+    "sin": np.sin,
+    "sqrt": np.sqrt,
+    "where": np.where
+}
+
+
+def evaluate(expression, values):
+    with np.errstate(all="ignore"):
+        result = eval(expression.code, {"__builtins__": {}},
+                      dict(FUNCTIONS, **values))
+    return np.asarray(result, dtype=np.float32)
+
+
+def derive_band(model_name, timestamp, fh, band, band_num):
+    model = get_model(model_name)
+    derived = model.derived_by_name.get(band["shorthand"])
+    if derived is None:
+        log(f"× {band['shorthand']} isn't a derived variable of {model_name} anymore.",
+            "WARN", indentLevel=2, remote=True, model=model_name)
+        return False
+
+    expression = derived.expression
+    target_filename = model_tools.get_band_filename(model_name, timestamp, derived.name)
+
+    try:
+        inputs = {}
+        for name in dict.fromkeys(expression.inputs + expression.prev_inputs):
+            inputs[name] = gdal.Open(model_tools.get_band_filename(model_name, timestamp, name))
+
+        if not os.path.exists(target_filename):
+            with metrics.span("create"):
+                num_bands = model_tools.get_number_of_hours(
+                    model_name, timestamp.strftime("%H"))
+                raster_tools.create_master(target_filename, model_tools.get_band_filename(
+                    model_name, timestamp, expression.inputs[0] if expression.inputs else expression.prev_inputs[0]),
+                    num_bands, derived.storage)
+            log("✓ Output master TIF created --> " + target_filename, "NOTICE",
+                indentLevel=1, remote=True, model=model_name)
+
+        with metrics.span("write"):
+            tif = gdal.Open(target_filename, gdalconst.GA_Update)
+            out_band = tif.GetRasterBand(band_num)
+            sinks = outputs.open_sinks(model_name, timestamp, derived.name, band_num, tif)
+            width = out_band.XSize
+            height = out_band.YSize
+            block_x, block_y = out_band.GetBlockSize()
+            # Every input (and its previous fh) is read for each window
+            max_pixels = max(1, int(config.get("copyBufferMB", 16) * 1024 * 1024) //
+                             (4 * (len(expression.inputs) + len(expression.prev_inputs) + 1)))
+
+            for x, y, w, h in raster_tools.get_windows(width, height, block_x, block_y, max_pixels):
+                values = {}
+                for name in expression.inputs:
+                    values[name] = raster_tools.read_window(
+                        inputs[name].GetRasterBand(band_num), x, y, w, h)
+                for name in expression.prev_inputs:
+                    # Accumulations start from nothing at the first fh
+                    if band_num > 1:
+                        values[PREV_PREFIX + name] = raster_tools.read_window(
+                            inputs[name].GetRasterBand(band_num - 1), x, y, w, h)
+                    else:
+                        values[PREV_PREFIX + name] = np.zeros((h, w), dtype=np.float32)
+
+                result = np.broadcast_to(evaluate(expression, values), (h, w))
+                raster_tools.write_window(out_band, result, x, y)
+                for sink in sinks:
+                    sink.write(x, y, result)
+
+            tif.FlushCache()
+            outputs.close_sinks(model_name, sinks)
+            raster_tools.extract_band(tif, band_num, publish.get_fh_filename(
+                model_name, timestamp, derived.name, fh))
+
+        tif = None
+        inputs = None
+    except Exception as e:
+        log(f"Couldn't derive {derived.name} | fh: {fh}.",
+            "ERROR", indentLevel=2, remote=True, model=model_name)
+        log(repr(e), "ERROR", indentLevel=2, remote=True, model=model_name)
+        return False
+
+    log(f"✓ Derived {derived.name} | fh: {fh}.",
+        "INFO", indentLevel=2, remote=True, model=model_name)
+    return True
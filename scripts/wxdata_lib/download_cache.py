@@ -0,0 +1,254 @@
+from .config import config
+from .logger import log
+from .http_manager import http
+from . import http_manager
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+
+'''
+    A local cache of upstream downloads, shared by every worker and every
+    model. Entries are keyed by URL plus byte range, so two models that
+    pull the same band out of the same GRIB file only download it once.
+
+    Each entry remembers the ETag/Last-Modified it was downloaded with.
+    When the caller has fresh validators (e.g. from a HEAD request) they're
+    compared directly, otherwise the cached copy is revalidated with a
+    conditional GET. A lock file per entry makes concurrent requests for
+    the same bytes wait for a single fetch instead of all downloading: an
+    entry that was fetched or revalidated while we were waiting for its
+    lock is used as is, even if upstream didn't send any validators.
+
+    The cache lives in tempDir/cache and is kept under downloadCacheMB by
+    evicting the least recently used entries, every time a worker has
+    stored another 1/EVICT_EVERY of that since it last looked. Set it to 0
+    to disable it.
+'''
+
+EVICT_EVERY = 16
+
+# Bytes this process stored since it last evicted
+stored_since_evict = 0
+
+
+def get_cache_dir():
+    return config["tempDir"] + "/cache"
+
+
+def is_enabled():
+    return config.get("downloadCacheMB", 2048) > 0
+
+
+def get_max_bytes():
+    return config.get("downloadCacheMB", 2048) * 1024 * 1024
+
+
+def get_key(url, byte_range):
+    return hashlib.sha256((url + "|" + (byte_range or "")).encode("utf-8")).hexdigest()
+
+
+def read_meta(meta_path):
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except:
+        return None
+
+
+def get_validators(headers):
+    return {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified")
+    }
+
+
+def validators_match(meta, validators):
+    if validators["etag"] and meta.get("etag"):
+        return validators["etag"] == meta["etag"]
+    if validators["last_modified"] and meta.get("last_modified"):
+        return validators["last_modified"] == meta["last_modified"]
+    return False
+
+
+def request(url, byte_range=None, meta=None):
+    headers = {}
+    if byte_range is not None:
+        headers["Range"] = "bytes=" + byte_range
+    if meta is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    started = time.time()
+    try:
+        response = http.request('GET', url, headers=headers,
+                                retries=http_manager.get_retries(url))
+    except:
+        http_manager.record(url, time.time() - started)
+        raise
+
+    http_manager.record(url, time.time() - started, response.status,
+                        nbytes=len(response.data),
+                        throttled=http_manager.get_throttled(response))
+    if response.status not in [200, 206, 304]:
+        raise Exception("HTTP " + str(response.status) + " for " + url)
+    return response
+
+
+def lock_entry(lock_path, blocking=True):
+    # Eviction deletes lock files, so check that the file we locked is
+    # still the entry's lock and not one that was deleted while we waited
+    while True:
+        lock = open(lock_path, "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return None
+
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino:
+                return lock
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+
+def remove_entry(cache_dir, key):
+    # With the entry's lock held
+    for extension in [".data", ".meta", ".lock"]:
+        try:
+            os.remove(cache_dir + "/" + key + extension)
+        except OSError:
+            pass
+
+
+'''
+    Makes sure the bytes are in the cache and returns the path of the
+    cached copy and how many bytes actually came over the network.
+'''
+
+
+def fetch(url, byte_range=None, validators=None):
+    global stored_since_evict
+
+    cache_dir = get_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    key = get_key(url, byte_range)
+    data_path = cache_dir + "/" + key + ".data"
+    meta_path = cache_dir + "/" + key + ".meta"
+    downloaded = 0
+
+    wait_started = time.time()
+    with lock_entry(cache_dir + "/" + key + ".lock"):
+        meta = read_meta(meta_path)
+        try:
+            fetched_at = os.stat(data_path).st_mtime if meta is not None else None
+        except FileNotFoundError:
+            meta = fetched_at = None
+
+        if fetched_at is not None and fetched_at >= wait_started:
+            log("· Download cache hit, fetched while we waited.", "DEBUG", indentLevel=2)
+        elif meta is not None and validators is not None and validators_match(meta, validators):
+            log("· Download cache hit.", "DEBUG", indentLevel=2)
+        else:
+            response = request(url, byte_range,
+                               meta if validators is None else None)
+            if response.status == 304:
+                log("· Download cache revalidated.", "DEBUG", indentLevel=2)
+            else:
+                with open(data_path + ".part", "wb") as f:
+                    f.write(response.data)
+                os.replace(data_path + ".part", data_path)
+                downloaded = len(response.data)
+
+                with open(meta_path + ".part", "w") as f:
+                    json.dump(dict(get_validators(response.headers),
+                                   url=url, range=byte_range), f)
+                os.replace(meta_path + ".part", meta_path)
+
+        os.utime(data_path)
+
+    stored_since_evict += downloaded
+    if stored_since_evict >= get_max_bytes() / EVICT_EVERY:
+        stored_since_evict = 0
+        evict()
+
+    return data_path, downloaded
+
+
+def fetch_to(url, filename, byte_range=None, validators=None, cache=True):
+    if not cache or not is_enabled():
+        response = request(url, byte_range)
+        with open(filename, "wb") as f:
+            f.write(response.data)
+        return len(response.data)
+
+    data_path, downloaded = fetch(url, byte_range, validators)
+
+    # A hard link keeps our copy intact even if the entry gets evicted
+    try:
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.link(data_path, filename)
+    except OSError:
+        shutil.copyfile(data_path, filename)
+
+    return downloaded
+
+
+def fetch_bytes(url, validators=None):
+    if not is_enabled():
+        return request(url).data
+
+    data_path, downloaded = fetch(url, None, validators)
+    with open(data_path, "rb") as f:
+        return f.read()
+
+
+def evict():
+    cache_dir = get_cache_dir()
+    max_bytes = get_max_bytes()
+
+    entries = []
+    total = 0
+    names = os.listdir(cache_dir)
+    for name in names:
+        # Locks of entries that never got any data, e.g. failed fetches
+        if name.endswith(".lock") and name[:-len(".lock")] + ".data" not in names:
+            lock = lock_entry(cache_dir + "/" + name, blocking=False)
+            if lock is not None:
+                with lock:
+                    if not os.path.exists(cache_dir + "/" + name[:-len(".lock")] + ".data"):
+                        remove_entry(cache_dir, name[:-len(".lock")])
+
+        if not name.endswith(".data"):
+            continue
+        try:
+            stat = os.stat(cache_dir + "/" + name)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name[:-len(".data")]))
+        total += stat.st_size
+
+    if total <= max_bytes:
+        return
+
+    entries.sort()
+    for mtime, size, key in entries:
+        if total <= max_bytes:
+            break
+
+        # Skip anything that's being fetched right now
+        lock = lock_entry(cache_dir + "/" + key + ".lock", blocking=False)
+        if lock is None:
+            continue
+        with lock:
+            remove_entry(cache_dir, key)
+        total -= size
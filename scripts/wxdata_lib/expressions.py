@@ -0,0 +1,86 @@
+import ast
+
+'''
+    Expressions for derived variables, e.g. "hypot(ugrd_10m, vgrd_10m)".
+    They're plain arithmetic over band shorthands and a fixed set of NumPy
+    functions, checked when the config is loaded. prev(name) is the band's
+    value at the previous forecast hour, for differencing accumulations.
+
+    Expressions are compiled to code that's evaluated against NumPy arrays
+    with nothing else in scope, prev(name) becoming a variable of its own.
+'''
+
+FUNCTIONS = ("abs", "arctan2", "cos", "degrees", "exp", "hypot", "log",
+             "maximum", "minimum", "mod", "radians", "sin", "sqrt", "where")
+
+PREV_PREFIX = "prev__"
+
+ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call,
+                 ast.Name, ast.Load, ast.Constant,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod,
+                 ast.UAdd, ast.USub,
+                 ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+class Expression:
+    __slots__ = ("text", "inputs", "prev_inputs", "code")
+
+    def __init__(self, text, inputs, prev_inputs, code):
+        self.text = text
+        self.inputs = inputs
+        self.prev_inputs = prev_inputs
+        self.code = code
+
+
+class PrevRewriter(ast.NodeTransformer):
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if node.func.id == "prev":
+            return ast.copy_location(ast.Name(id=PREV_PREFIX + node.args[0].id, ctx=ast.Load()), node)
+        return node
+
+
+def parse(text):
+    try:
+        tree = ast.parse(text, mode="eval")
+    except SyntaxError as e:
+        raise ExpressionError(f"can't parse '{text}': {e.msg}")
+
+    inputs = []
+    prev_inputs = []
+    calls = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ExpressionError(
+                f"'{text}' uses {type(node).__name__}, only arithmetic, comparisons and function calls are allowed")
+
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ExpressionError(f"'{text}' has a non-numeric constant")
+
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.keywords:
+                raise ExpressionError(f"'{text}' has an unsupported call")
+            calls.add(id(node.func))
+            if node.func.id == "prev":
+                if len(node.args) != 1 or not isinstance(node.args[0], ast.Name):
+                    raise ExpressionError(
+                        f"prev() in '{text}' takes a single band name")
+                calls.add(id(node.args[0]))
+                if node.args[0].id not in prev_inputs:
+                    prev_inputs.append(node.args[0].id)
+            elif node.func.id not in FUNCTIONS:
+                raise ExpressionError(
+                    f"'{text}' calls unknown function {node.func.id}()")
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and id(node) not in calls and node.id not in inputs:
+            inputs.append(node.id)
+
+    tree = ast.fix_missing_locations(PrevRewriter().visit(tree))
+    code = compile(tree, "<derived>", "eval")
+
+    return Expression(text, tuple(inputs), tuple(prev_inputs), code)
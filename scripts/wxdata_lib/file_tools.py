@@ -17,3 +17,32 @@ def clean():
     except:
         log(f"· Couldn't delete old rasters from {config['mapfileDir']}.",
             "WARN", indentLevel=0, remote=True)
+
+    # So are runs (built and published) and the links to them
+    model_dirs = config["mapfileDir"] + "/*"
+    try:
+        os.system(f'find {model_dirs} {model_dirs}/.build {model_dirs}/.runs -mindepth 1 -maxdepth 1 ' +
+                  '-name "*_[0-9][0-9]Z*" -mtime +' + retention_days + ' -exec rm -rf {} +')
+    except:
+        log(f"· Couldn't delete old runs from {config['mapfileDir']}.",
+            "WARN", indentLevel=0, remote=True)
+
+    # Tiles are kept in a directory per run
+    tiles_dir = config.get("tilesDir", config["mapfileDir"] + "/tiles")
+    if os.path.isdir(tiles_dir):
+        try:
+            os.system(f'find {tiles_dir} -mindepth 2 -maxdepth 2 -type d -mtime +' +
+                      retention_days + ' -exec rm -rf {} +')
+        except:
+            log(f"· Couldn't delete old tiles from {tiles_dir}.",
+                "WARN", indentLevel=0, remote=True)
+
+    # So is the Zarr store
+    zarr_dir = config.get("zarrDir")
+    if zarr_dir and os.path.isdir(zarr_dir):
+        try:
+            os.system(f'find {zarr_dir} -mindepth 2 -maxdepth 2 -type d -mtime +' +
+                      retention_days + ' -exec rm -rf {} +')
+        except:
+            log(f"· Couldn't delete old runs from {zarr_dir}.",
+                "WARN", indentLevel=0, remote=True)
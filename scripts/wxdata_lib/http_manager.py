@@ -1,5 +1,30 @@
+from . import mirrors
+from . import concurrency
+
 import urllib3
 import certifi
 
 http = urllib3.PoolManager(timeout=urllib3.Timeout(
     connect=5.0, read=10.0), cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
+
+
+def get_retries(url):
+    # Throttled responses are retried with the backoff the dispatcher
+    # currently wants for this host, honouring Retry-After
+    return urllib3.Retry(total=5, backoff_factor=concurrency.get_backoff(url),
+                         status_forcelist=concurrency.THROTTLE_CODES,
+                         respect_retry_after_header=True, raise_on_status=False)
+
+
+def get_throttled(response):
+    if response.retries is None:
+        return 0
+    return len([attempt for attempt in response.retries.history
+                if attempt.status in concurrency.THROTTLE_CODES])
+
+
+def record(url, seconds, status=None, nbytes=0, throttled=0):
+    # A 404 just means the file isn't out yet, the host is fine
+    mirrors.record(url, seconds, nbytes=nbytes,
+                   ok=status is not None and status < 500 and status != 429)
+    concurrency.observe(url, seconds, status, throttled=throttled, nbytes=nbytes)
@@ -1,6 +1,28 @@
 from . import pg_connection_manager as pg
 from .config import config
 from datetime import datetime, timedelta, tzinfo, time
+from psycopg2.extras import execute_values
+import os
+import queue
+import threading
+
+'''
+    Remote log lines are queued and written to wxdata.log in batches by a
+    background shipper thread, one per process. The shipper writes when it
+    has remoteLogBatchSize lines or remoteLogFlushSeconds have passed.
+
+    If the database falls behind and the queue fills up, DEBUG lines are
+    dropped and everything else waits (up to remoteLogBlockSeconds) for room.
+'''
+
+_queue = None
+_shipper_pid = None
+_dropped = 0
+
+
+class _FlushRequest:
+    def __init__(self):
+        self.done = threading.Event()
 
 
 def log(text, level, indentLevel=0, remote=False, model=''):
@@ -18,17 +40,104 @@ def log(text, level, indentLevel=0, remote=False, model=''):
     print(f"[{level}\t| {time_str}] {indents}{text}")
 
     if remote:
+        queue_remote_log((model, level, timestamp, '0', text))
+
+
+def queue_remote_log(row):
+    global _dropped
+    log_queue = get_queue()
+    try:
+        log_queue.put_nowait(row)
+    except queue.Full:
+        if row[1] == "DEBUG":
+            _dropped += 1
+            return
+
         try:
-            conn, curr = pg.ConnectionPool.connect()
-            curr.execute(
-                "INSERT INTO wxdata.log (model, level, timestamp, agent, message) VALUES (%s, %s, %s, %s, %s)", (model, level, timestamp, '0', text))
-            conn.commit()
-            pg.ConnectionPool.close(conn, curr)
-        except:
+            log_queue.put(row, timeout=config.get("remoteLogBlockSeconds", 5))
+        except queue.Full:
             print("Wasn't logged remotely :(")
+
+
+def get_queue():
+    global _queue, _shipper_pid
+
+    # Threads don't survive a fork, so each worker starts its own shipper.
+    if _shipper_pid != os.getpid():
+        _queue = queue.Queue(maxsize=config.get("remoteLogQueueSize", 10000))
+        _shipper_pid = os.getpid()
+        threading.Thread(target=ship_remote_logs, args=(_queue,),
+                         daemon=True).start()
+
+    return _queue
+
+
+def ship_remote_logs(log_queue):
+    batch_size = config.get("remoteLogBatchSize", 200)
+    flush_seconds = config.get("remoteLogFlushSeconds", 2)
+
+    while True:
+        rows = []
+        flush_request = None
+        item = log_queue.get()
+        deadline = datetime.utcnow() + timedelta(seconds=flush_seconds)
+        while True:
+            if isinstance(item, _FlushRequest):
+                flush_request = item
+                break
+
+            rows.append(item)
+            remaining = (deadline - datetime.utcnow()).total_seconds()
+            if len(rows) >= batch_size or remaining <= 0:
+                break
+
+            try:
+                item = log_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+        write_remote_logs(rows)
+
+        if flush_request is not None:
+            flush_request.done.set()
+
+
+def write_remote_logs(rows):
+    global _dropped
+    if _dropped > 0:
+        print(f"Dropped {str(_dropped)} DEBUG lines from the remote log queue.")
+        _dropped = 0
+
+    if len(rows) == 0:
+        return
+
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        execute_values(
+            curr, "INSERT INTO wxdata.log (model, level, timestamp, agent, message) VALUES %s", rows)
+        conn.commit()
+    except:
+        print(f"{str(len(rows))} lines weren't logged remotely :(")
+    finally:
+        if conn is not None:
             pg.ConnectionPool.close(conn, curr)
 
 
+def flush_remote_logs(timeout=10):
+    if _shipper_pid != os.getpid():
+        return
+
+    flush_request = _FlushRequest()
+    try:
+        _queue.put(flush_request, timeout=timeout)
+    except queue.Full:
+        print("Couldn't flush the remote log queue.")
+        return
+
+    flush_request.done.wait(timeout)
+
+
 def print_line():
     print("-----------------")
 
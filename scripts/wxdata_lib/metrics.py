@@ -0,0 +1,239 @@
+from . import pg_connection_manager as pg
+from .config import config
+from .logger import log
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from psycopg2.extras import execute_values
+import os
+import threading
+import time
+
+'''
+    Timing spans around each stage of processing a step (HEAD, idx fetch,
+    download, translate, warp, master TIF create and band write).
+
+    Workers collect the spans for the step they're on, labelled with the
+    model, run, fh and band, and send them back with the result. The
+    dispatcher folds them into per model/stage histograms, exported in the
+    Prometheus text format to metricsFile and/or on metricsPort. With
+    metricsToPostgres each step also gets a row in wxdata.step_timings.
+'''
+
+STAGES = ("head", "idx", "download", "translate", "warp", "create", "write")
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# The current step's labels and spans, in a worker
+labels = {}
+spans = []
+
+# (model, stage) -> histogram, in the dispatcher
+histograms = {}
+pending_rows = []
+last_export = 0
+exported_text = ""
+server = None
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "bytes")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.bytes = 0
+
+    def observe(self, seconds, nbytes):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.total += seconds
+        self.count += 1
+        self.bytes += nbytes
+
+
+def start_step(model_name, timestamp, fh, band):
+    labels.clear()
+    labels.update({
+        "model": model_name,
+        "run": timestamp.strftime("%Y%m%d%H"),
+        "fh": fh,
+        "band": band or ""
+    })
+    spans.clear()
+
+
+'''
+    Usage:
+        with metrics.span("download") as s:
+            s["bytes"] = fetch(...)
+'''
+
+
+@contextmanager
+def span(stage):
+    current = dict(labels, stage=stage, bytes=0)
+    started = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current["seconds"] = time.perf_counter() - started
+        spans.append(current)
+
+
+def record_spans(result):
+    if len(result["spans"]) == 0:
+        return
+
+    row = {stage: None for stage in STAGES}
+    download_bytes = 0
+    for s in result["spans"]:
+        key = (s["model"], s["stage"])
+        if key not in histograms:
+            histograms[key] = Histogram()
+        histograms[key].observe(s["seconds"], s["bytes"])
+
+        row[s["stage"]] = (row[s["stage"]] or 0) + s["seconds"]
+        download_bytes += s["bytes"]
+
+    if config.get("metricsToPostgres", False):
+        pending_rows.append((result["model_name"], result["timestamp"], result["fh"],
+                             result["band"]) + tuple(row[stage] for stage in STAGES) +
+                            (download_bytes, result["finished_at"]))
+
+    export()
+
+
+def format_labels(model_name, stage, **extra):
+    pairs = [("model", model_name), ("stage", stage)] + list(extra.items())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+def render():
+    lines = [
+        "# HELP wxdata_stage_seconds Time spent in each stage of processing a step.",
+        "# TYPE wxdata_stage_seconds histogram"
+    ]
+    for (model_name, stage), histogram in sorted(histograms.items()):
+        for bound, count in zip(BUCKETS, histogram.counts):
+            lines.append("wxdata_stage_seconds_bucket" +
+                         format_labels(model_name, stage, le=str(bound)) + " " + str(count))
+        lines.append("wxdata_stage_seconds_bucket" +
+                     format_labels(model_name, stage, le="+Inf") + " " + str(histogram.count))
+        lines.append("wxdata_stage_seconds_sum" +
+                     format_labels(model_name, stage) + " " + str(histogram.total))
+        lines.append("wxdata_stage_seconds_count" +
+                     format_labels(model_name, stage) + " " + str(histogram.count))
+
+    lines += [
+        "# HELP wxdata_stage_bytes_total Bytes downloaded in each stage.",
+        "# TYPE wxdata_stage_bytes_total counter"
+    ]
+    for (model_name, stage), histogram in sorted(histograms.items()):
+        if histogram.bytes > 0:
+            lines.append("wxdata_stage_bytes_total" +
+                         format_labels(model_name, stage) + " " + str(histogram.bytes))
+
+    return "\n".join(lines) + "\n"
+
+
+def export(force=False):
+    global last_export, exported_text
+
+    if not force and time.time() - last_export < config.get("metricsFlushSeconds", 15):
+        return
+    last_export = time.time()
+
+    exported_text = render()
+
+    if config.get("metricsFile"):
+        try:
+            # Write then rename so a scrape never sees half a file
+            with open(config["metricsFile"] + ".part", "w") as f:
+                f.write(exported_text)
+            os.replace(config["metricsFile"] + ".part", config["metricsFile"])
+        except Exception as e:
+            log("Couldn't write the metrics file.", "WARN")
+            log(repr(e), "WARN", indentLevel=1)
+
+    write_rows()
+
+
+def write_rows():
+    if len(pending_rows) == 0:
+        return
+
+    rows = list(pending_rows)
+    pending_rows.clear()
+
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        execute_values(curr, """
+            INSERT INTO wxdata.step_timings (model, timestamp, fh, band, head_seconds,
+                idx_seconds, download_seconds, translate_seconds, warp_seconds,
+                create_seconds, write_seconds, download_bytes, finished_at)
+            VALUES %s""", rows)
+        conn.commit()
+    except Exception as e:
+        log("Couldn't save step timings.", "WARN", remote=True)
+        log(repr(e), "WARN", indentLevel=1, remote=True)
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+
+def flush():
+    export(force=True)
+
+
+def clean():
+    if not config.get("metricsToPostgres", False):
+        return
+
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        curr.execute(
+            "DELETE FROM wxdata.step_timings WHERE timestamp < now() - interval '" + str(config["retentionDays"]) + " days'")
+        conn.commit()
+    except Exception as e:
+        log(f"· Couldn't delete old step timings.",
+            "WARN", indentLevel=0, remote=True)
+        log(repr(e), "WARN", indentLevel=0)
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = exported_text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve():
+    global server
+
+    if server is not None or not config.get("metricsPort"):
+        return
+
+    try:
+        server = ThreadingHTTPServer(
+            (config.get("metricsHost", "127.0.0.1"), config["metricsPort"]), MetricsHandler)
+    except Exception as e:
+        log("Couldn't start the metrics endpoint.", "WARN", remote=True)
+        log(repr(e), "WARN", indentLevel=1, remote=True)
+        return
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log("· Serving metrics on port " + str(config["metricsPort"]) + ".", "INFO")
@@ -0,0 +1,102 @@
+from .config import config
+from .logger import log
+
+from urllib.parse import urlsplit
+import time
+
+'''
+    Tracks how each upstream host has been behaving (latency, throughput
+    and error rate, as moving averages) and orders a model's mirror URLs
+    so requests go to the fastest healthy one first.
+
+    A host that keeps failing is benched for mirrorBenchSeconds, doubling
+    each time it fails again, and is only used if nothing else is left.
+    Hosts we haven't heard from yet keep their order from the config.
+    Stats are per process, each worker learns on its own.
+'''
+
+ALPHA = 0.3
+
+# Roughly what a band download weighs, for comparing latency to throughput
+TYPICAL_BYTES = 2 * 1024 * 1024
+
+
+class HostStats:
+    __slots__ = ("latency", "throughput", "error_rate",
+                 "failures", "benched_until")
+
+    def __init__(self):
+        self.latency = None
+        self.throughput = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.benched_until = 0
+
+
+hosts = {}
+
+
+def get_host(url):
+    return urlsplit(url).netloc
+
+
+def get_stats(host):
+    if host not in hosts:
+        hosts[host] = HostStats()
+    return hosts[host]
+
+
+def average(previous, value):
+    if previous is None:
+        return value
+    return ALPHA * value + (1 - ALPHA) * previous
+
+
+def record(url, seconds, nbytes=0, ok=True):
+    host = get_host(url)
+    stats = get_stats(host)
+    stats.error_rate = average(stats.error_rate, 0.0 if ok else 1.0)
+
+    if ok:
+        stats.failures = 0
+        stats.latency = average(stats.latency, seconds)
+        if nbytes > 0 and seconds > 0:
+            stats.throughput = average(stats.throughput, nbytes / seconds)
+        return
+
+    stats.failures += 1
+    if stats.failures >= config.get("mirrorMaxFailures", 3):
+        bench = config.get("mirrorBenchSeconds", 60) * \
+            2 ** (stats.failures - config.get("mirrorMaxFailures", 3))
+        stats.benched_until = time.time() + min(bench, 3600)
+        log(f"· Benching upstream host {host} for {str(int(min(bench, 3600)))}s.",
+            "WARN", indentLevel=2, remote=True)
+
+
+def get_expected_seconds(stats):
+    if stats.latency is None:
+        return None
+
+    seconds = stats.latency
+    if stats.throughput:
+        seconds += TYPICAL_BYTES / stats.throughput
+
+    # Each expected failure costs about another attempt
+    return seconds / max(1.0 - stats.error_rate, 0.05)
+
+
+def order(urls):
+    if len(urls) <= 1:
+        return list(urls)
+
+    now = time.time()
+    ranked = []
+    for i, url in enumerate(urls):
+        stats = get_stats(get_host(url))
+        benched = stats.benched_until > now
+        expected = get_expected_seconds(stats)
+        # Unknown hosts go first so they get measured, in config order
+        ranked.append((benched, expected is not None, expected or 0, i, url))
+
+    ranked.sort()
+    return [url for benched, known, expected, i, url in ranked]
@@ -1,12 +1,24 @@
-from .config import config, models, levelMaps
+from .config import config, get_model
+from . import config as config_file
 from .logger import log
 from . import file_tools as file_tools
 from . import pg_connection_manager as pg
+from . import progress
+from . import arrivals
+from . import schedules
+from . import mirrors
+from . import http_manager
+from . import metrics
+from . import clock
+from . import zarr_store
+from . import publish
 
 from datetime import datetime, timedelta, tzinfo, time
 import requests
+from psycopg2.extras import execute_values
 import pytz
 import signal
+import threading
 
 utc = pytz.UTC
 
@@ -20,29 +32,58 @@ def timeout_handler(signum, frame):
 
 
 def make_url(model_name, model_date, model_hour, fh):
-    model = models[model_name]
-    return model["url"].replace("%D", model_date).replace("%H", model_hour).replace("%T", fh)
+    return get_model(model_name).make_url(model_date, model_hour, fh)
+
+
+def make_urls(model_name, model_date, model_hour, fh):
+    # Every mirror for the file, best performing first
+    return mirrors.order(get_model(model_name).make_urls(model_date, model_hour, fh))
+
+
+def reload_config():
+    try:
+        if not config_file.reload_if_changed():
+            return False
+    except Exception as e:
+        log("Couldn't reload config.json, keeping the current config.",
+            "ERROR", remote=True)
+        log(repr(e), "ERROR", indentLevel=1, remote=True)
+        return False
+
+    schedules.compile_schedules()
+    log("Reloaded config.json.", "NOTICE", remote=True)
+    return True
 
 
 def add_model_to_db(model_name, timestamp):
+    return add_models_to_db([(model_name, timestamp)])
+
+
+def add_models_to_db(new_models):
+    conn = curr = None
     try:
-        log("✓ Added model to models table.", "INFO",
-            indentLevel=1, remote=True, model=model_name)
         conn, curr = pg.ConnectionPool.connect()
-        curr.execute(
-            "INSERT INTO wxdata.models (model, status, timestamp) VALUES (%s, %s, %s)", (model_name, "WAITING", timestamp))
+        execute_values(curr, "INSERT INTO wxdata.models (model, status, timestamp) VALUES %s",
+                       [(model_name, "WAITING", timestamp) for model_name, timestamp in new_models])
         conn.commit()
-        pg.ConnectionPool.close(conn, curr)
+        for model_name, timestamp in new_models:
+            update_model_state(model_name, status="WAITING",
+                               timestamp=timestamp)
+            log("✓ Added model to models table.", "INFO",
+                indentLevel=1, remote=True, model=model_name)
         return True
     except:
-        pg.ConnectionPool.close(conn, curr)
-        log("Couldn't add model to db.", "ERROR", remote=True, model=model_name)
+        log("Couldn't add models to db: " + ", ".join(model_name for model_name, timestamp in new_models),
+            "ERROR", remote=True)
         return False
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
 
 
 def get_last_available_timestamp(model, prev=0):
     try:
-        now = datetime.utcnow()
+        now = clock.now().replace(tzinfo=None)
         start_of_day = now - timedelta(
             hours=now.hour,
             minutes=now.minute,
@@ -74,67 +115,154 @@ def get_last_available_timestamp(model, prev=0):
 
 
 def get_number_of_hours(model_name, hour):
-    model = models[model_name]
-    fh = model["startTime"]
-    i = 0
-    while True:
-        fh = add_appropriate_fh_step(model_name, fh, hour)
-        i += 1
+    return schedules.get_schedule(model_name, hour).band_count
 
-        if fh > model["endTime"]:
-            return i
 
+'''
+    A snapshot of every row in wxdata.models, loaded with a single query.
+    Reads are served from the snapshot until it's older than
+    modelStateTTLSeconds; our own writes update it in place.
+'''
 
-def get_model_status(model_name):
+model_states = {}
+model_states_loaded_at = None
+
+
+def get_model_states(refresh=False):
+    global model_states, model_states_loaded_at
+
+    ttl = config.get("modelStateTTLSeconds", 15)
+    if not refresh and model_states_loaded_at is not None and \
+            (clock.now() - model_states_loaded_at).total_seconds() < ttl:
+        return model_states
+
+    conn = curr = None
     try:
         conn, curr = pg.ConnectionPool.connect()
         curr.execute(
-            "SELECT status FROM wxdata.models WHERE model LIKE '" + model_name + "'")
-
-        if curr.rowcount == 0:
-            return None
-        result = curr.fetchone()
-        pg.ConnectionPool.close(conn, curr)
-        return result[0]
+            "SELECT model, status, timestamp, lastfh, paused_at, resume_at FROM wxdata.models")
+        states = {}
+        for row in curr.fetchall():
+            states[row[0]] = {
+                "status": row[1],
+                "timestamp": row[2],
+                "lastfh": row[3],
+                "paused_at": row[4],
+                "resume_at": row[5]
+            }
+        model_states = states
+        model_states_loaded_at = clock.now()
+        return model_states
 
     except Exception as e:
-        pg.ConnectionPool.close(conn, curr)
         log(repr(e), "ERROR")
+        return None
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+
+def get_model_state(model_name):
+    states = get_model_states()
+    if states is None:
+        return None
+    return states.get(model_name)
+
+
+def update_model_state(model_name, **fields):
+    if model_name not in model_states:
+        model_states[model_name] = {
+            "status": None,
+            "timestamp": None,
+            "lastfh": None,
+            "paused_at": None,
+            "resume_at": None
+        }
+    model_states[model_name].update(fields)
+
+
+def invalidate_model_states():
+    global model_states_loaded_at
+    model_states_loaded_at = None
+
+
+def get_model_status(model_name):
+    states = get_model_states()
+    if states is None:
         return "ERROR"
 
+    if model_name not in states:
+        return None
+
+    return states[model_name]["status"]
+
+
+# A stale snapshot can still say PAUSED for a model that's just been
+# resumed, so double check with the DB before skipping its steps.
+def is_model_paused(model_name):
+    if get_model_status(model_name) != "PAUSED":
+        return False
+
+    get_model_states(refresh=True)
+    return get_model_status(model_name) == "PAUSED"
+
 
 def get_model_timestamp(model_name):
+    state = get_model_state(model_name)
+    if state is None:
+        return None
+
+    return state["timestamp"]
+
+
+def set_models_as_disabled(model_names):
+    if len(model_names) == 0:
+        return
+
+    conn = curr = None
     try:
         conn, curr = pg.ConnectionPool.connect()
         curr.execute(
-            "SELECT timestamp FROM wxdata.models WHERE model LIKE '" + model_name + "'")
-        result = curr.fetchone()
-        pg.ConnectionPool.close(conn, curr)
-        return result[0]
-
-    except:
-        pg.ConnectionPool.close(conn, curr)
-        return None
+            "UPDATE wxdata.models SET status = %s WHERE model = ANY(%s)", ("DISABLED", list(model_names)))
+        conn.commit()
+        for model_name in model_names:
+            if model_name in model_states:
+                update_model_state(model_name, status="DISABLED")
+    except Exception as e:
+        log(repr(e), "ERROR", remote=True)
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
 
 
 def get_full_fh(model_name, fh):
-    model = models[model_name]
-    return str(fh).rjust(len(str(model["endTime"])), '0')
-
-
-def get_level_name_for_level(level_shorthand, name_type):
-    return levelMaps[level_shorthand][name_type]
+    return schedules.format_fh(get_model(model_name).raw, fh)
 
 
 def check_if_model_fh_available(model_name, timestamp, fh):
-    url = make_url(model_name, timestamp.strftime(
+    urls = make_urls(model_name, timestamp.strftime(
         "%Y%m%d"), timestamp.strftime("%H"), fh)
+
+    # Mirrors don't always get files at the same time, so any of them will do
+    for url in urls:
+        if check_if_url_available(model_name, url):
+            return True
+
+    return False
+
+
+def check_if_url_available(model_name, url):
     log("· Checking URL: " + url, "DEBUG",
         remote=True, indentLevel=1, model=model_name)
 
+    # Alarms only work on the main thread, discovery threads have to rely
+    # on the request timeouts
+    use_alarm = threading.current_thread() is threading.main_thread()
+    started = datetime.now().timestamp()
     try:
-        signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(10)
+        if use_alarm:
+            signal.signal(signal.SIGALRM, timeout_handler)
+            signal.alarm(10)
         try:
             ret = requests.head(url, timeout=(3, 5))
         except TimeoutException:
@@ -142,7 +270,11 @@ def check_if_model_fh_available(model_name, timestamp, fh):
         except:
             raise
         finally:
-            signal.alarm(0)
+            if use_alarm:
+                signal.alarm(0)
+
+        http_manager.record(url, datetime.now().timestamp() - started,
+                            ret.status_code)
 
         if ret.status_code >= 200 and ret.status_code < 300:
             log("✓ Found.", "DEBUG", remote=True,
@@ -157,11 +289,13 @@ def check_if_model_fh_available(model_name, timestamp, fh):
                     indentLevel=1, model=model_name)
 
     except Exception as e:
+        http_manager.record(url, datetime.now().timestamp() - started)
         log("× Not found -- Exception.", "DEBUG", remote=True,
             indentLevel=1, model=model_name)
         log(repr(e), "ERROR", indentLevel=1, remote=True)
     finally:
-        signal.alarm(0)
+        if use_alarm:
+            signal.alarm(0)
 
     return False
 
@@ -190,35 +324,37 @@ def get_base_filename(model_name, timestamp, var_level):
         return file
 
 
+def get_band_filename(model_name, timestamp, shorthand):
+    # Master TIFs stay in the run's build directory, see publish
+    return publish.get_build_dir(model_name, timestamp) + "/" + \
+        get_base_filename(model_name, timestamp, shorthand) + ".tif"
+
+
 # This iterates a fh by the appropriate step size,
 # given the fh. This is for models where the fh step size
 # increases after a certain hour.
 def add_appropriate_fh_step(model_name, fh, currentHr="00"):
+    next_fh = schedules.get_next_fh(schedules.get_fh_steps(
+        get_model(model_name).raw, currentHr), fh)
 
-    fhSteps = {}
+    if next_fh is None:
+        log("× Couldn't match the appropriate step size.",
+            "WARN", indentLevel=1, remote=True, model=model_name)
+        return fh
 
-    model = models[model_name]
-    if "fhStepManual" in model:
-        manualDef = model["fhStepManual"]
-        for fhDef in manualDef:
-            for hour in fhDef["appliesTo"]:
-                if hour == currentHr:
-                    fhSteps = fhDef["fhStep"]
-                    break
+    return next_fh
 
-            if bool(fhSteps):
-                break
 
-    else:
-        fhSteps = model["fhStep"]
+class Step:
+    __slots__ = ("fh", "band_num", "band", "retries", "inputs")
 
-    for key in reversed(sorted(fhSteps.keys(), key=lambda x: float(x))):
-        if fh >= int(key):
-            return fh + fhSteps[key]
-
-    log("× Couldn't match the appropriate step size.",
-        "WARN", indentLevel=1, remote=True, model=model_name)
-    return fh
+    def __init__(self, fh, band_num, band=None, inputs=()):
+        self.fh = fh
+        self.band_num = band_num
+        self.band = band
+        self.retries = 0
+        # Steps of the same fh that have to finish before this one can start
+        self.inputs = inputs
 
 
 def make_band_dict(model_name, hour):
@@ -227,82 +363,104 @@ def make_band_dict(model_name, hour):
 
     band_dict = {}
 
-    model = models[model_name]
-
-    fh = model["startTime"]
-    i = 1
-
+    model = get_model(model_name)
+    schedule = schedules.get_schedule(model_name, hour)
     bands = make_model_band_array(model_name)
+    flat_time = model.flat_time or model.flat_time_full_file
 
-    while True:
-        full_fh = get_full_fh(model_name, fh)
+    for i, full_fh in enumerate(schedule.full_fhs):
+        band_num = schedule.band_numbers[full_fh]
+        prev_fh = schedule.full_fhs[i - 1] if i > 0 else None
         if bands == None or len(bands) == 0:
-            band_dict.update({
-                full_fh: {
-                    'retries': 0,
-                    'fh': full_fh,
-                    'band_num': i,
-                    'processing': False
-                }
-            })
-        else:
-            for band in bands:
+            band_dict[full_fh] = Step(full_fh, band_num)
+            add_dependent_steps(band_dict, model, full_fh, band_num, prev_fh)
+            continue
+
+        fh = schedule.fhs[i]
+        for band in bands:
+            if flat_time:
+                band = band.copy()
+                time_val = fh
+                if model.anl and fh == model.start_time:
+                    time_val = "anl"
+
+                band["time"] = str(time_val)
+
+            band_dict[band["shorthand"] + "_" + full_fh] = Step(
+                full_fh, band_num, band)
+
+        add_dependent_steps(band_dict, model, full_fh, band_num, prev_fh)
+
+    log(f"Band dict created.", "NOTICE",
+        indentLevel=0, remote=True, model=model_name)
+
+    return band_dict
+
+
+def get_input_step(band_dict, shorthand, full_fh):
+    # A full file step writes every band of the fh at once
+    if shorthand + "_" + full_fh in band_dict:
+        return shorthand + "_" + full_fh
+    return full_fh
 
-                band_copy = band.copy()
 
-                vals = {
-                    'retries': 0,
-                    'fh': full_fh,
-                    'band_num': i,
-                    'band': band_copy,
-                    'processing': False
-                }
+# Steps made from bands we've already written, rather than from upstream
+LOCAL_STAGES = ("derived", "contours", "tiles")
 
-                if ("flatTime" in model and model["flatTime"]) or ("flatTimeFullFile" in model and model["flatTimeFullFile"]):
-                    time_val = fh
-                    if "anl" in model and fh == model["startTime"]:
-                        time_val = "anl"
 
-                    band_copy["time"] = str(time_val)
+def is_local_step(step):
+    return step.band is not None and any(stage in step.band for stage in LOCAL_STAGES)
 
-                band_dict.update({
-                    band["shorthand"] + "_" + full_fh: vals
-                })
-        fh = add_appropriate_fh_step(model_name, fh, hour)
-        i += 1
 
-        if fh > model["endTime"]:
-            log(f"Band dict created.", "NOTICE",
-                indentLevel=0, remote=True, model=model_name)
+def add_dependent_steps(band_dict, model, full_fh, band_num, prev_fh=None):
+    for derived in model.derived:
+        inputs = [get_input_step(band_dict, name, full_fh)
+                  for name in derived.expression.inputs]
+        # prev(name) reads the band the previous fh's step writes. The first
+        # fh starts from zeros, but still needs the band's TIF to exist.
+        inputs += [get_input_step(band_dict, name, prev_fh or full_fh)
+                   for name in derived.expression.prev_inputs]
+        inputs = tuple(dict.fromkeys(inputs))
+        band_dict[derived.name + "_" + full_fh] = Step(
+            full_fh, band_num, {"shorthand": derived.name, "derived": True}, inputs)
 
-            return band_dict
+    # Contours and tiles are made from the band once it's written
+    for output in model.bands + model.derived:
+        shorthand = output.name if output in model.derived else output.shorthand
+        for stage, settings in [("contours", output.contours), ("tiles", output.tiles)]:
+            if settings is None:
+                continue
+            band_dict[shorthand + "_" + stage + "_" + full_fh] = Step(
+                full_fh, band_num, {"shorthand": shorthand + "_" + stage, stage: shorthand},
+                (get_input_step(band_dict, shorthand, full_fh),))
 
 
 def make_model_band_array(model_name, force=False):
-    model = models[model_name]
-    if not "bands" in model:
+    model = get_model(model_name)
+    if not "bands" in model.raw:
         return None
 
-    model_band_array = []
-    if model["index"] or force:
-        for band in model["bands"]:
-            shorthand = band["var"].lower() + "_" + band["level"].lower()
-            if "output" in band:
-                shorthand += "_" + band["output"]
-            model_band_array.append({
-                "shorthand": shorthand,
-                "band": band
-            })
+    if model.index or force:
+        return list(model.band_array)
 
-    return model_band_array
+    return []
 
 
-def set_as_paused(model_name, full_fh):
+def set_as_paused(model_name, full_fh, timestamp=None):
+    if timestamp is None:
+        timestamp = get_model_timestamp(model_name)
+
+    resume_at = None
+    if timestamp is not None:
+        resume_at = arrivals.get_next_probe_time(model_name, timestamp, full_fh)
+
     conn, curr = pg.ConnectionPool.connect()
     try:
-        curr.execute("UPDATE wxdata.models SET (status,lastfh,paused_at) = (%s, %s, %s) WHERE model = %s",
-                     ("PAUSED", full_fh, datetime.now().isoformat(), model_name))
+        curr.execute("UPDATE wxdata.models SET (status,lastfh,paused_at,resume_at) = (%s, %s, %s, %s) WHERE model = %s",
+                     ("PAUSED", full_fh, clock.now(), resume_at, model_name))
         conn.commit()
+        update_model_state(model_name, status="PAUSED", lastfh=full_fh,
+                           paused_at=clock.now(), resume_at=resume_at)
     except:
         log("Couldn't set " + model_name + " to paused.", "ERROR", remote=True)
     finally:
@@ -315,6 +473,7 @@ def update_last_fh(model_name, full_fh):
         curr.execute("UPDATE wxdata.models SET lastfh = %s WHERE model = %s",
                      (full_fh, model_name))
         conn.commit()
+        update_model_state(model_name, lastfh=full_fh)
     except Exception as e:
         print(repr(e))
         log("Couldn't update model's last fh " +
@@ -329,6 +488,7 @@ def mark_model_as_complete(model_name, timestamp):
         curr.execute(
             "UPDATE wxdata.models SET status = %s WHERE model = %s", ("WAITING", model_name))
         conn.commit()
+        update_model_state(model_name, status="WAITING")
 
         curr.execute(
             "UPDATE wxdata.run_status SET status = 'COMPLETE' WHERE model = %s AND timestamp = %s", (model_name, timestamp))
@@ -342,33 +502,57 @@ def mark_model_as_complete(model_name, timestamp):
 
 
 def mark_model_as_processing(model_name, timestamp):
-    conn, curr = pg.ConnectionPool.connect()
-    formatted_timestamp = timestamp.strftime('%Y%m%d_%HZ')
-    try:
-        log(f"· Start processing {model_name} | {formatted_timestamp}.",
-            "INFO", indentLevel=1, remote=True, model=model_name)
+    mark_models_as_processing([(model_name, timestamp)])
 
-        curr.execute("UPDATE wxdata.models SET (status, timestamp) = (%s, %s) WHERE model = %s",
-                     ("PROCESSING", timestamp, model_name))
-        conn.commit()
 
-        curr.execute(
-            "DELETE FROM wxdata.run_status WHERE model = %s AND timestamp = %s", (model_name, timestamp))
-        conn.commit()
+def mark_models_as_processing(runs):
+    conn = curr = None
+    try:
+        for model_name, timestamp in runs:
+            formatted_timestamp = timestamp.strftime('%Y%m%d_%HZ')
+            log(f"· Start processing {model_name} | {formatted_timestamp}.",
+                "INFO", indentLevel=1, remote=True, model=model_name)
 
-        curr.execute("INSERT INTO wxdata.run_status (model, status, timestamp) VALUES (%s, %s, %s)",
-                     (model_name, "PROCESSING", timestamp))
+        conn, curr = pg.ConnectionPool.connect()
+        execute_values(curr, '''
+            UPDATE wxdata.models AS m SET (status, timestamp) = ('PROCESSING', v.timestamp)
+            FROM (VALUES %s) AS v (model, timestamp)
+            WHERE m.model = v.model''', runs, template="(%s, %s::timestamptz)")
+
+        execute_values(curr, '''
+            DELETE FROM wxdata.run_status AS r
+            USING (VALUES %s) AS v (model, timestamp)
+            WHERE r.model = v.model AND r.timestamp = v.timestamp''', runs, template="(%s, %s::timestamptz)")
+
+        execute_values(curr, "INSERT INTO wxdata.run_status (model, status, timestamp) VALUES %s",
+                       [(model_name, "PROCESSING", timestamp) for model_name, timestamp in runs])
         conn.commit()
+
+        for model_name, timestamp in runs:
+            update_model_state(model_name, status="PROCESSING",
+                               timestamp=timestamp)
     except:
         log("Could not set the model status back to processing! This requires manual intervention.",
             "ERROR", remote=True)
     finally:
-        pg.ConnectionPool.close(conn, curr)
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
 
 
 def finish_model(model_name, timestamp):
     log(model_name + " is completely finished processing.",
         "NOTICE", remote=True)
+    failed_steps = progress.get_failed_steps(model_name, timestamp)
+    if failed_steps:
+        log(f"{str(len(failed_steps))} steps failed permanently for {model_name}: " +
+            ", ".join(sorted(band + "@" + fh if band else fh for fh, band in failed_steps)),
+            "WARN", remote=True, model=model_name)
+    zarr_store.consolidate(model_name, timestamp)
+    publish.publish(model_name, timestamp, failed_steps)
     mark_model_as_complete(model_name, timestamp)
     file_tools.clean()
     pg.clean()
+    progress.clean()
+    arrivals.forget_run(model_name, timestamp)
+    arrivals.clean()
+    metrics.clean()
@@ -0,0 +1,40 @@
+from .logger import log
+
+from . import points
+from . import zarr_store
+
+'''
+    Extra outputs fed from the windows of a band as it's written to its
+    master TIF (see raster_tools.copy_band and derived.derive_band), so
+    they don't read the band back. A sink has write(x, y, values, nodata)
+    called for every window, in real values unless the band is stored
+    as-is, and close() once the band is done.
+
+    A sink that can't be opened is logged and skipped; the TIF is what
+    matters.
+'''
+
+
+def open_sinks(model_name, timestamp, shorthand, band_num, dataset):
+    sinks = []
+    for name, open_sink in [("point series", points.open_sampler),
+                            ("Zarr store", zarr_store.open_writer)]:
+        try:
+            sink = open_sink(model_name, timestamp, shorthand, band_num, dataset)
+            if sink is not None:
+                sinks.append(sink)
+        except Exception as e:
+            log(f"× Couldn't open the {name} for {shorthand}.",
+                "WARN", indentLevel=2, remote=True, model=model_name)
+            log(repr(e), "ERROR", indentLevel=2, remote=True, model=model_name)
+    return sinks
+
+
+def close_sinks(model_name, sinks):
+    for sink in sinks:
+        try:
+            sink.close()
+        except Exception as e:
+            log(f"× Couldn't close {sink.filename}.",
+                "WARN", indentLevel=2, remote=True, model=model_name)
+            log(repr(e), "ERROR", indentLevel=2, remote=True, model=model_name)
@@ -4,32 +4,106 @@ from datetime import datetime
 import psycopg2
 from psycopg2 import pool
 import os
+import time
 
 pid = str(os.getpid())
 
 
 '''
-    This used to be a nice singleton that managed a threaded connection pool.
-    So you wouldn't have to re-connect to run queries and whatnot.
-    But since I moved to multiprocessing, this fails with SSL errors
-    due to attempting to copy the connection between processes.
-
-    So now it's just a shell of itself.
-    Maybe somebody smarter than me can figure out a better way of managing
-    a single psql connection between multiple processes.
+    Each process gets its own pool of persistent connections.
+
+    Connections can't be shared between processes (the SSL state gets
+    copied on fork and both sides end up talking over the same socket), so
+    the pool remembers which pid created it. When a forked worker asks for
+    a connection, the inherited pool is set aside untouched and a fresh one
+    is created lazily in the child. Connections are health checked when
+    they're checked out and replaced if they've gone bad.
+
+    ConnectionPool.close() hands the connection back to the pool rather
+    than closing it, so call sites keep the connect()/close() pattern.
 '''
 
 
 class ConnectionPool:
     __instance = None
+    __pid = None
+    __last_used = {}
+
+    # Pools inherited across a fork. We keep a reference so they're never
+    # garbage collected (which would close the parent's sockets).
+    __orphans = []
+
+    @staticmethod
+    def get_pool():
+        current_pid = os.getpid()
+        if ConnectionPool.__instance is None or ConnectionPool.__pid != current_pid:
+            if ConnectionPool.__instance is not None:
+                ConnectionPool.__orphans.append(ConnectionPool.__instance)
+
+            ConnectionPool.__instance = pool.ThreadedConnectionPool(
+                0,
+                ConnectionPool.get_max_connections(),
+                host=config["postgres"]["host"],
+                port=5432,
+                dbname=config["postgres"]["db"],
+                user=config["postgres"]["user"],
+                sslmode="require")
+            ConnectionPool.__pid = current_pid
+            ConnectionPool.__last_used = {}
+
+        return ConnectionPool.__instance
+
+    @staticmethod
+    def get_max_connections():
+        # Room for every discovery thread, the log shipper and the main
+        # thread at once, so a discovery pass never overflows the pool.
+        # Connections are only opened when they're needed, so workers
+        # don't pay for the extra room.
+        return max(config["postgres"].get("maxConnections", 4),
+                   config.get("discoveryThreads", 8) + 2)
+
+    @staticmethod
+    def is_healthy(conn):
+        if conn.closed:
+            return False
+
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+
+        try:
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+
+            last_used = ConnectionPool.__last_used.get(id(conn), time.time())
+            if time.time() - last_used > config["postgres"].get("healthCheckSeconds", 30):
+                curr = conn.cursor()
+                curr.execute("SELECT 1")
+                curr.close()
+                conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
 
     @staticmethod
     def connect():
-        conn = psycopg2.connect(host=config["postgres"]["host"],
-                                port=5432,
-                                dbname=config["postgres"]["db"],
-                                user=config["postgres"]["user"],
-                                sslmode="require")
+        conn_pool = ConnectionPool.get_pool()
+        try:
+            conn = conn_pool.getconn()
+        except pool.PoolError:
+            log("Connection pool exhausted, opening an unpooled connection.", "DEBUG")
+            conn = psycopg2.connect(host=config["postgres"]["host"],
+                                    port=5432,
+                                    dbname=config["postgres"]["db"],
+                                    user=config["postgres"]["user"],
+                                    sslmode="require")
+            return conn, conn.cursor()
+
+        if not ConnectionPool.is_healthy(conn):
+            log("Replacing a dead pg connection.", "DEBUG")
+            conn_pool.putconn(conn, close=True)
+            conn = conn_pool.getconn()
 
         curr = conn.cursor()
         return conn, curr
@@ -38,15 +112,41 @@ class ConnectionPool:
     def close(conn, curr):
         try:
             curr.close()
-            conn.close()
         except:
-            log("Couldn't close pool", "DEBUG")
+            pass
 
-    def __init__(self):
-        if ConnectionPool.__instance == None:
-            ConnectionPool.__instance = self
+        try:
+            if ConnectionPool.__pid != os.getpid():
+                raise pool.PoolError("connection from another process")
+
+            broken = conn.closed or conn.get_transaction_status(
+            ) == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+            if not broken and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+
+            ConnectionPool.__last_used[id(conn)] = time.time()
+            ConnectionPool.__instance.putconn(conn, close=broken)
+        except pool.PoolError:
+            # Not one of ours (an overflow connection), just close it.
+            try:
+                conn.close()
+            except:
+                log("Couldn't close connection", "DEBUG")
+        except:
+            log("Couldn't return connection to the pool", "DEBUG")
+
+    @staticmethod
+    def close_all():
+        if ConnectionPool.__instance is not None and ConnectionPool.__pid == os.getpid():
+            try:
+                ConnectionPool.__instance.closeall()
+            except:
+                log("Couldn't close pool", "DEBUG")
+            ConnectionPool.__instance = None
+            ConnectionPool.__pid = None
 
-        #log("Making new pg connection pool...", "NOTICE")
+    def __init__(self):
+        ConnectionPool.get_pool()
 
 
 def add_agent():
@@ -117,6 +217,8 @@ def connect():
             config["postgres"]["host"] + "]", "INFO")
 
         ConnectionPool()
+        conn, curr = ConnectionPool.connect()
+        ConnectionPool.close(conn, curr)
 
         return True
 
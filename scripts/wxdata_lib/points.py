@@ -0,0 +1,166 @@
+from .config import config, get_model
+
+from . import model_tools as model_tools
+from . import schedules
+from . import publish
+import json
+import os
+
+import numpy as np
+
+'''
+    Point time series, sampled at ingest for the `points` in the config so
+    a point forecast is one contiguous read instead of a pixel from every
+    band of every TIF.
+
+    Each (model, run) gets a float32 array file laid out as
+    [point][variable][fh], next to a JSON header listing the points inside
+    the model's grid, the variables and the fhs. All of a point's values are
+    one run of bytes: (point index * variables * fhs) floats in. Missing
+    values are NaN.
+
+    Values are picked out of the windows as bands are written to the
+    master TIFs (see raster_tools.copy_band), with vectorized indexing, so
+    sampling doesn't read anything again.
+'''
+
+
+def get_series_filename(model_name, timestamp, run_dir=None):
+    if run_dir is None:
+        run_dir = publish.get_publish_dir(model_name, timestamp)
+    return run_dir + "/points/" + \
+        model_tools.get_base_filename(model_name, timestamp, None) + ".f32"
+
+
+def get_output_names(model):
+    return [band.shorthand for band in model.bands] + [derived.name for derived in model.derived]
+
+
+def make_header(model_name, timestamp, geo_transform, width, height):
+    model = get_model(model_name)
+    schedule = schedules.get_schedule(model_name, timestamp.strftime("%H"))
+
+    points = []
+    for point in config.get("points", []):
+        col = int((point["lon"] - geo_transform[0]) // geo_transform[1])
+        row = int((point["lat"] - geo_transform[3]) // geo_transform[5])
+        if 0 <= col < width and 0 <= row < height:
+            points.append({"id": point["id"], "lat": point["lat"], "lon": point["lon"],
+                           "row": row, "col": col})
+
+    return {
+        "model": model_name,
+        "run": timestamp.strftime("%Y%m%d%H"),
+        "layout": ["point", "variable", "fh"],
+        "dtype": "float32",
+        "points": points,
+        "variables": get_output_names(model),
+        "fhs": list(schedule.full_fhs)
+    }
+
+
+def get_shape(header):
+    return (len(header["points"]), len(header["variables"]), len(header["fhs"]))
+
+
+def get_header_filename(filename):
+    return filename[:-len(".f32")] + ".json"
+
+
+def load_header(filename):
+    with open(get_header_filename(filename)) as f:
+        return json.load(f)
+
+
+def create_store(filename, header):
+    # Workers on the same run may race to create it. Whoever links the
+    # array into place first wins; the header is the same either way, and
+    # it's in place before the array is.
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    staged = filename + "." + str(os.getpid())
+    with open(staged + ".json", "w") as f:
+        json.dump(header, f)
+    values = np.memmap(staged, dtype=np.float32, mode="w+", shape=get_shape(header))
+    values[:] = np.nan
+    values.flush()
+    del values
+
+    try:
+        os.replace(staged + ".json", get_header_filename(filename))
+        os.link(staged, filename)
+    except FileExistsError:
+        pass
+    finally:
+        for leftover in [staged, staged + ".json"]:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+class PointSampler:
+    def __init__(self, filename, header, variable, band_num):
+        self.filename = filename
+        self.variable = header["variables"].index(variable)
+        self.fh = band_num - 1
+        self.rows = np.array([point["row"] for point in header["points"]], dtype=np.int64)
+        self.cols = np.array([point["col"] for point in header["points"]], dtype=np.int64)
+        self.samples = np.full(len(header["points"]), np.nan, dtype=np.float32)
+        self.shape = get_shape(header)
+
+    def write(self, x, y, values, nodata=None):
+        h, w = values.shape
+        inside = (self.rows >= y) & (self.rows < y + h) & (self.cols >= x) & (self.cols < x + w)
+        if not inside.any():
+            return
+        picked = values[self.rows[inside] - y, self.cols[inside] - x].astype(np.float32)
+        if nodata is not None:
+            picked[picked == np.float32(nodata)] = np.nan
+        self.samples[inside] = picked
+
+    def close(self):
+        values = np.memmap(self.filename, dtype=np.float32, mode="r+", shape=self.shape)
+        values[:, self.variable, self.fh] = self.samples
+        values.flush()
+        del values
+
+
+def open_sampler(model_name, timestamp, shorthand, band_num, dataset):
+    if len(config.get("points", [])) == 0:
+        return None
+
+    filename = get_series_filename(model_name, timestamp)
+    if not os.path.exists(filename):
+        header = make_header(model_name, timestamp, dataset.GetGeoTransform(),
+                             dataset.RasterXSize, dataset.RasterYSize)
+        create_store(filename, header)
+
+    header = load_header(filename)
+    if shorthand not in header["variables"] or len(header["points"]) == 0 or band_num > len(header["fhs"]):
+        return None
+
+    return PointSampler(filename, header, shorthand, band_num)
+
+
+'''
+    A point's whole forecast: {variable: [value per fh]}, with the fhs.
+'''
+
+
+def read_series(model_name, timestamp, point_id):
+    filename = get_series_filename(
+        model_name, timestamp, publish.get_run_dir(model_name, timestamp))
+    header = load_header(filename)
+    ids = [point["id"] for point in header["points"]]
+    if point_id not in ids:
+        return None
+
+    variables, fhs = len(header["variables"]), len(header["fhs"])
+    with open(filename, "rb") as f:
+        f.seek(ids.index(point_id) * variables * fhs * 4)
+        values = np.frombuffer(f.read(variables * fhs * 4), dtype=np.float32)
+
+    values = values.reshape(variables, fhs)
+    return {
+        "fhs": header["fhs"],
+        "values": {variable: [None if np.isnan(value) else float(value) for value in values[i]]
+                   for i, variable in enumerate(header["variables"])}
+    }
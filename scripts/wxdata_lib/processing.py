@@ -1,13 +1,25 @@
-from .config import config, models
+from .config import config, get_model
 from .logger import log
 
 from . import model_tools as model_tools
 from . import pg_connection_manager as pg
-from .http_manager import http
+from . import download_cache
+from . import mirrors
+from . import http_manager
+from . import metrics
+from . import raster_tools
+from . import outputs
+from . import publish
+from . import derived
+from . import contours
+from . import tiles
+from . import clock
+from . import schedules
 import subprocess
 import sys
 
 from datetime import datetime, timedelta, tzinfo, time
+from email.utils import parsedate_to_datetime
 import os
 import random
 import requests
@@ -24,20 +36,56 @@ def timeout_handler(signum, frame):
     raise TimeoutException
 
 
+# Stats for the step currently being processed by this worker.
+step_stats = {
+    "bytes": 0,
+    "seen_at": None,
+    "upstream_at": None
+}
+
+
+def reset_step_stats():
+    step_stats["bytes"] = 0
+    step_stats["seen_at"] = None
+    step_stats["upstream_at"] = None
+
+
 def process(step, model_name, timestamp):
 
+    reset_step_stats()
     log("· Trying to process a step in model " + model_name, "INFO")
-    full_fh = step['fh']
-    band_num = step['band_num']
+    full_fh = step.fh
+    band_num = step.band_num
 
     log("Preparing to process " + model_name + " | fh: " + full_fh, "INFO")
 
     band = None
     band_info_str = ' | (no var/level)'
-    if 'band' in step:
-        band = step['band']
+    if step.band is not None:
+        band = step.band
         band_info_str = ' | band ' + band['shorthand']
 
+    if band is not None and band.get("derived"):
+        log("Deriving for " + model_name + " | fh: " + full_fh +
+            band_info_str, "NOTICE", remote=True, model=model_name)
+        if not derived.derive_band(model_name, timestamp, full_fh, band, band_num):
+            return 'FAIL'
+        return 'OK'
+
+    if band is not None and band.get("contours"):
+        log("Contouring for " + model_name + " | fh: " + full_fh +
+            band_info_str, "INFO", remote=True, model=model_name)
+        if not contours.generate(model_name, timestamp, full_fh, band, band_num):
+            return 'FAIL'
+        return 'OK'
+
+    if band is not None and band.get("tiles"):
+        log("Rendering tiles for " + model_name + " | fh: " + full_fh +
+            band_info_str, "INFO", remote=True, model=model_name)
+        if not tiles.generate(model_name, timestamp, full_fh, band, band_num):
+            return 'FAIL'
+        return 'OK'
+
     file_exists = model_tools.check_if_model_fh_available(
         model_name, timestamp, full_fh)
 
@@ -46,6 +94,8 @@ def process(step, model_name, timestamp):
             full_fh + band_info_str, 'NOTICE', remote=True, model=model_name)
         return 'PAUSE'
 
+    step_stats["seen_at"] = clock.now()
+
     log("Processing for " + model_name + " | fh: " + full_fh +
         band_info_str, "NOTICE", remote=True, model=model_name)
 
@@ -74,106 +124,69 @@ def process(step, model_name, timestamp):
 
 
 def download_band(model_name, timestamp, fh, band, band_num):
-    model = models[model_name]
+    model = get_model(model_name)
 
-    url = model_tools.make_url(model_name, timestamp.strftime(
+    urls = model_tools.make_urls(model_name, timestamp.strftime(
         "%Y%m%d"), timestamp.strftime("%H"), fh)
 
     file_name = model_tools.get_base_filename(
         model_name, timestamp, band["shorthand"])
-    target_dir = config["mapfileDir"] + "/" + model_name + "/"
+    target_dir = publish.get_build_dir(model_name, timestamp) + "/"
     download_filename = config["tempDir"] + "/" + \
-        file_name + "_t" + fh + "." + model["filetype"]
+        file_name + "_t" + fh + "." + model.filetype
     target_filename = target_dir + file_name + ".tif"
 
-    try:
-        signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(10)
-        try:
-            response = requests.head(url, timeout=(10, 30))
-        except TimeoutException:
-            raise Exception("Timeout alarm tripped")
-        except:
-            raise
-        else:
-            signal.alarm(0)
-        if response.status_code != 200 or response.status_code == None or response == None:
-            log(f"· This index file is not ready yet. " + url,
+    # The byte range comes from the mirror's own .idx, so each attempt
+    # sticks to one mirror from HEAD to download
+    for i, url in enumerate(urls):
+        if i > 0:
+            log(f"· Failing over to {mirrors.get_host(url)}.",
                 "WARN", remote=True, indentLevel=2, model=model_name)
-            return False
-
-        content_length = str(response.headers["Content-Length"])
-    except Exception as e:
-        log(f"· Couldn't get header of " + url, "ERROR",
-            remote=True, indentLevel=2, model=model_name)
-        log(repr(e), "ERROR")
-        return False
-
-    byte_range = get_byte_range(band, url + ".idx", content_length)
-
-    if not byte_range or byte_range == None:
-        log(f"· Band {band['shorthand']} doesn't exist for fh {fh}.",
-            "WARN", remote=True, indentLevel=2, model=model_name)
-        return False
-
-    log(f"↓ Downloading band {band['shorthand']} for fh {fh}.",
-        "INFO", indentLevel=2, remote=True, model=model_name)
-    try:
-        response = http.request('GET', url,
-                                headers={
-                                    'Range': 'bytes=' + byte_range
-                                },
-                                retries=5)
-
-        with open(download_filename, 'wb') as f:
-            f.write(response.data)
-
-    except Exception as e:
-        log("Couldn't read the band -- the request likely timed out. " +
-            fh, "ERROR", indentLevel=2, remote=True, model=model_name)
-
-        log(repr(e), "ERROR", remote=True, model=model_name)
+        if download_band_from(model_name, url, fh, band, download_filename):
+            break
+    else:
         return False
 
     log(f"✓ Downloaded band {band['shorthand']} for fh {fh}.",
         "INFO", indentLevel=2, remote=True, model=model_name)
 
-    bounds = config["bounds"][model["bounds"]]
+    bounds = model.bounds
     epsg4326 = osr.SpatialReference()
     epsg4326.ImportFromEPSG(4326)
 
     log("· Warping downloaded data.", "INFO",
         indentLevel=2, remote=True, model=model_name)
     try:
-        if "customTranslate" in model:
-
-            p = subprocess.run(
-                model["customTranslate"] + [
-                    model["customPathPrefix"] + download_filename,
-                    model["customPathPrefix"] +
-                    download_filename + "_staged.tif",
-                    "-co", "interleave=band", "-co", "bigtiff=yes"],
-                close_fds=True,
-                timeout=3600,
-                bufsize=-1
-            )
+        if model.custom_translate is not None:
+
+            with metrics.span("translate"):
+                p = subprocess.run(
+                    model.custom_translate + [
+                        model.custom_path_prefix + download_filename,
+                        model.custom_path_prefix +
+                        download_filename + "_staged.tif",
+                        "-co", "interleave=band", "-co", "bigtiff=yes"],
+                    close_fds=True,
+                    timeout=3600,
+                    bufsize=-1
+                )
 
             grib_file = gdal.Open(download_filename + "_staged.tif")
 
         else:
             grib_file = gdal.Open(download_filename)
 
-        out_file = gdal.Warp(
-            download_filename + ".tif",
-            grib_file,
-            format='GTiff',
-            outputBounds=[bounds["left"], bounds["bottom"],
-                          bounds["right"], bounds["top"]],
-            dstSRS=epsg4326,
-            creationOptions=["BIGTIFF=YES", "INTERLEAVE=BAND"],
-            resampleAlg=gdal.GRA_CubicSpline)
-        out_file.FlushCache()
-        out_file = None
+        with metrics.span("warp"):
+            out_file = gdal.Warp(
+                download_filename + ".tif",
+                grib_file,
+                format='GTiff',
+                outputBounds=bounds.as_list(),
+                dstSRS=epsg4326,
+                creationOptions=["BIGTIFF=YES", "INTERLEAVE=BAND"],
+                resampleAlg=gdal.GRA_CubicSpline)
+            out_file.FlushCache()
+            out_file = None
 
         grib_file = None
     except subprocess.CalledProcessError as e:
@@ -199,21 +212,12 @@ def download_band(model_name, timestamp, fh, band, band_num):
             model_name, timestamp.strftime("%H"))
 
         try:
-            grib_file = gdal.Open(download_filename + ".tif")
-            geo_transform = grib_file.GetGeoTransform()
-            width = grib_file.RasterXSize
-            height = grib_file.RasterYSize
-
-            new_raster = gdal.GetDriverByName('MEM').Create(
-                '', width, height, num_bands, gdal.GDT_Float32)
-            new_raster.SetProjection(grib_file.GetProjection())
-            new_raster.SetGeoTransform(list(geo_transform))
-            gdal.GetDriverByName('GTiff').CreateCopy(
-                target_filename, new_raster, 0)
+            with metrics.span("create"):
+                raster_tools.create_master(
+                    target_filename, download_filename + ".tif", num_bands,
+                    model.get_storage(band["shorthand"]))
             log("✓ Output master TIF created --> " + target_filename, "NOTICE",
                 indentLevel=1, remote=True, model=model_name)
-            new_raster = None
-            grib_file = None
         except Exception as e:
             log("Couldn't create the new master TIF: " + target_filename,
                 "ERROR", indentLevel=1, remote=True, model=model_name)
@@ -223,22 +227,24 @@ def download_band(model_name, timestamp, fh, band, band_num):
     log(f"· Writing data to the GTiff | band: {band['shorthand']} | fh: {fh} | band_number: {str(band_num)}",
         "INFO", indentLevel=2, remote=True, model=model_name)
 
-    sub_band_num = 1
-    if "subBandNum" in band["band"]:
-        sub_band_num = band["band"]["subBandNum"]
+    sub_band_num = band["config"].sub_band_num or 1
 
     try:
         # Copy the downloaded band to this temp file
-        grib_file = gdal.Open(download_filename + ".tif")
-        data = grib_file.GetRasterBand(sub_band_num).ReadAsArray()
-
-        tif = gdal.Open(target_filename, gdalconst.GA_Update)
-        tif.GetRasterBand(band_num).WriteArray(data)
-        tif.FlushCache()
+        with metrics.span("write"):
+            grib_file = gdal.Open(download_filename + ".tif")
+            tif = gdal.Open(target_filename, gdalconst.GA_Update)
+            sinks = outputs.open_sinks(
+                model_name, timestamp, band["shorthand"], band_num, tif)
+            raster_tools.copy_band(grib_file.GetRasterBand(
+                sub_band_num), tif.GetRasterBand(band_num), sinks)
+            tif.FlushCache()
+            outputs.close_sinks(model_name, sinks)
+            raster_tools.extract_band(tif, band_num, publish.get_fh_filename(
+                model_name, timestamp, band["shorthand"], fh))
 
         grib_file = None
         tif = None
-        data = None
         log(f"✓ Data written to the GTiff | band: {band['shorthand']} | fh: {fh}.",
             "INFO", indentLevel=2, remote=True, model=model_name)
     except Exception as e:
@@ -277,6 +283,66 @@ def download_band(model_name, timestamp, fh, band, band_num):
     return True
 
 
+def download_band_from(model_name, url, fh, band, download_filename):
+    started = datetime.now().timestamp()
+    try:
+        signal.signal(signal.SIGALRM, timeout_handler)
+        signal.alarm(10)
+        try:
+            with metrics.span("head"):
+                response = requests.head(url, timeout=(10, 30))
+        except TimeoutException:
+            raise Exception("Timeout alarm tripped")
+        except:
+            raise
+        finally:
+            # Left armed, it would go off in the middle of the next mirror
+            signal.alarm(0)
+        http_manager.record(url, datetime.now().timestamp() - started,
+                            response.status_code)
+        if response.status_code != 200 or response.status_code == None or response == None:
+            log(f"· This index file is not ready yet. " + url,
+                "WARN", remote=True, indentLevel=2, model=model_name)
+            return False
+
+        content_length = str(response.headers["Content-Length"])
+        validators = download_cache.get_validators(response.headers)
+        if validators["last_modified"]:
+            step_stats["upstream_at"] = parsedate_to_datetime(
+                validators["last_modified"])
+    except Exception as e:
+        http_manager.record(url, datetime.now().timestamp() - started)
+        log(f"· Couldn't get header of " + url, "ERROR",
+            remote=True, indentLevel=2, model=model_name)
+        log(repr(e), "ERROR")
+        return False
+
+    with metrics.span("idx"):
+        byte_range = get_byte_range(band, url + ".idx", content_length)
+
+    if not byte_range or byte_range == None:
+        log(f"· Band {band['shorthand']} doesn't exist for fh {fh}.",
+            "WARN", remote=True, indentLevel=2, model=model_name)
+        return False
+
+    log(f"↓ Downloading band {band['shorthand']} for fh {fh}.",
+        "INFO", indentLevel=2, remote=True, model=model_name)
+    try:
+        with metrics.span("download") as s:
+            s["bytes"] = download_cache.fetch_to(
+                url, download_filename, byte_range=byte_range, validators=validators)
+        step_stats["bytes"] += s["bytes"]
+
+    except Exception as e:
+        log("Couldn't read the band -- the request likely timed out. " +
+            fh, "ERROR", indentLevel=2, remote=True, model=model_name)
+
+        log(repr(e), "ERROR", remote=True, model=model_name)
+        return False
+
+    return True
+
+
 '''
     Downloads a full GRIB2 file for a timestamp, then extracts each var/level
     to convert to separate TIF libraries.
@@ -284,15 +350,15 @@ def download_band(model_name, timestamp, fh, band, band_num):
 
 
 def download_full_file(model_name, timestamp, fh, band_num):
-    model = models[model_name]
+    model = get_model(model_name)
 
-    url = model_tools.make_url(model_name, timestamp.strftime(
+    urls = model_tools.make_urls(model_name, timestamp.strftime(
         "%Y%m%d"), timestamp.strftime("%H"), fh)
 
     file_name = model_tools.get_base_filename(model_name, timestamp, None)
-    target_dir = config["mapfileDir"] + "/" + model_name + "/"
+    target_dir = publish.get_build_dir(model_name, timestamp) + "/"
     download_filename = config["tempDir"] + "/" + \
-        file_name + "_t" + fh + "." + model["filetype"]
+        file_name + "_t" + fh + "." + model.filetype
 
     try:
         os.makedirs(target_dir)
@@ -302,25 +368,30 @@ def download_full_file(model_name, timestamp, fh, band_num):
 
     log(f"↓ Downloading fh {fh}.", "INFO",
         indentLevel=2, remote=True, model=model_name)
-    try:
-        response = http.request('GET', url, retries=5)
-        log("Url: " + url, "DEBUG", indentLevel=2)
-        log("Download: " + download_filename, "DEBUG", indentLevel=2)
-
-        with open(download_filename, 'wb') as f:
-            f.write(response.data)
+    for i, url in enumerate(urls):
+        try:
+            log("Url: " + url, "DEBUG", indentLevel=2)
+            log("Download: " + download_filename, "DEBUG", indentLevel=2)
 
-        del response
+            with metrics.span("download") as s:
+                # Whole files would push every band out of the cache
+                s["bytes"] = download_cache.fetch_to(url, download_filename, cache=False)
+            step_stats["bytes"] += s["bytes"]
 
-        log(f"✓ Downloaded band fh {fh}.", "INFO",
-            indentLevel=2, remote=True, model=model_name)
-    except Exception as e:
-        log("Couldn't read the fh -- the request likely timed out. " +
-            fh, "ERROR", indentLevel=2, remote=True, model=model_name)
-        log(repr(e), "ERROR", indentLevel=2, remote=True, model=model_name)
+            log(f"✓ Downloaded band fh {fh}.", "INFO",
+                indentLevel=2, remote=True, model=model_name)
+            break
+        except Exception as e:
+            log("Couldn't read the fh -- the request likely timed out. " +
+                fh, "ERROR", indentLevel=2, remote=True, model=model_name)
+            log(repr(e), "ERROR", indentLevel=2, remote=True, model=model_name)
+            if i + 1 < len(urls):
+                log(f"· Failing over to {mirrors.get_host(urls[i + 1])}.",
+                    "WARN", remote=True, indentLevel=2, model=model_name)
+    else:
         return False
 
-    bounds = config["bounds"][model["bounds"]]
+    bounds = model.bounds
 
     try:
         epsg4326 = osr.SpatialReference()
@@ -333,17 +404,18 @@ def download_full_file(model_name, timestamp, fh, band_num):
         except:
             log("· No old file to remove.", "DEBUG", indentLevel=2)
 
-        if "customTranslate" in model:
-            p = subprocess.run(
-                model["customTranslate"] + [
-                    model["customPathPrefix"] + download_filename,
-                    model["customPathPrefix"] +
-                    download_filename + "_staged.tif",
-                    "-co", "interleave=band", "-co", "bigtiff=yes"],
-                close_fds=True,
-                timeout=3600,
-                bufsize=-1
-            )
+        if model.custom_translate is not None:
+            with metrics.span("translate"):
+                p = subprocess.run(
+                    model.custom_translate + [
+                        model.custom_path_prefix + download_filename,
+                        model.custom_path_prefix +
+                        download_filename + "_staged.tif",
+                        "-co", "interleave=band", "-co", "bigtiff=yes"],
+                    close_fds=True,
+                    timeout=3600,
+                    bufsize=-1
+                )
             filename = download_filename + "_staged.tif"
         else:
             filename = download_filename
@@ -351,17 +423,17 @@ def download_full_file(model_name, timestamp, fh, band_num):
         log
         grib_file = gdal.Open(filename)
 
-        new_file = gdal.Warp(
-            download_filename + ".tif",
-            grib_file,
-            format='GTiff',
-            outputBounds=[bounds["left"], bounds["bottom"],
-                          bounds["right"], bounds["top"]],
-            dstSRS=epsg4326,
-            creationOptions=["BIGTIFF=YES", "INTERLEAVE=BAND"],
-            resampleAlg=gdal.GRA_CubicSpline)
-
-        del new_file
+        with metrics.span("warp"):
+            new_file = gdal.Warp(
+                download_filename + ".tif",
+                grib_file,
+                format='GTiff',
+                outputBounds=bounds.as_list(),
+                dstSRS=epsg4326,
+                creationOptions=["BIGTIFF=YES", "INTERLEAVE=BAND"],
+                resampleAlg=gdal.GRA_CubicSpline)
+
+            del new_file
         del grib_file
         del epsg4326
 
@@ -373,6 +445,7 @@ def download_full_file(model_name, timestamp, fh, band_num):
 
     num_bands = model_tools.get_number_of_hours(
         model_name, timestamp.strftime("%H"))
+    schedule = schedules.get_schedule(model_name, timestamp.strftime("%H"))
 
     bands = model_tools.make_model_band_array(model_name, force=True)
 
@@ -393,19 +466,10 @@ def download_full_file(model_name, timestamp, fh, band_num):
                     indentLevel=2, remote=True, model=model_name)
 
             try:
-                grib_file = gdal.Open(download_filename + ".tif")
-                geo_transform = grib_file.GetGeoTransform()
-                width = grib_file.RasterXSize
-                height = grib_file.RasterYSize
-
-                new_raster = gdal.GetDriverByName('MEM').Create(
-                    '', width, height, num_bands, gdal.GDT_Float32)
-                new_raster.SetProjection(grib_file.GetProjection())
-                new_raster.SetGeoTransform(list(geo_transform))
-                gdal.GetDriverByName('GTiff').CreateCopy(
-                    target_filename, new_raster, 0)
-                grib_file = None
-                new_raster = None
+                with metrics.span("create"):
+                    raster_tools.create_master(
+                        target_filename, download_filename + ".tif", num_bands,
+                        model.get_storage(band["shorthand"]))
                 log("✓ Output master TIF created. --> " + target_filename, "NOTICE",
                     indentLevel=1, remote=True, model=model_name)
             except:
@@ -417,45 +481,54 @@ def download_full_file(model_name, timestamp, fh, band_num):
             "INFO", indentLevel=2, remote=True, model=model_name)
         # Copy the downloaded band to this temp file
         try:
-            grib_file = gdal.Open(download_filename + ".tif")
-            gribnum_bands = grib_file.RasterCount
-            band_level = model_tools.get_level_name_for_level(
-                band["band"]["level"], "gribName")
-            tif = gdal.Open(target_filename, gdalconst.GA_Update)
-            for i in range(1, gribnum_bands + 1):
-                try:
-                    file_band = grib_file.GetRasterBand(i)
-                    metadata = file_band.GetMetadata()
-                    if ((
-                            "ignoreBandVar" in model and
-                            model["ignoreBandVar"] == True
-                        ) or (
-                            metadata["GRIB_ELEMENT"].lower() == band["band"]["var"].lower() and
-                            metadata["GRIB_SHORT_NAME"].lower() == band_level.lower() and (
-                                "comment" not in band["band"] or
-                                band["band"]["comment"].lower(
-                                ) == metadata["GRIB_COMMENT"].lower()
-                            )
-                    )):
-                        log("· Band " + band["band"]["var"] + " found.",
-                            "DEBUG", indentLevel=2, remote=False)
-                        data = file_band.ReadAsArray()
-                        if "flatTimeFullFile" in model and model["flatTimeFullFile"] == True:
-                            tif.GetRasterBand(i).WriteArray(data)
-                        else:
-                            tif.GetRasterBand(band_num).WriteArray(data)
-                            break
-
-                except Exception as e:
-                    log(f"× Couldn't read GTiff band: #{str(i)} | fh: {fh}",
-                        "WARN", indentLevel=2, remote=True, model=model_name)
-                    log(repr(e), "ERROR")
-
-            tif.FlushCache()
+            with metrics.span("write"):
+                grib_file = gdal.Open(download_filename + ".tif")
+                gribnum_bands = grib_file.RasterCount
+                band_config = band["config"]
+                tif = gdal.Open(target_filename, gdalconst.GA_Update)
+                written = []
+                for i in range(1, gribnum_bands + 1):
+                    try:
+                        file_band = grib_file.GetRasterBand(i)
+                        metadata = file_band.GetMetadata()
+                        if (model.ignore_band_var or (
+                                metadata["GRIB_ELEMENT"].lower() == band_config.var.lower() and
+                                metadata["GRIB_SHORT_NAME"].lower() == band_config.grib_level.lower() and (
+                                    band_config.comment is None or
+                                    band_config.comment.lower(
+                                    ) == metadata["GRIB_COMMENT"].lower()
+                                )
+                        )):
+                            log("· Band " + band_config.var + " found.",
+                                "DEBUG", indentLevel=2, remote=False)
+                            if model.flat_time_full_file:
+                                sinks = outputs.open_sinks(
+                                    model_name, timestamp, band["shorthand"], i, tif)
+                                raster_tools.copy_band(
+                                    file_band, tif.GetRasterBand(i), sinks)
+                                outputs.close_sinks(model_name, sinks)
+                                written.append((i, schedule.full_fhs[i - 1]))
+                            else:
+                                sinks = outputs.open_sinks(
+                                    model_name, timestamp, band["shorthand"], band_num, tif)
+                                raster_tools.copy_band(
+                                    file_band, tif.GetRasterBand(band_num), sinks)
+                                outputs.close_sinks(model_name, sinks)
+                                written.append((band_num, fh))
+                                break
+
+                    except Exception as e:
+                        log(f"× Couldn't read GTiff band: #{str(i)} | fh: {fh}",
+                            "WARN", indentLevel=2, remote=True, model=model_name)
+                        log(repr(e), "ERROR")
+
+                tif.FlushCache()
+                for i, written_fh in written:
+                    raster_tools.extract_band(tif, i, publish.get_fh_filename(
+                        model_name, timestamp, band["shorthand"], written_fh))
 
             grib_file = None
             tif = None
-            data = None
             file_band = None
         except Exception as e:
             return False
@@ -497,15 +570,10 @@ def get_byte_range(band, idx_file, content_length):
     log(f"· Searching for band defs in index file {idx_file}",
         "DEBUG", indentLevel=2, remote=True)
     try:
-        response = http.request('GET', idx_file)
-        data = response.data.decode('utf-8')
-        var_name_to_find = band["band"]["var"]
-
-        if "idxVar" in band["band"]:
-            var_name_to_find = band["band"]["idxVar"]
-
-        level_to_find = model_tools.get_level_name_for_level(
-            band["band"]["level"], "idxName")
+        data = download_cache.fetch_bytes(idx_file).decode('utf-8')
+        band_config = band["config"]
+        var_name_to_find = band_config.idx_var
+        level_to_find = band_config.idx_level
 
         found = False
         start_byte = None
@@ -520,17 +588,17 @@ def get_byte_range(band, idx_file, content_length):
             time = parts[5]
 
             if found:
-                if "subBandNum" in band["band"] and band["band"]["subBandNum"] and not skipped_for_subband:
+                if band_config.sub_band_num and not skipped_for_subband:
                     skipped_for_subband = True
                 else:
                     end_byte = parts[1]
                     break
 
             if var_name == var_name_to_find and level == level_to_find:
-                if "hourRange" in band["band"]:
+                if band_config.hour_range is not None:
                     range_val = time.split(" ", 1)[0]
                     ranges = range_val.split("-")
-                    if (int(ranges[1]) - int(ranges[0])) != band["band"]["hourRange"] or "day" in time:
+                    if (int(ranges[1]) - int(ranges[0])) != band_config.hour_range or "day" in time:
                         continue
 
                 if "time" in band and "day" not in time:
@@ -541,11 +609,11 @@ def get_byte_range(band, idx_file, content_length):
                     if hr != band["time"]:
                         continue
 
-                if "comment" in band["band"]:
+                if band_config.comment is not None:
                     if len(parts) <= 6:
                         continue
 
-                    if band["band"]["comment"] != parts[6]:
+                    if band_config.comment != parts[6]:
                         continue
 
                 log("✓ Found.", "DEBUG", indentLevel=2, remote=False)
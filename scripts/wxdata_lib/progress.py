@@ -0,0 +1,108 @@
+from .config import config
+from .logger import log
+from . import pg_connection_manager as pg
+
+from datetime import datetime
+from psycopg2.extras import execute_values
+
+'''
+    Tracks the outcome of every (model, run, fh, band) step in
+    wxdata.band_progress so a paused or crashed run can resume exactly
+    where it left off. Rows are buffered in memory and written in batches.
+    Steps without a band (full file downloads) use an empty band name.
+'''
+
+pending = {}
+last_flushed = datetime.utcnow()
+
+
+def get_step_band(step):
+    if step.band is not None:
+        return step.band['shorthand']
+    return ''
+
+
+def record_step(model_name, timestamp, fh, band, status, retries=0, bytes=None, started_at=None, finished_at=None):
+    pending[(model_name, timestamp, fh, band)] = (
+        model_name, timestamp, fh, band, status, retries, bytes, started_at, finished_at)
+
+    if len(pending) >= config.get("progressBatchSize", 50) or \
+            (datetime.utcnow() - last_flushed).total_seconds() >= config.get("progressFlushSeconds", 10):
+        flush()
+
+
+def flush():
+    global pending, last_flushed
+    last_flushed = datetime.utcnow()
+    if len(pending) == 0:
+        return True
+
+    rows = list(pending.values())
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        execute_values(curr, '''
+            INSERT INTO wxdata.band_progress
+                (model, timestamp, fh, band, status, retries, bytes, started_at, finished_at)
+            VALUES %s
+            ON CONFLICT (model, timestamp, fh, band) DO UPDATE SET
+                status = EXCLUDED.status,
+                retries = EXCLUDED.retries,
+                bytes = EXCLUDED.bytes,
+                started_at = EXCLUDED.started_at,
+                finished_at = EXCLUDED.finished_at''', rows)
+        conn.commit()
+        pending = {}
+        return True
+    except Exception as e:
+        log("Couldn't write band progress.", "ERROR", remote=True)
+        log(repr(e), "ERROR", indentLevel=1)
+        return False
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+
+def get_steps_with_status(model_name, timestamp, status, flush_pending=True):
+    # Only the main process thread owns the pending buffer
+    if flush_pending:
+        flush()
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        curr.execute(
+            "SELECT fh, band FROM wxdata.band_progress WHERE model = %s AND timestamp = %s AND status = %s",
+            (model_name, timestamp, status))
+        return set((row[0], row[1]) for row in curr.fetchall())
+    except Exception as e:
+        log("Couldn't read band progress for " + model_name,
+            "ERROR", remote=True, model=model_name)
+        log(repr(e), "ERROR", indentLevel=1)
+        return None
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+
+def get_completed_steps(model_name, timestamp, flush_pending=True):
+    return get_steps_with_status(model_name, timestamp, "DONE", flush_pending)
+
+
+def get_failed_steps(model_name, timestamp):
+    return get_steps_with_status(model_name, timestamp, "FAILED")
+
+
+def clean():
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        curr.execute(
+            "DELETE FROM wxdata.band_progress WHERE timestamp < now() - interval '" + str(config["retentionDays"]) + " days'")
+        conn.commit()
+    except Exception as e:
+        log(f"· Couldn't delete old band progress.",
+            "WARN", indentLevel=0, remote=True)
+        log(repr(e), "WARN", indentLevel=0)
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
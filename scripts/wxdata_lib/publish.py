@@ -0,0 +1,232 @@
+from .config import config
+from .logger import log
+
+from . import schedules
+from . import clock
+from xml.sax.saxutils import escape
+import json
+import os
+
+from osgeo import gdal
+
+'''
+    Master TIFs are written in place, a band at a time, so nothing outside
+    wxdata reads them: they're built in <mapfileDir>/<model>/.build/<run>.
+
+    What's published is in <mapfileDir>/<model>/.runs/<run>, which shows
+    up as <mapfileDir>/<model>/<run>, a symlink to it, once the run's first
+    fh is published. Runs are named like their files, e.g. 20240101_06Z.
+    As soon as a band is written to its master TIF, it's also copied to a
+    file of its own, bands/<band>/<fh>.tif, which is written to a temporary
+    file and then replaced, and never changes afterwards.
+
+    Each fh is published as soon as it has no steps left. Every band gets
+    a VRT, named like its master TIF, with the fh's band pointing at its
+    file, and band numbers matching the master TIF's; fhs that aren't
+    published yet have no source and read as nodata. Then manifest.json
+    is rewritten with the fhs that are complete and the ones that aren't,
+    if steps failed for good, and <mapfileDir>/<model>/latest is swapped to
+    the newest run with a published fh. VRTs, the manifest and both
+    symlinks are written to a temporary file and swapped in with
+    os.replace, so readers never see anything half-written, and the bands
+    of fhs in the manifest never change.
+
+    The run's Zarr group and tiles live in their own directories (see
+    zarr_store and tiles) and aren't covered by the manifest.
+'''
+
+BUILD_DIR = ".build"
+RUNS_DIR = ".runs"
+BANDS_DIR = "bands"
+LATEST = "latest"
+MANIFEST = "manifest.json"
+
+
+def get_run_name(timestamp):
+    return timestamp.strftime("%Y%m%d_%HZ")
+
+
+def get_model_dir(model_name):
+    return config["mapfileDir"] + "/" + model_name
+
+
+def get_build_dir(model_name, timestamp):
+    return get_model_dir(model_name) + "/" + BUILD_DIR + "/" + get_run_name(timestamp)
+
+
+def get_publish_dir(model_name, timestamp):
+    return get_model_dir(model_name) + "/" + RUNS_DIR + "/" + get_run_name(timestamp)
+
+
+def get_run_dir(model_name, timestamp):
+    return get_model_dir(model_name) + "/" + get_run_name(timestamp)
+
+
+def get_fh_filename(model_name, timestamp, shorthand, fh):
+    return get_publish_dir(model_name, timestamp) + "/" + BANDS_DIR + "/" + shorthand + "/" + fh + ".tif"
+
+
+def get_vrt_name(model_name, timestamp, shorthand):
+    return model_name + "_" + get_run_name(timestamp) + "_" + shorthand + ".vrt"
+
+
+def replace_file(filename, text):
+    staged = filename + "." + str(os.getpid())
+    with open(staged, "w") as f:
+        f.write(text)
+    os.replace(staged, filename)
+
+
+def make_vrt(dataset, fh_files):
+    # fh_files holds a file (relative to the VRT) or None for every band
+    band = dataset.GetRasterBand(1)
+    data_type = gdal.GetDataTypeName(band.DataType)
+    properties = []
+    if band.GetNoDataValue() is not None:
+        properties.append(f"    <NoDataValue>{repr(band.GetNoDataValue())}</NoDataValue>")
+    if band.GetOffset() not in (None, 0.0):
+        properties.append(f"    <Offset>{repr(band.GetOffset())}</Offset>")
+    if band.GetScale() not in (None, 1.0):
+        properties.append(f"    <Scale>{repr(band.GetScale())}</Scale>")
+
+    lines = [f'<VRTDataset rasterXSize="{str(dataset.RasterXSize)}" rasterYSize="{str(dataset.RasterYSize)}">',
+             f"  <SRS>{escape(dataset.GetProjection())}</SRS>",
+             f"  <GeoTransform>{', '.join(repr(value) for value in dataset.GetGeoTransform())}</GeoTransform>"]
+    for band_num, fh_file in enumerate(fh_files, start=1):
+        lines.append(f'  <VRTRasterBand dataType="{data_type}" band="{str(band_num)}">')
+        lines += properties
+        if fh_file is not None:
+            lines += ["    <SimpleSource>",
+                      f'      <SourceFilename relativeToVRT="1">{escape(fh_file)}</SourceFilename>',
+                      "      <SourceBand>1</SourceBand>",
+                      "    </SimpleSource>"]
+        lines.append("  </VRTRasterBand>")
+    lines.append("</VRTDataset>")
+    return "\n".join(lines) + "\n"
+
+
+def write_vrts(model_name, timestamp, fhs, changed_fhs):
+    # Only bands with a file for one of changed_fhs need a new VRT
+    publish_dir = get_publish_dir(model_name, timestamp)
+    bands_dir = publish_dir + "/" + BANDS_DIR
+    full_fhs = schedules.get_schedule(model_name, timestamp.strftime("%H")).full_fhs
+
+    names = []
+    for shorthand in sorted(os.listdir(bands_dir)) if os.path.isdir(bands_dir) else []:
+        available = set(name[:-len(".tif")] for name in os.listdir(bands_dir + "/" + shorthand)
+                        if name.endswith(".tif"))
+        published = [fh for fh in full_fhs if fh in fhs and fh in available]
+        if not published:
+            continue
+
+        vrt_name = get_vrt_name(model_name, timestamp, shorthand)
+        names.append(vrt_name)
+        if not available.intersection(changed_fhs) and os.path.exists(publish_dir + "/" + vrt_name):
+            continue
+
+        dataset = gdal.Open(bands_dir + "/" + shorthand + "/" + published[0] + ".tif")
+        replace_file(publish_dir + "/" + vrt_name, make_vrt(
+            dataset, [BANDS_DIR + "/" + shorthand + "/" + fh + ".tif" if fh in published else None
+                      for fh in full_fhs]))
+        dataset = None
+    return names
+
+
+def read_manifest(publish_dir, model_name, timestamp):
+    try:
+        with open(publish_dir + "/" + MANIFEST) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {
+            "model": model_name,
+            "run": timestamp.strftime("%Y%m%d%H"),
+            "finished": False,
+            "fhs": [],
+            "incomplete": []
+        }
+
+
+def swap_link(link, target):
+    if os.path.islink(link) and os.readlink(link) == target:
+        return
+
+    staged = link + "." + str(os.getpid())
+    if os.path.lexists(staged):
+        os.remove(staged)
+    os.symlink(target, staged)
+    os.replace(staged, link)
+
+
+def point_latest(model_name, run_name):
+    latest = get_model_dir(model_name) + "/" + LATEST
+    # A run that was held up doesn't take over from a newer one
+    if os.path.islink(latest) and os.readlink(latest) > run_name:
+        return False
+
+    swap_link(latest, run_name)
+    return True
+
+
+def publish_manifest(model_name, timestamp, manifest, changed_fhs):
+    publish_dir = get_publish_dir(model_name, timestamp)
+    run_name = get_run_name(timestamp)
+
+    os.makedirs(publish_dir, exist_ok=True)
+    manifest["files"] = write_vrts(model_name, timestamp,
+                                   set(manifest["fhs"] + manifest["incomplete"]), changed_fhs)
+    manifest["published"] = clock.now().isoformat()
+    replace_file(publish_dir + "/" + MANIFEST, json.dumps(manifest, indent=4))
+
+    swap_link(get_run_dir(model_name, timestamp), RUNS_DIR + "/" + run_name)
+    return point_latest(model_name, run_name)
+
+
+def publish_fh(model_name, timestamp, fh, complete=True):
+    run_name = get_run_name(timestamp)
+
+    try:
+        manifest = read_manifest(get_publish_dir(model_name, timestamp), model_name, timestamp)
+        full_fhs = schedules.get_schedule(model_name, timestamp.strftime("%H")).full_fhs
+        for key in ["fhs", "incomplete"]:
+            fhs = set(manifest[key]) - {fh}
+            if key == ("fhs" if complete else "incomplete"):
+                fhs.add(fh)
+            manifest[key] = [full_fh for full_fh in full_fhs if full_fh in fhs]
+
+        is_latest = publish_manifest(model_name, timestamp, manifest, {fh})
+    except Exception as e:
+        log(f"× Couldn't publish {model_name} | {run_name} | {fh}.",
+            "ERROR", indentLevel=1, remote=True, model=model_name)
+        log(repr(e), "ERROR", indentLevel=1, remote=True, model=model_name)
+        return False
+
+    log(f"✓ Published {model_name} | {run_name} | {fh}" + ("" if complete else " (incomplete)") +
+        (" as latest." if is_latest else "."), "INFO", indentLevel=1, model=model_name)
+    return True
+
+
+def publish(model_name, timestamp, failed_steps):
+    # The run is finished; its fhs are already published, this settles the manifest
+    run_name = get_run_name(timestamp)
+
+    try:
+        schedule = schedules.get_schedule(model_name, timestamp.strftime("%H"))
+        failed_fhs = set(fh for fh, band in failed_steps)
+
+        manifest = read_manifest(get_publish_dir(model_name, timestamp), model_name, timestamp)
+        manifest["finished"] = True
+        manifest["fhs"] = [fh for fh in schedule.full_fhs if fh not in failed_fhs]
+        manifest["incomplete"] = [fh for fh in schedule.full_fhs if fh in failed_fhs]
+
+        # fhs of a run that was resumed may not have been published by us
+        is_latest = publish_manifest(model_name, timestamp, manifest,
+                                     set(schedule.full_fhs))
+    except Exception as e:
+        log(f"× Couldn't publish {model_name} | {run_name}.",
+            "ERROR", indentLevel=1, remote=True, model=model_name)
+        log(repr(e), "ERROR", indentLevel=1, remote=True, model=model_name)
+        return False
+
+    log(f"✓ Published {model_name} | {run_name} with {str(len(manifest['fhs']))} complete fhs" +
+        (" as latest." if is_latest else "."), "NOTICE", indentLevel=1, remote=True, model=model_name)
+    return True
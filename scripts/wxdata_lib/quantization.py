@@ -0,0 +1,28 @@
+import numpy as np
+
+'''
+    Bands stored as integers are quantized: value = (stored * scale) +
+    offset. Values are rounded to the nearest step and clipped to the
+    type's range, leaving out the nodata value, which is what NaN, inf
+    and the source's own nodata become.
+'''
+
+
+def quantize(values, out, scale, offset, nodata, src_nodata=None):
+    # values is used as scratch space
+    info = np.iinfo(out.dtype)
+    low = info.min + 1 if nodata == info.min else info.min
+    high = info.max - 1 if nodata == info.max else info.max
+
+    invalid = ~np.isfinite(values)
+    if src_nodata is not None:
+        invalid |= values == src_nodata
+
+    np.subtract(values, offset, out=values)
+    np.divide(values, scale, out=values)
+    np.rint(values, out=values)
+    np.clip(values, low, high, out=values)
+    np.copyto(values, low, where=invalid)
+    np.copyto(out, values, casting="unsafe")
+    np.copyto(out, nodata, where=invalid)
+    return out
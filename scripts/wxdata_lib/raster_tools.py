@@ -0,0 +1,140 @@
+from .config import config
+from .quantization import quantize
+
+from osgeo import gdal, gdal_array
+import numpy as np
+import os
+
+'''
+    Band copies are streamed through a window at a time instead of reading
+    whole grids into memory. Windows are made of whole destination blocks
+    (strips for the default GTiff layout, tiles for tiled ones), so every
+    block is written once, and hold at most copyBufferMB (default 16) of
+    pixels. The buffers are allocated once per worker and reused for every
+    window and every step.
+
+    Integer destination bands are quantized on the way: value =
+    (stored * scale) + offset (see quantization), using the band's own scale, offset and
+    nodata, so files created before a band's storage changed keep working.
+    Sinks (see outputs) see each window before it's quantized.
+'''
+
+buffers = {}
+
+
+def get_buffer(name, pixels, dtype):
+    buffer = buffers.get(name)
+    if buffer is None or buffer.dtype != dtype or buffer.size < pixels:
+        buffer = np.empty(pixels, dtype=dtype)
+        buffers[name] = buffer
+    return buffer
+
+
+def get_windows(width, height, block_x, block_y, max_pixels):
+    block_x = min(block_x, width)
+    block_y = min(block_y, height)
+
+    # As many whole blocks across as fit, then as many rows of them
+    cols = max(block_x, min(width, max_pixels // block_y) // block_x * block_x)
+    rows = max(block_y, max_pixels // cols // block_y * block_y)
+
+    for y in range(0, height, rows):
+        for x in range(0, width, cols):
+            yield x, y, min(cols, width - x), min(rows, height - y)
+
+
+def copy_band(src_band, dst_band, sinks=()):
+    width = dst_band.XSize
+    height = dst_band.YSize
+    block_x, block_y = dst_band.GetBlockSize()
+
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(dst_band.DataType))
+    quantized = np.issubdtype(dtype, np.integer)
+    read_dtype = np.dtype(np.float32) if quantized else dtype
+
+    max_pixels = max(1, int(config.get("copyBufferMB", 16) * 1024 * 1024) // read_dtype.itemsize)
+    windows = list(get_windows(width, height, block_x, block_y, max_pixels))
+    largest = max(w * h for x, y, w, h in windows)
+    data = get_buffer("read", largest, read_dtype)
+    if quantized:
+        stored = get_buffer("stored", largest, dtype)
+        scale = dst_band.GetScale() or 1.0
+        offset = dst_band.GetOffset() or 0.0
+        nodata = dst_band.GetNoDataValue()
+        nodata = int(np.iinfo(dtype).min if nodata is None else nodata)
+        src_nodata = src_band.GetNoDataValue()
+
+    for x, y, w, h in windows:
+        # A contiguous view of the start of the buffer; GDAL converts to the
+        # buffer's type as it reads
+        window = data[:w * h].reshape(h, w)
+        src_band.ReadAsArray(x, y, w, h, buf_obj=window)
+        for sink in sinks:
+            sink.write(x, y, window, src_band.GetNoDataValue())
+        if quantized:
+            window = quantize(window, stored[:w * h].reshape(h, w),
+                              scale, offset, nodata, src_nodata)
+        dst_band.WriteArray(window, x, y)
+
+
+def read_window(band, x, y, w, h):
+    # Real values as float32, with nodata as NaN
+    values = band.ReadAsArray(x, y, w, h, buf_type=gdal.GDT_Float32)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        values[values == np.float32(nodata)] = np.nan
+    scale = band.GetScale()
+    offset = band.GetOffset()
+    if scale not in (None, 1.0) or offset not in (None, 0.0):
+        values *= scale or 1.0
+        values += offset or 0.0
+    return values
+
+
+def write_window(band, values, x, y):
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+    if np.issubdtype(dtype, np.integer):
+        nodata = band.GetNoDataValue()
+        values = quantize(np.array(values, dtype=np.float32), np.empty(values.shape, dtype=dtype),
+                          band.GetScale() or 1.0, band.GetOffset() or 0.0,
+                          int(np.iinfo(dtype).min if nodata is None else nodata))
+    band.WriteArray(values, x, y)
+
+
+'''
+    Master TIFs are created straight on disk. Blocks nothing has been
+    written to yet are written out as zeros (or nodata, for quantized
+    bands) when the file is closed, without holding every band in memory
+    first.
+'''
+
+
+def create_master(target_filename, template_filename, num_bands, storage=None):
+    data_type = gdal.GDT_Float32
+    if storage is not None:
+        data_type = gdal.GetDataTypeByName(storage.type)
+
+    template = gdal.Open(template_filename)
+    new_raster = gdal.GetDriverByName('GTiff').Create(
+        target_filename, template.RasterXSize, template.RasterYSize, num_bands, data_type)
+    new_raster.SetProjection(template.GetProjection())
+    new_raster.SetGeoTransform(list(template.GetGeoTransform()))
+    if storage is not None and storage.nodata is not None:
+        # Unwritten blocks are filled with nodata instead of zeros
+        for i in range(1, num_bands + 1):
+            raster_band = new_raster.GetRasterBand(i)
+            raster_band.SetNoDataValue(storage.nodata)
+            raster_band.SetScale(storage.scale)
+            raster_band.SetOffset(storage.offset)
+    new_raster.FlushCache()
+    new_raster = None
+    template = None
+
+
+def extract_band(dataset, band_num, target_filename):
+    # A band of a master TIF as a file of its own, swapped in whole (see publish)
+    os.makedirs(os.path.dirname(target_filename), exist_ok=True)
+    staged = target_filename + "." + str(os.getpid())
+    extracted = gdal.Translate(staged, dataset, format="GTiff", bandList=[band_num])
+    extracted = None
+    os.replace(staged, target_filename)
@@ -0,0 +1,106 @@
+from .config import models, get_model
+from .logger import log
+
+from types import MappingProxyType
+
+'''
+    Forecast hour schedules, compiled once from the config for every model
+    and cycle hour. A schedule holds the sequence of forecast hours for a
+    run, their zero-padded names and which master TIF band each one is
+    written to, so nothing has to walk fhStep/fhStepManual at runtime.
+'''
+
+
+class Schedule:
+    __slots__ = ("model_name", "hour", "fhs", "full_fhs",
+                 "band_numbers", "band_count")
+
+    def __init__(self, model_name, hour, fhs, full_fhs):
+        object.__setattr__(self, "model_name", model_name)
+        object.__setattr__(self, "hour", hour)
+        object.__setattr__(self, "fhs", tuple(fhs))
+        object.__setattr__(self, "full_fhs", tuple(full_fhs))
+        object.__setattr__(self, "band_numbers", MappingProxyType(
+            {full_fh: i + 1 for i, full_fh in enumerate(full_fhs)}))
+        object.__setattr__(self, "band_count", len(fhs))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Schedules can't be modified")
+
+
+schedules = {}
+
+
+def get_fh_steps(model, hour):
+    fh_steps = {}
+    if "fhStepManual" in model:
+        for fh_def in model["fhStepManual"]:
+            if hour in fh_def["appliesTo"]:
+                fh_steps = fh_def["fhStep"]
+                break
+    else:
+        fh_steps = model["fhStep"]
+
+    # (start hour, step) pairs, latest start first
+    return sorted(((int(float(key)), fh_steps[key]) for key in fh_steps), reverse=True)
+
+
+def get_next_fh(fh_steps, fh):
+    for start, step in fh_steps:
+        if fh >= start:
+            return fh + step
+    return None
+
+
+def format_fh(model, fh):
+    return str(fh).rjust(len(str(model["endTime"])), '0')
+
+
+def compile_schedule(model_name, hour):
+    model = get_model(model_name).raw
+    fh_steps = get_fh_steps(model, hour)
+
+    fhs = []
+    fh = model["startTime"]
+    while True:
+        fhs.append(fh)
+        fh = get_next_fh(fh_steps, fh)
+
+        if fh is None:
+            log(f"× Couldn't match the appropriate step size for {hour}Z.",
+                "WARN", indentLevel=1, model=model_name)
+            break
+
+        if fh > model["endTime"]:
+            break
+
+    return Schedule(model_name, hour, fhs, [format_fh(model, fh) for fh in fhs])
+
+
+def get_cycle_hours(model):
+    hours = set()
+    hour = model["updateOffset"] % 24
+    while hour not in hours:
+        hours.add(hour)
+        hour = (hour + model["updateFrequency"]) % 24
+    return sorted(str(hour).rjust(2, '0') for hour in hours)
+
+
+def compile_schedules():
+    global schedules
+    compiled = {}
+    for model_name, model in models.items():
+        for hour in get_cycle_hours(model):
+            compiled[(model_name, hour)] = compile_schedule(model_name, hour)
+    schedules = compiled
+
+
+def get_schedule(model_name, hour):
+    key = (model_name, hour)
+    if key not in schedules:
+        # Off-cycle hour, compile it on demand
+        schedules[key] = compile_schedule(model_name, hour)
+    return schedules[key]
+
+
+compile_schedules()
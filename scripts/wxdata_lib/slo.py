@@ -0,0 +1,182 @@
+from .config import config, models
+from .logger import log
+from . import pg_connection_manager as pg
+from . import clock
+
+'''
+    End-to-end latency for every forecast hour, from upstream to a band
+    that can be read from our TIFs. Each (model, run, fh) row in
+    wxdata.fh_arrivals gets:
+     * upstream_at - the Last-Modified of the upstream file, when we got one
+     * first_seen - when we first found the file available
+     * started_at/finished_at - the first step starting and the last one
+       finishing
+     * published_at - when the fh was published, i.e. added to the run's
+       manifest by publish_fh in wxdata.py (see publish)
+
+    The dispatcher collects these from step results and writes the row
+    once the fh is published. The SLO is that published_at - upstream_at
+    stays under sloTargetMinutes (per model, or in config) for sloPercentile
+    of the fhs. When upstream didn't send a Last-Modified, first_seen is
+    used instead, and the report says how many fhs that was.
+'''
+
+# (model, timestamp, fh) -> timings collected so far
+pending = {}
+
+# Forecast hours that lost a band, or couldn't be published; they don't count
+failed = set()
+
+
+def observe(result):
+    key = (result["model_name"], result["timestamp"], result["fh"])
+    if key in failed:
+        return
+
+    if key not in pending:
+        pending[key] = {"upstream_at": None, "seen_at": None,
+                        "started_at": None, "finished_at": None}
+
+    entry = pending[key]
+    for field in ["upstream_at", "seen_at", "started_at"]:
+        if result[field] is not None and (entry[field] is None or result[field] < entry[field]):
+            entry[field] = result[field]
+    if entry["finished_at"] is None or result["finished_at"] > entry["finished_at"]:
+        entry["finished_at"] = result["finished_at"]
+
+
+def discard(model_name, timestamp, fh):
+    pending.pop((model_name, timestamp, fh), None)
+    failed.add((model_name, timestamp, fh))
+
+
+def record_published(model_name, timestamp, fh):
+    key = (model_name, timestamp, fh)
+    entry = pending.pop(key, None)
+    if key in failed:
+        failed.discard(key)
+        return
+    if entry is None:
+        return
+
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        curr.execute('''
+            INSERT INTO wxdata.fh_arrivals (model, timestamp, fh, first_seen, upstream_at,
+                started_at, finished_at, published_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (model, timestamp, fh) DO UPDATE SET
+                first_seen = LEAST(wxdata.fh_arrivals.first_seen, EXCLUDED.first_seen),
+                upstream_at = COALESCE(wxdata.fh_arrivals.upstream_at, EXCLUDED.upstream_at),
+                started_at = LEAST(wxdata.fh_arrivals.started_at, EXCLUDED.started_at),
+                finished_at = EXCLUDED.finished_at,
+                published_at = EXCLUDED.published_at''',
+                     (model_name, timestamp, fh, entry["seen_at"] or entry["started_at"],
+                      entry["upstream_at"], entry["started_at"], entry["finished_at"],
+                      clock.now()))
+        conn.commit()
+    except Exception as e:
+        log("Couldn't record fh latency for " + model_name,
+            "WARN", remote=True, model=model_name)
+        log(repr(e), "WARN", indentLevel=1)
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+
+def get_target_minutes(model_name):
+    if model_name in models and "sloTargetMinutes" in models[model_name]:
+        return models[model_name]["sloTargetMinutes"]
+    return config.get("sloTargetMinutes", 30)
+
+
+'''
+    Percentiles (in seconds) per model over the last `hours`:
+     * end_to_end - upstream Last-Modified (or first seen) to published
+     * since_seen - first seen to published
+     * queued - first seen to processing start
+     * processing - processing start to finish
+    plus how many fhs were published within the model's target, and how
+    many of them had no upstream time to measure from.
+'''
+
+
+def get_report(hours=24):
+    report = {}
+    conn = curr = None
+    try:
+        conn, curr = pg.ConnectionPool.connect()
+        curr.execute('''
+            SELECT model, COUNT(*),
+                percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM published_at - COALESCE(upstream_at, first_seen))),
+                percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM published_at - first_seen)),
+                percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM started_at - first_seen)),
+                percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM finished_at - started_at)),
+                array_agg(EXTRACT(EPOCH FROM published_at - COALESCE(upstream_at, first_seen))),
+                COUNT(*) FILTER (WHERE upstream_at IS NULL)
+            FROM wxdata.fh_arrivals
+            WHERE published_at IS NOT NULL AND published_at > now() - %s * interval '1 hour'
+            GROUP BY model ORDER BY model''', (hours,))
+
+        for row in curr.fetchall():
+            target = get_target_minutes(row[0]) * 60
+            report[row[0]] = {
+                "count": row[1],
+                "end_to_end": row[2],
+                "since_seen": row[3],
+                "queued": row[4],
+                "processing": row[5],
+                "target": target,
+                "within_target": len([lag for lag in row[6] if lag is not None and lag <= target]),
+                "from_first_seen": row[7]
+            }
+    except Exception as e:
+        log("Couldn't load the SLO report.", "ERROR")
+        log(repr(e), "ERROR", indentLevel=1)
+        return None
+    finally:
+        if conn is not None:
+            pg.ConnectionPool.close(conn, curr)
+
+    return report
+
+
+def format_minutes(percentiles):
+    if percentiles is None or percentiles[0] is None:
+        return "       -"
+    return " / ".join(f"{seconds / 60:5.1f}" for seconds in percentiles)
+
+
+def print_report(hours=24):
+    report = get_report(hours)
+    if report is None:
+        return False
+
+    objective = config.get("sloPercentile", 95)
+    print(f"Latency over the last {str(hours)}h, minutes as p50 / p95 / p99. " +
+          f"Objective: {str(objective)}% of fhs published within target.\n")
+
+    if len(report) == 0:
+        print("No published forecast hours yet.")
+        return True
+
+    all_ok = True
+    for model_name, stats in report.items():
+        met = 100 * stats["within_target"] / stats["count"]
+        ok = met >= objective
+        all_ok = all_ok and ok
+        print(f"{'✓' if ok else '×'} {model_name} | {str(stats['count'])} fhs | " +
+              f"{met:.1f}% within {str(int(stats['target'] / 60))}m")
+        if stats["from_first_seen"] == stats["count"]:
+            baseline = "from first seen, upstream sent no Last-Modified"
+        elif stats["from_first_seen"] > 0:
+            baseline = f"from upstream, {str(stats['from_first_seen'])} fhs from first seen"
+        else:
+            baseline = "from upstream"
+        print(f"   end to end     {format_minutes(stats['end_to_end'])} ({baseline})")
+        print(f"   since seen     {format_minutes(stats['since_seen'])}")
+        print(f"   queued         {format_minutes(stats['queued'])}")
+        print(f"   processing     {format_minutes(stats['processing'])}")
+
+    return all_ok
@@ -0,0 +1,343 @@
+from .config import config, get_model
+from .logger import log
+
+from . import model_tools as model_tools
+from . import metrics
+import hashlib
+import json
+import math
+import os
+
+from osgeo import gdal, osr
+import numpy as np
+
+'''
+    Pre-rendered web map tiles, for bands (or derived variables) with
+    `tiles` set, so most map traffic can be served as static files.
+
+    Each (band, fh) gets a step that runs once the band is written and
+    renders XYZ (Web Mercator) tiles over the configured zoom range into
+    <tilesDir>/<model>/<run>/<band>/<band number>/<z>/<x>/<y>.<format>.
+    Tiles are colored with the band's ramp, or hold the raw values packed
+    into RGB. A row of tiles is warped at a time, at most copyBufferMB of
+    them.
+
+    Before a row of tiles is warped, the source pixels it's warped from
+    are hashed, along with everything else that goes into the tiles. If
+    the same hash was rendered for the same tiles before (the same fh, on
+    a retry or a resumed run, the previous fh, or the same fh of the
+    previous run), those tiles are linked instead of warped and rendered
+    again. That's what keeps fields that don't change between fhs or runs,
+    and dry or calm areas, from being rendered over and over. Hashes are
+    kept in sources.json next to the tiles. Tiles with no data aren't
+    written.
+'''
+
+TILE_SIZE = 256
+ORIGIN = 20037508.342789244
+MAX_LAT = 85.0511287798
+SOURCES_FILE = "sources.json"
+# Pixels around a row of tiles, in source pixels and in tile pixels
+# (kernels grow when downsampling), that resampling may reach
+SOURCE_PADDING = 4
+
+
+def get_tiles_dir():
+    return config.get("tilesDir", config["mapfileDir"] + "/tiles")
+
+
+def get_tile_dir(model_name, timestamp, shorthand, band_num):
+    return get_tiles_dir() + "/" + model_name + "/" + timestamp.strftime("%Y%m%d%H") + \
+        "/" + shorthand + "/" + str(band_num)
+
+
+def get_tile_range(left, bottom, right, top, zoom):
+    # Tile columns and rows (from the top) covering the bounds
+    count = 2 ** zoom
+    bottom = max(bottom, -MAX_LAT)
+    top = min(top, MAX_LAT)
+
+    def column(lon):
+        return min(max(int(math.floor((lon + 180) / 360 * count)), 0), count - 1)
+
+    def row(lat):
+        y = math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+        return min(max(int(math.floor((1 - y / math.pi) / 2 * count)), 0), count - 1)
+
+    return column(left), row(top), column(right - 1e-9), row(bottom + 1e-9)
+
+
+def get_run_dirs(model_name):
+    runs_dir = get_tiles_dir() + "/" + model_name
+    try:
+        return sorted(name for name in os.listdir(runs_dir) if name.isdigit())
+    except OSError:
+        return []
+
+
+def get_candidate_dirs(model_name, timestamp, shorthand, band_num):
+    # Where the same source is most likely to have been rendered already
+    candidates = [get_tile_dir(model_name, timestamp, shorthand, band_num)]
+    if band_num > 1:
+        candidates.append(get_tile_dir(model_name, timestamp, shorthand, band_num - 1))
+
+    run = timestamp.strftime("%Y%m%d%H")
+    earlier = [name for name in get_run_dirs(model_name) if name < run]
+    if earlier:
+        candidates.append(get_tiles_dir() + "/" + model_name + "/" + earlier[-1] +
+                          "/" + shorthand + "/" + str(band_num))
+    return candidates
+
+
+def get_tile_bounds(x, y, zoom):
+    size = 2 * ORIGIN / 2 ** zoom
+    return (-ORIGIN + x * size, ORIGIN - (y + 1) * size,
+            -ORIGIN + (x + 1) * size, ORIGIN - y * size)
+
+
+def render(values, settings):
+    # float32 values with NaN for nodata -> 4 x h x w RGBA
+    rgba = np.zeros((4,) + values.shape, dtype=np.uint8)
+    valid = np.isfinite(values)
+
+    if len(settings.ramp_values) > 0:
+        values = np.where(valid, values, settings.ramp_values[0])
+        for channel in range(4):
+            rgba[channel] = np.interp(values, settings.ramp_values,
+                                      [color[channel] for color in settings.ramp_colors]).astype(np.uint8)
+    else:
+        packed = np.rint((np.where(valid, values, settings.offset) - settings.offset) / settings.scale)
+        packed = np.clip(packed, 0, 2 ** 24 - 1).astype(np.uint32)
+        rgba[0] = packed >> 16
+        rgba[1] = (packed >> 8) & 255
+        rgba[2] = packed & 255
+        rgba[3] = 255
+
+    rgba[:, ~valid] = 0
+    return rgba
+
+
+def encode(rgba, settings):
+    image = gdal.GetDriverByName("MEM").Create(
+        "", TILE_SIZE, TILE_SIZE, 4, gdal.GDT_Byte)
+    for channel in range(4):
+        image.GetRasterBand(channel + 1).WriteArray(rgba[channel])
+
+    path = "/vsimem/tile." + settings.format.lower()
+    options = ["LOSSLESS=TRUE"] if settings.format == "WEBP" and len(settings.ramp_values) == 0 else []
+    gdal.GetDriverByName(settings.format).CreateCopy(path, image, 0, options)
+    image = None
+
+    f = gdal.VSIFOpenL(path, "rb")
+    gdal.VSIFSeekL(f, 0, 2)
+    size = gdal.VSIFTellL(f)
+    gdal.VSIFSeekL(f, 0, 0)
+    data = gdal.VSIFReadL(1, size, f)
+    gdal.VSIFCloseL(f)
+    gdal.Unlink(path)
+    return data
+
+
+def to_lat(y):
+    return math.degrees(2 * math.atan(math.exp(y / ORIGIN * math.pi)) - math.pi / 2)
+
+
+def get_source_window(geo_transform, width, height, west, south, east, north, tile_pixel):
+    # Pixels of a north-up lat/lon grid covering Web Mercator bounds
+    left, pixel_width, _, top, _, pixel_height = geo_transform
+    margin = tile_pixel * SOURCE_PADDING
+    west, south, east, north = west - margin, south - margin, east + margin, north + margin
+    x0 = math.floor((west / ORIGIN * 180 - left) / pixel_width) - SOURCE_PADDING
+    x1 = math.ceil((east / ORIGIN * 180 - left) / pixel_width) + SOURCE_PADDING
+    y0 = math.floor((to_lat(north) - top) / pixel_height) - SOURCE_PADDING
+    y1 = math.ceil((to_lat(south) - top) / pixel_height) + SOURCE_PADDING
+
+    x0, x1 = max(x0, 0), min(x1, width)
+    y0, y1 = max(y0, 0), min(y1, height)
+    return x0, y0, max(x1 - x0, 0), max(y1 - y0, 0)
+
+
+def get_source_digest(raster_band, window, context):
+    digest = hashlib.sha1(json.dumps(context).encode("utf-8"))
+    x, y, w, h = window
+    if w > 0 and h > 0:
+        digest.update(raster_band.ReadAsArray(x, y, w, h).tobytes())
+    return digest.hexdigest()
+
+
+def load_sources(tile_dir):
+    try:
+        with open(tile_dir + "/" + SOURCES_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_sources(tile_dir, sources):
+    with open(tile_dir + "/" + SOURCES_FILE + ".tmp", "w") as f:
+        json.dump(sources, f)
+    os.replace(tile_dir + "/" + SOURCES_FILE + ".tmp",
+               tile_dir + "/" + SOURCES_FILE)
+
+
+def link_tiles(tile_dir, candidate_dir, keys, extension):
+    # Tiles are replaced, never rewritten, so linked ones can't change
+    for key in keys:
+        filename = tile_dir + "/" + key + extension
+        if candidate_dir == tile_dir:
+            if not os.path.exists(filename):
+                return False
+            continue
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        try:
+            if os.path.lexists(filename):
+                os.remove(filename)
+            os.link(candidate_dir + "/" + key + extension, filename)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            with open(candidate_dir + "/" + key + extension, "rb") as f:
+                write_tile(filename, f.read())
+    return True
+
+
+def remove_tiles(tile_dir, keys, extension):
+    for key in keys:
+        try:
+            os.remove(tile_dir + "/" + key + extension)
+        except OSError:
+            pass
+
+
+def write_tile(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(filename + ".tmp", filename)
+
+
+def generate(model_name, timestamp, fh, band, band_num):
+    model = get_model(model_name)
+    shorthand = band["tiles"]
+    settings = model.get_tiles(shorthand)
+    if settings is None:
+        log(f"× {shorthand} doesn't have tiles set anymore.",
+            "WARN", indentLevel=2, remote=True, model=model_name)
+        return False
+
+    tile_dir = get_tile_dir(model_name, timestamp, shorthand, band_num)
+    extension = "." + settings.format.lower()
+    written = linked = 0
+
+    try:
+        os.makedirs(tile_dir, exist_ok=True)
+        sources = load_sources(tile_dir)
+        candidates = [(candidate_dir, sources if candidate_dir == tile_dir else load_sources(candidate_dir))
+                      for candidate_dir in get_candidate_dirs(model_name, timestamp, shorthand, band_num)]
+
+        with metrics.span("write"):
+            tif = gdal.Open(model_tools.get_band_filename(
+                model_name, timestamp, shorthand))
+            raster_band = tif.GetRasterBand(band_num)
+            scale = raster_band.GetScale() or 1.0
+            offset = raster_band.GetOffset() or 0.0
+            source = gdal.Translate("", tif, format="VRT", bandList=[band_num])
+
+            geo_transform = tif.GetGeoTransform()
+            left = geo_transform[0]
+            top = geo_transform[3]
+            right = left + geo_transform[1] * tif.RasterXSize
+            bottom = top + geo_transform[5] * tif.RasterYSize
+
+            # Source windows can only be worked out for north-up lat/lon
+            # grids that don't wrap past the antimeridian
+            srs = osr.SpatialReference()
+            srs.ImportFromWkt(tif.GetProjection())
+            hashable = bool(srs.IsGeographic()) and geo_transform[2] == 0 and \
+                geo_transform[4] == 0 and left >= -180 and right <= 180
+            resampling = config.get("resampling", "bilinear")
+            context = [list(geo_transform), scale, offset, raster_band.GetNoDataValue(), resampling,
+                       settings.format, settings.ramp_values, settings.ramp_colors,
+                       settings.scale, settings.offset]
+
+            max_columns = max(1, int(config.get("copyBufferMB", 16) * 1024 * 1024) //
+                              (4 * TILE_SIZE * TILE_SIZE))
+
+            for zoom in range(settings.min_zoom, settings.max_zoom + 1):
+                x0, y0, x1, y1 = get_tile_range(left, bottom, right, top, zoom)
+                for y in range(y0, y1 + 1):
+                    for first in range(x0, x1 + 1, max_columns):
+                        last = min(first + max_columns - 1, x1)
+                        west, south, _, north = get_tile_bounds(first, y, zoom)
+                        east = get_tile_bounds(last, y, zoom)[2]
+
+                        row_key = f"{str(zoom)}/{str(y)}/{str(first)}-{str(last)}"
+                        previous = sources.get(row_key)
+                        digest = None
+                        if hashable:
+                            window = get_source_window(geo_transform, tif.RasterXSize, tif.RasterYSize,
+                                                       west, south, east, north,
+                                                       (east - west) / ((last - first + 1) * TILE_SIZE))
+                            digest = get_source_digest(raster_band, window, context + [row_key, list(window)])
+
+                        match = None
+                        if digest is not None:
+                            for candidate_dir, candidate_sources in candidates:
+                                entry = candidate_sources.get(row_key)
+                                if entry is not None and entry["source"] == digest:
+                                    match = (candidate_dir, entry)
+                                    break
+
+                        if match is not None:
+                            keys = [f"{str(zoom)}/{str(x)}/{str(y)}" for x in match[1]["columns"]]
+                            if link_tiles(tile_dir, match[0], keys, extension):
+                                if previous is not None:
+                                    remove_tiles(tile_dir, [f"{str(zoom)}/{str(x)}/{str(y)}" for x in previous["columns"]
+                                                            if x not in match[1]["columns"]], extension)
+                                sources[row_key] = match[1]
+                                linked += len(keys)
+                                continue
+
+                        warped = gdal.Warp("", source, format="MEM", dstSRS="EPSG:3857",
+                                           outputBounds=[west, south, east, north],
+                                           width=(last - first + 1) * TILE_SIZE, height=TILE_SIZE,
+                                           outputType=gdal.GDT_Float32, dstNodata=float("nan"),
+                                           resampleAlg=resampling)
+                        values = warped.GetRasterBand(1).ReadAsArray()
+                        warped = None
+                        if scale != 1.0 or offset != 0.0:
+                            values = values * scale + offset
+
+                        columns = []
+                        for x in range(first, last + 1):
+                            filename = tile_dir + "/" + f"{str(zoom)}/{str(x)}/{str(y)}" + extension
+                            column = (x - first) * TILE_SIZE
+                            rgba = render(values[:, column:column + TILE_SIZE], settings)
+
+                            if not rgba[3].any():
+                                if os.path.lexists(filename):
+                                    os.remove(filename)
+                                continue
+
+                            write_tile(filename, encode(rgba, settings))
+                            columns.append(x)
+                            written += 1
+
+                        if digest is not None:
+                            sources[row_key] = {"source": digest, "columns": columns}
+                        else:
+                            sources.pop(row_key, None)
+
+            source = None
+            tif = None
+            save_sources(tile_dir, sources)
+    except Exception as e:
+        log(f"Couldn't render tiles for {shorthand} | fh: {fh}.",
+            "ERROR", indentLevel=2, remote=True, model=model_name)
+        log(repr(e), "ERROR", indentLevel=2, remote=True, model=model_name)
+        return False
+
+    log(f"✓ Rendered {str(written)} tiles for {shorthand} | fh: {fh} ({str(linked)} reused).",
+        "INFO", indentLevel=2, remote=True, model=model_name)
+    return True
@@ -0,0 +1,215 @@
+from .config import config
+from .logger import log
+
+from . import schedules
+import fcntl
+import json
+import os
+import zlib
+
+import numpy as np
+
+'''
+    A time-major copy of every band (and derived variable), written next
+    to the master TIFs when zarrDir is set, for time series and statistics
+    over a run without opening a TIF band per fh.
+
+    Each run is a Zarr (v2) group at <zarrDir>/<model>/<run>.zarr with an
+    array per variable shaped (fh, y, x), float32, chunked by zarrChunks
+    (default 8 fhs x 256 x 256) and compressed with zlib. It's written
+    without the zarr package: the format is a JSON file per array and a
+    compressed C-order file per chunk, named "<t>.<y>.<x>".
+
+    Values come from the same windows that are written to the TIFs (see
+    outputs). They're collected into (y, x) planes of a chunk, and each
+    plane is written into its chunk as soon as it's full, so an fh is in
+    the store as soon as its band is written. Chunks hold several fhs, so
+    that's a read-modify-write under a lock on the array. Chunks with
+    nothing in them aren't written; readers see the fill value (NaN).
+
+    The group's metadata is consolidated into .zmetadata when the run is
+    finished.
+'''
+
+DEFAULT_CHUNKS = (8, 256, 256)
+COMPRESSION_LEVEL = 1
+LOCK_FILE = ".lock"
+
+
+def is_enabled():
+    return bool(config.get("zarrDir"))
+
+
+def get_group_dir(model_name, timestamp):
+    return config["zarrDir"] + "/" + model_name + "/" + \
+        timestamp.strftime("%Y%m%d%H") + ".zarr"
+
+
+def get_chunks():
+    return tuple(int(size) for size in config.get("zarrChunks", DEFAULT_CHUNKS))
+
+
+def write_json(filename, data):
+    # Workers may write the same metadata at the same time; it's identical
+    staged = filename + "." + str(os.getpid())
+    with open(staged, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(staged, filename)
+
+
+def read_json(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def make_group(model_name, timestamp):
+    group_dir = get_group_dir(model_name, timestamp)
+    if not os.path.exists(group_dir + "/.zgroup"):
+        os.makedirs(group_dir, exist_ok=True)
+        write_json(group_dir + "/.zattrs", {
+            "model": model_name,
+            "run": timestamp.strftime("%Y%m%d%H"),
+            "fhs": list(schedules.get_schedule(model_name, timestamp.strftime("%H")).full_fhs)
+        })
+        write_json(group_dir + "/.zgroup", {"zarr_format": 2})
+    return group_dir
+
+
+def make_array(model_name, timestamp, shorthand, dataset):
+    array_dir = make_group(model_name, timestamp) + "/" + shorthand
+    if not os.path.exists(array_dir + "/.zarray"):
+        os.makedirs(array_dir, exist_ok=True)
+        schedule = schedules.get_schedule(model_name, timestamp.strftime("%H"))
+        write_json(array_dir + "/.zattrs", {
+            "_ARRAY_DIMENSIONS": ["fh", "y", "x"],
+            "fhs": list(schedule.full_fhs),
+            "geo_transform": list(dataset.GetGeoTransform()),
+            "crs": dataset.GetProjection()
+        })
+        write_json(array_dir + "/.zarray", {
+            "zarr_format": 2,
+            "shape": [schedule.band_count, dataset.RasterYSize, dataset.RasterXSize],
+            "chunks": list(get_chunks()),
+            "dtype": "<f4",
+            "compressor": {"id": "zlib", "level": COMPRESSION_LEVEL},
+            "fill_value": "NaN",
+            "order": "C",
+            "filters": None,
+            "dimension_separator": "."
+        })
+    return array_dir, read_json(array_dir + "/.zarray")
+
+
+class ChunkWriter:
+    def __init__(self, filename, meta, band_num):
+        self.filename = filename
+        self.t = band_num - 1
+        _, self.height, self.width = meta["shape"]
+        self.chunks = tuple(meta["chunks"])
+        # (chunk row, chunk column) -> [plane, pixels filled]
+        self.pending = {}
+
+    def write(self, x, y, values, nodata=None):
+        _, chunk_y, chunk_x = self.chunks
+        h, w = values.shape
+        for row in range(y // chunk_y, (y + h - 1) // chunk_y + 1):
+            y0 = max(y, row * chunk_y)
+            y1 = min(y + h, (row + 1) * chunk_y)
+            for column in range(x // chunk_x, (x + w - 1) // chunk_x + 1):
+                x0 = max(x, column * chunk_x)
+                x1 = min(x + w, (column + 1) * chunk_x)
+
+                entry = self.pending.get((row, column))
+                if entry is None:
+                    entry = [np.full((chunk_y, chunk_x), np.nan, dtype=np.float32), 0]
+                    self.pending[(row, column)] = entry
+
+                part = entry[0][y0 - row * chunk_y:y1 - row * chunk_y,
+                                x0 - column * chunk_x:x1 - column * chunk_x]
+                part[:] = values[y0 - y:y1 - y, x0 - x:x1 - x]
+                if nodata is not None:
+                    part[part == np.float32(nodata)] = np.nan
+                entry[1] += (y1 - y0) * (x1 - x0)
+
+                # Edge chunks are only partly inside the grid
+                inside = (min(self.height, (row + 1) * chunk_y) - row * chunk_y) * \
+                    (min(self.width, (column + 1) * chunk_x) - column * chunk_x)
+                if entry[1] >= inside:
+                    self.flush(row, column, self.pending.pop((row, column))[0])
+
+    def flush(self, row, column, plane):
+        chunk_t = self.chunks[0]
+        filename = self.filename + "/" + \
+            f"{str(self.t // chunk_t)}.{str(row)}.{str(column)}"
+
+        with open(self.filename + "/" + LOCK_FILE, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(filename):
+                with open(filename, "rb") as f:
+                    chunk = np.frombuffer(zlib.decompress(f.read()), dtype="<f4") \
+                        .reshape(self.chunks).copy()
+            else:
+                chunk = np.full(self.chunks, np.nan, dtype="<f4")
+
+            chunk[self.t % chunk_t] = plane
+            if np.isnan(chunk).all():
+                if os.path.exists(filename):
+                    os.remove(filename)
+                return
+
+            with open(filename + ".part", "wb") as f:
+                f.write(zlib.compress(chunk.tobytes(), COMPRESSION_LEVEL))
+            os.replace(filename + ".part", filename)
+
+    def close(self):
+        # Only left over if the band wasn't written in full
+        for (row, column), (plane, filled) in list(self.pending.items()):
+            self.flush(row, column, plane)
+        self.pending = {}
+
+
+def open_writer(model_name, timestamp, shorthand, band_num, dataset):
+    if not is_enabled():
+        return None
+
+    array_dir, meta = make_array(model_name, timestamp, shorthand, dataset)
+    if band_num > meta["shape"][0]:
+        return None
+    return ChunkWriter(array_dir, meta, band_num)
+
+
+'''
+    Consolidated metadata: every .zgroup/.zarray/.zattrs of the run in one
+    .zmetadata, so readers open the group with a single read.
+'''
+
+
+def consolidate(model_name, timestamp):
+    if not is_enabled():
+        return
+
+    group_dir = get_group_dir(model_name, timestamp)
+    if not os.path.isdir(group_dir):
+        return
+
+    try:
+        metadata = {}
+        for key in [".zgroup", ".zattrs"]:
+            metadata[key] = read_json(group_dir + "/" + key)
+        for name in sorted(os.listdir(group_dir)):
+            if not os.path.exists(group_dir + "/" + name + "/.zarray"):
+                continue
+            for key in [".zarray", ".zattrs"]:
+                metadata[name + "/" + key] = read_json(
+                    group_dir + "/" + name + "/" + key)
+
+        write_json(group_dir + "/.zmetadata", {
+            "zarr_consolidated_format": 1,
+            "metadata": metadata
+        })
+        log(f"✓ Consolidated the Zarr store for {model_name} | {timestamp.strftime('%Y%m%d_%HZ')}.",
+            "INFO", indentLevel=1, remote=True, model=model_name)
+    except Exception as e:
+        log(f"× Couldn't consolidate the Zarr store for {model_name}.",
+            "WARN", indentLevel=1, remote=True, model=model_name)
+        log(repr(e), "ERROR", indentLevel=1, remote=True, model=model_name)